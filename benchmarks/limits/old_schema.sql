@@ -0,0 +1,58 @@
+-- limits schema before sites were partitioned and counted by hour, used by run.sh for comparison
+
+create table sites (
+  id bigserial primary key,
+  public_key varchar(30) not null unique,
+  auth_key varchar(72) not null,
+  created timestamptz not null default current_timestamp,
+  site_size int not null default 0,
+  user_agent varchar(200),
+  ip_address varchar(50)
+);
+create index idx_site_public_key on sites using btree (public_key);
+create index idx_site_auth_key on sites using btree (auth_key);
+create index idx_site_created on sites using btree (created);
+
+create or replace function check_new_site(
+    public_key text,
+    auth_key text,
+    max_sites int,
+    user_agent varchar(200),
+    ip_address varchar(50)
+  ) returns int as $$
+  declare
+    site_count int;
+    site_id int;
+  begin
+    select count(*) into site_count
+    from sites
+    where sites.auth_key=check_new_site.auth_key and now() - created<interval '24 hours';
+
+    if site_count < max_sites then
+      insert into sites (public_key, auth_key, user_agent, ip_address)
+      values (check_new_site.public_key, check_new_site.auth_key, check_new_site.user_agent, check_new_site.ip_address)
+      on conflict do nothing returning id into site_id;
+      if site_id is not null then
+        return site_count;
+      end if;
+    end if;
+    return null;
+  end;
+$$ language plpgsql;
+
+-- reserve space for a batch of files in one atomic statement, the update takes a row lock, so concurrent reservations
+-- for the same site wait for each other and the limit is checked against the latest site size.
+-- returns the new site size, or null if the files would take the site over the limit.
+-- negative sizes release space which was reserved but not used, that's always allowed.
+create or replace function reserve_site_size(public_key text, file_sizes int[], size_limit int) returns int as $$
+  update sites set site_size=sites.site_size + batch.total_size
+  from (select coalesce(sum(f.size), 0) as total_size from unnest(file_sizes) as f(size)) batch
+  where sites.public_key=reserve_site_size.public_key
+    and (batch.total_size <= 0 or sites.site_size + batch.total_size <= size_limit)
+  returning sites.site_size;
+$$ language sql;
+
+-- single file version of reserve_site_size, kept for workers deployed before it existed
+create or replace function check_new_file(public_key text, file_size int, size_limit int) returns int as $$
+  select reserve_site_size(check_new_file.public_key, array[file_size], size_limit);
+$$ language sql;
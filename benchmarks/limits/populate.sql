@@ -0,0 +1,15 @@
+-- a year of sites, none in the last 24 hours, so every key can create sites during the benchmark.
+-- keys are skewed so a few have created most sites, e.g. key-0 has about 10% with 1000 keys, the same as in
+-- check_new_site.pgbench. run with psql variables "sites" and "keys".
+
+insert into sites (public_key, auth_key, created, site_size, user_agent)
+select
+  substr(md5(i::text), 1, 30),
+  'key-' || floor(:keys * random() ^ 3)::int,
+  now() - interval '1 day' - random() * interval '364 days',
+  1000,
+  'populate'
+from generate_series(1, :sites) i;
+
+-- hourly counts are only kept for the last 24 hours, so there are none to add here
+analyze sites;
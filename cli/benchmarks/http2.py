@@ -0,0 +1,136 @@
+"""
+Compare uploading a site over HTTP/1.1 and HTTP/2 against a local HTTPS server.
+
+The server is hypercorn with a certificate from trustme, both only needed here, as is "h2":
+
+    pip install hypercorn trustme h2
+    python benchmarks/http2.py --files 1000
+"""
+
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+from typing import Any
+
+import trustme
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from typer import Option, run
+
+from smokeshow import upload
+
+
+class Server:
+    """
+    Minimal stand in for the worker, every upload waits `latency` seconds to simulate the round trip to the server.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.connections: set[tuple[str, int]] = set()
+
+    async def __call__(self, scope: dict[str, Any], receive: Any, send: Any) -> None:
+        if scope['type'] == 'lifespan':
+            while (await receive())['type'] != 'lifespan.shutdown':
+                await send({'type': 'lifespan.startup.complete'})
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+        self.connections.add(tuple(scope['client']))
+        size = 0
+        while True:
+            message = await receive()
+            size += len(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        path = scope['path']
+        if path == '/create/':
+            # the host is replaced by the CLI with the root url it was given
+            await self.respond(send, 200, {'secret_key': 'testing', 'url': 'https://example.com/site/'})
+        elif path.startswith('/site/.smokeshow/'):
+            # no hash checks or archives, so every file is uploaded individually
+            await self.respond(send, 404, {})
+        else:
+            await asyncio.sleep(self.latency)
+            await self.respond(send, 200, {'size': size, 'total_site_size': 0})
+
+    @staticmethod
+    async def respond(send: Any, status: int, obj: dict[str, Any]) -> None:
+        body = json.dumps(obj).encode()
+        await send(
+            {'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'application/json')]}
+        )
+        await send({'type': 'http.response.body', 'body': body})
+
+
+async def benchmark(files: int, size: int, concurrency: int, latency: float, repeat: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = Path(tmp_dir)
+        site = tmp_path / 'site'
+        site.mkdir()
+        for i in range(files):
+            (site / f'{i}.html').write_bytes(os.urandom(size // 2).hex().encode())
+
+        ca = trustme.CA()
+        cert_path = tmp_path / 'cert.pem'
+        ca.issue_cert('localhost').private_key_and_cert_chain_pem.write_to_path(str(cert_path))
+        ca_path = tmp_path / 'ca.pem'
+        ca.cert_pem.write_to_path(str(ca_path))
+        os.environ['SSL_CERT_FILE'] = str(ca_path)
+
+        with socket.socket() as sock:
+            sock.bind(('localhost', 0))
+            port = sock.getsockname()[1]
+        config = Config()
+        config.bind = [f'localhost:{port}']
+        config.certfile = config.keyfile = str(cert_path)
+        config.accesslog = config.errorlog = None
+
+        server = Server(latency)
+        shutdown = asyncio.Event()
+        server_task = asyncio.create_task(serve(server, config, shutdown_trigger=shutdown.wait))  # type: ignore
+        await asyncio.sleep(0.5)
+
+        print(f'uploading {files} files of {size} bytes, concurrency {concurrency}, latency {latency * 1000:.0f}ms')
+        for http2 in (False, True):
+            times = []
+            for _ in range(repeat):
+                server.connections.clear()
+                start = time.perf_counter()
+                with redirect_stdout(StringIO()):
+                    await upload(
+                        site,
+                        auth_key='testing',
+                        root_url=f'https://localhost:{port}',
+                        concurrency=concurrency,
+                        http2=http2,
+                    )
+                times.append(time.perf_counter() - start)
+            name = 'HTTP/2  ' if http2 else 'HTTP/1.1'
+            print(
+                f'{name} best {min(times):.3f}s, mean {sum(times) / repeat:.3f}s, {len(server.connections)} connections'
+            )
+
+        shutdown.set()
+        await server_task
+
+
+def main(
+    files: int = Option(500, help='Number of files in the site.'),
+    size: int = Option(2000, help='Size of each file in bytes.'),
+    concurrency: int = Option(20, help='Parallel uploads.'),
+    latency: float = Option(0.02, help='Time in seconds the server takes to handle each upload.'),
+    repeat: int = Option(3, help='Number of uploads with each protocol.'),
+) -> None:
+    asyncio.run(benchmark(files, size, concurrency, latency, repeat))
+
+
+if __name__ == '__main__':
+    run(main)
@@ -0,0 +1,261 @@
+"""
+Benchmarks for the upload pipeline, run against a local server with synthetic sites.
+
+Each scenario runs in a fresh process so peak RSS is measured for that scenario alone, with an empty temporary cache
+directory so earlier runs don't affect it. Results can be saved as a JSON baseline and later runs compared against it:
+
+    python benchmarks/run.py --save baseline.json
+    python benchmarks/run.py --compare baseline.json --threshold 0.2
+
+With `--compare`, the exit code is 1 if any scenario is slower, or uses more memory, than the baseline by more than
+the threshold (a fraction). Baselines are only comparable on the same machine.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from aiohttp import web
+from typer import Exit, Option, run
+
+from smokeshow import upload
+from smokeshow.keys import KEY_SEARCH_BATCH, _search_key_batch
+
+KB = 1024
+MB = KB**2
+
+
+def large_site(root: Path) -> None:
+    for i in range(10):
+        (root / f'large_{i}.bin').write_bytes(os.urandom(10 * MB))
+
+
+def tiny_site(root: Path) -> None:
+    for i in range(50):
+        d = root / f'dir_{i}'
+        d.mkdir()
+        for j in range(100):
+            (d / f'{j}.txt').write_text(f'tiny file {i} {j}\n')
+
+
+def coverage_site(root: Path) -> None:
+    """
+    Roughly the shape of a coverage.py HTML report: one page per module plus an index and shared assets.
+    """
+    (root / 'style_cb_8e611ae1.css').write_text('.pc_cov { font-weight: bold }\n' * 1000)
+    (root / 'coverage_html_cb_6fb7b396.js').write_text('function x() { return 1 }\n' * 1000)
+    (root / 'favicon_32_cb_58284776.png').write_bytes(os.urandom(2 * KB))
+    (root / '.gitignore').write_text('*\n')
+    rows = []
+    for i in range(400):
+        name = f'z_{i:04x}_module_{i}_py.html'
+        lines = ''.join(
+            f'<p class="run"><span class="n"><a id="t{n}" href="#t{n}">{n}</a></span>'
+            f'<span class="t">    value_{i}_{n} = compute({n})</span></p>\n'
+            for n in range(50 + (i * 37) % 800)
+        )
+        (root / name).write_text(f'<html><body><h1>module_{i}.py</h1>\n{lines}</body></html>\n')
+        rows.append(f'<tr><td><a href="{name}">module_{i}.py</a></td><td>90%</td></tr>')
+    rows_html = '\n'.join(rows)
+    (root / 'index.html').write_text(
+        f'<html><body><span class="pc_cov">91.23%</span><table>{rows_html}</table></body></html>\n'
+    )
+    (root / 'status.json').write_text(json.dumps({'files': {f'module_{i}': {'index': i} for i in range(400)}}))
+
+
+SITES: dict[str, Callable[[Path], None]] = {'large': large_site, 'tiny': tiny_site, 'coverage': coverage_site}
+SCENARIOS: dict[str, tuple[str, dict[str, Any]]] = {
+    'large': ('large', {}),
+    'tiny': ('tiny', {}),
+    'tiny-archive': ('tiny', {'archive': True}),
+    'coverage': ('coverage', {}),
+    'coverage-compress': ('coverage', {'compress': True}),
+    # minifying in a process per core, as the CLI does
+    'coverage-optimise': ('coverage', {'optimise': True, 'minify_processes': os.cpu_count() or 1}),
+    'coverage-optimise-warm': ('coverage', {'optimise': True, 'minify_processes': os.cpu_count() or 1}),
+}
+# scenarios where the site is uploaded once before the timed upload, so caches are warm, e.g. the minify cache,
+# other scenarios start with an empty cache
+WARM_SCENARIOS = {'coverage-optimise-warm'}
+# for each metric, whether a higher value is better
+METRICS = {
+    'wall_time': False,
+    'files_per_sec': True,
+    'mb_per_sec': True,
+    'peak_rss_mb': False,
+    'attempts_per_sec': True,
+}
+# regressions in these fail a comparison, the rest are derived from them
+CHECKED_METRICS = {'wall_time', 'peak_rss_mb', 'attempts_per_sec'}
+
+
+class Server:
+    """
+    Local stand in for the worker, content is counted and discarded, archives are read to the end.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.port = 0
+        self._loop = asyncio.new_event_loop()
+
+    def start(self) -> None:
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+
+    async def _start(self) -> None:
+        app = web.Application(client_max_size=1024**3)
+        app.add_routes(
+            [
+                web.post('/create/', self.create),
+                web.post('/site/.smokeshow/check-hashes', self.check_hashes),
+                web.post('/site/.smokeshow/archive', self.archive),
+                web.post('/site/{path:.*}', self.upload),
+            ]
+        )
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, 'localhost', 0)
+        await site.start()
+        self.port = runner.addresses[0][1]
+
+    async def create(self, request: web.Request) -> web.Response:
+        return web.json_response({'secret_key': 'testing', 'url': f'http://localhost:{self.port}/site/'})
+
+    async def check_hashes(self, request: web.Request) -> web.Response:
+        return web.json_response({'missing': (await request.json())['hashes']})
+
+    async def archive(self, request: web.Request) -> web.Response:
+        size = await self._read(request)
+        await asyncio.sleep(self.latency)
+        return web.json_response({'files': [], 'missing': [], 'size': size, 'total_site_size': 0})
+
+    async def upload(self, request: web.Request) -> web.Response:
+        size = await self._read(request)
+        await asyncio.sleep(self.latency)
+        return web.json_response({'size': size, 'total_site_size': 0})
+
+    @staticmethod
+    async def _read(request: web.Request) -> int:
+        size = 0
+        async for chunk in request.content.iter_any():
+            size += len(chunk)
+        return size
+
+
+def run_upload(root: Path, port: int, kwargs: dict[str, Any], warm: bool = False) -> dict[str, float]:
+    """
+    Upload a site, run in a fresh process, with a cache directory of its own, so runs don't affect each other and
+    nothing is left in the real cache, e.g. upload journals. With `warm`, the site is uploaded once before the timed
+    upload to fill the cache.
+    """
+    files = [p for p in root.glob('**/*') if p.is_file()]
+    size = sum(p.stat().st_size for p in files)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        os.environ['XDG_CACHE_HOME'] = cache_dir
+        with redirect_stdout(StringIO()):
+            if warm:
+                asyncio.run(upload(root, auth_key='testing', root_url=f'http://localhost:{port}', **kwargs))
+            start = time.perf_counter()
+            asyncio.run(upload(root, auth_key='testing', root_url=f'http://localhost:{port}', **kwargs))
+            wall_time = time.perf_counter() - start
+    return {
+        'wall_time': wall_time,
+        'files_per_sec': len(files) / wall_time,
+        'mb_per_sec': size / MB / wall_time,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_generate_key(batches: int) -> dict[str, float]:
+    # an impossible threshold, so every batch runs to the end
+    threshold = bytes(32)
+    start = time.perf_counter()
+    for _ in range(batches):
+        _search_key_batch(threshold)
+    wall_time = time.perf_counter() - start
+    return {
+        'wall_time': wall_time,
+        'attempts_per_sec': batches * KEY_SEARCH_BATCH / wall_time,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return rss / (MB if sys.platform == 'darwin' else KB)
+
+
+def in_process(func: Callable[..., dict[str, float]], *args: Any) -> dict[str, float]:
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+
+def compare(results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]], threshold: float) -> bool:
+    ok = True
+    for scenario, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(scenario, {}).get(metric)
+            if metric not in CHECKED_METRICS or not base:
+                continue
+            change = (value - base) / base
+            regression = -change if METRICS[metric] else change
+            if regression > threshold:
+                print(f'REGRESSION {scenario} {metric}: {base:.2f} -> {value:.2f} ({change:+.0%})')
+                ok = False
+    return ok
+
+
+def main(
+    scenarios: Optional[list[str]] = Option(
+        None, '--scenario', help=f'Scenarios to run, from: {", ".join(SCENARIOS)}.'
+    ),
+    repeat: int = Option(3, help='Runs of each scenario, the best run is kept.'),
+    latency: float = Option(0, help='Time in seconds the server takes to handle each request.'),
+    key_batches: int = Option(20, help=f'Batches of {KEY_SEARCH_BATCH:,} seeds to try when generating a key.'),
+    save: Optional[Path] = Option(None, help='Save results as a JSON baseline.'),
+    compare_to: Optional[Path] = Option(None, '--compare', help='Compare results to a JSON baseline.'),
+    threshold: float = Option(0.2, help='Fraction a metric can regress by before the comparison fails.'),
+) -> None:
+    server = Server(latency)
+    server.start()
+    results: dict[str, dict[str, float]] = {}
+    selected = scenarios or [*SCENARIOS, 'generate-key']
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sites: dict[str, Path] = {}
+        for scenario in selected:
+            if scenario == 'generate-key':
+                runs = [in_process(run_generate_key, key_batches) for _ in range(repeat)]
+            else:
+                site_name, kwargs = SCENARIOS[scenario]
+                if site_name not in sites:
+                    sites[site_name] = Path(tmp_dir) / site_name
+                    sites[site_name].mkdir()
+                    SITES[site_name](sites[site_name])
+                warm = scenario in WARM_SCENARIOS
+                runs = [in_process(run_upload, sites[site_name], server.port, kwargs, warm) for _ in range(repeat)]
+            results[scenario] = best = min(runs, key=lambda r: r['wall_time'])
+            print(f'{scenario:>22}: ' + ', '.join(f'{k}={v:,.2f}' for k, v in best.items()))
+
+    if save:
+        save.write_text(json.dumps(results, indent=2) + '\n')
+        print(f'results saved to {save}')
+    if compare_to and not compare(results, json.loads(compare_to.read_text()), threshold):
+        raise Exit(1)
+
+
+if __name__ == '__main__':
+    run(main)
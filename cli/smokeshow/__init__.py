@@ -1,4 +1,17 @@
-from .main import upload
+from typing import TYPE_CHECKING, Any
+
 from .version import __version__
 
-__all__ = 'upload', '__version__'
+if TYPE_CHECKING:
+    from .main import Span, Uploader, upload
+
+__all__ = 'upload', 'Uploader', 'Span', '__version__'
+
+
+def __getattr__(name: str) -> Any:
+    # imported on first use, so the CLI only imports httpx and the upload code when it's uploading
+    if name in {'upload', 'Uploader', 'Span'}:
+        from . import main
+
+        return getattr(main, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,271 @@
+import os
+import sys
+from datetime import datetime
+from enum import Enum
+from pathlib import Path
+from typing import Any, Optional, Union
+
+from typer import Argument, Exit, Option, Typer
+
+from .constants import DEFAULT_CONCURRENCY, DEFAULT_KEEPALIVE_EXPIRY, DEFAULT_RETRIES, DEFAULT_RETRY_BUDGET, ROOT_URL
+from .keys import clear_cached_key, generate_key, key_cache_path, key_is_valid
+from .version import __version__
+
+__all__ = ('cli',)
+
+cli = Typer(
+    name='smokeshow', help=f'Smokeshow CLI v{__version__}, see https://smokeshow.helpmanual.io for more information.'
+)
+
+
+def version_callback(value: bool) -> None:
+    if value:
+        print(f'Smokeshow v{__version__}')
+        raise Exit()
+
+
+@cli.callback()
+def _cli_callback(
+    _version: bool = Option(None, '--version', callback=version_callback, is_eager=True),
+) -> None:
+    pass
+
+
+@cli.command(name='generate-key', help='Generate a new upload key')
+def cli_generate_key(
+    processes: Optional[int] = Option(None, envvar='SMOKESHOW_KEY_PROCESSES', min=1, show_default='all cores'),
+) -> None:
+    generate_key(processes or os.cpu_count() or 1)
+
+
+key_cli = Typer(name='key', help='Inspect or clear the cached upload key, used when no auth key is provided.')
+cli.add_typer(key_cli)
+
+
+@key_cli.command(name='show', help='Show the cached upload key')
+def cli_key_show() -> None:
+    path = key_cache_path()
+    try:
+        key = path.read_text().strip()
+    except FileNotFoundError:
+        print(f'No key cached at {path}')
+        return
+    created = datetime.fromtimestamp(path.stat().st_mtime).isoformat(' ', 'seconds')
+    valid = 'valid' if key_is_valid(key) else 'invalid, it will be replaced next time a key is needed'
+    print(f"Key cached at {path}, created {created}, {valid}:\n\n    SMOKESHOW_AUTH_KEY='{key}'\n")
+
+
+@key_cli.command(name='clear', help='Delete the cached upload key')
+def cli_key_clear() -> None:
+    path = key_cache_path()
+    if clear_cached_key():
+        print(f'Cached key at {path} deleted')
+    else:
+        print(f'No key cached at {path}')
+
+
+class ReportFormat(str, Enum):
+    json = 'json'
+
+
+@cli.command(
+    name='upload', help='Upload a directory or file to create a new site, a site is created for each path given'
+)
+def cli_upload(
+    paths: list[Path] = Argument(..., exists=True, dir_okay=True, file_okay=True, readable=True, resolve_path=True),
+    auth_key: Optional[str] = Option(None, envvar='SMOKESHOW_AUTH_KEY'),
+    root_url: str = Option(ROOT_URL, envvar='SMOKESHOW_ROOT_URL'),
+    github_status_description: Optional[str] = Option(None, envvar='SMOKESHOW_GITHUB_STATUS_DESCRIPTION'),
+    github_coverage_threshold: Optional[float] = Option(None, envvar='SMOKESHOW_GITHUB_COVERAGE_THRESHOLD'),
+    concurrency: int = Option(DEFAULT_CONCURRENCY, envvar='SMOKESHOW_CONCURRENCY', min=1),
+    http2: bool = Option(False, envvar='SMOKESHOW_HTTP2', help='Multiplex uploads over HTTP/2 connections.'),
+    max_connections: Optional[int] = Option(
+        None, envvar='SMOKESHOW_MAX_CONNECTIONS', min=1, show_default='concurrency'
+    ),
+    max_keepalive: Optional[int] = Option(
+        None, envvar='SMOKESHOW_MAX_KEEPALIVE', min=0, show_default='max connections'
+    ),
+    keepalive_expiry: float = Option(DEFAULT_KEEPALIVE_EXPIRY, envvar='SMOKESHOW_KEEPALIVE_EXPIRY', min=0),
+    minify_processes: Optional[int] = Option(
+        None, envvar='SMOKESHOW_MINIFY_PROCESSES', min=1, show_default='all cores', help='Processes for "--optimise".'
+    ),
+    retries: int = Option(DEFAULT_RETRIES, envvar='SMOKESHOW_RETRIES', min=0, help='Retries of each request.'),
+    retry_budget: int = Option(
+        DEFAULT_RETRY_BUDGET, envvar='SMOKESHOW_RETRY_BUDGET', min=0, help='Total retries for the whole site.'
+    ),
+    archive: bool = Option(False, envvar='SMOKESHOW_ARCHIVE', help='Upload files in a few tar archives.'),
+    archive_gzip: bool = Option(True, envvar='SMOKESHOW_ARCHIVE_GZIP', help='Compress archives with gzip.'),
+    compress: bool = Option(False, envvar='SMOKESHOW_COMPRESS', help='Store text files gzip compressed.'),
+    optimise: bool = Option(
+        False, envvar='SMOKESHOW_OPTIMISE', help='Minify HTML, CSS, JavaScript and JSON files before uploading.'
+    ),
+    drop_source_maps: bool = Option(False, envvar='SMOKESHOW_DROP_SOURCE_MAPS', help='Skip "*.map" source map files.'),
+    include: Optional[list[str]] = Option(
+        None, envvar='SMOKESHOW_INCLUDE', help='Only upload files matching these gitignore style patterns.'
+    ),
+    exclude: Optional[list[str]] = Option(
+        None, envvar='SMOKESHOW_EXCLUDE', help='Skip files matching these gitignore style patterns.'
+    ),
+    follow_symlinks: bool = Option(
+        False, envvar='SMOKESHOW_FOLLOW_SYMLINKS', help='Upload the content of symlinked directories.'
+    ),
+    report: Optional[ReportFormat] = Option(
+        None, envvar='SMOKESHOW_REPORT', help='Write a report of the timing of each request.'
+    ),
+    report_file: Path = Option(Path('smokeshow-report.json'), envvar='SMOKESHOW_REPORT_FILE'),
+    resume: bool = Option(
+        False, envvar='SMOKESHOW_RESUME', help="Continue the last upload of this path, if it's still allowed."
+    ),
+    journal: Optional[Path] = Option(
+        None, envvar='SMOKESHOW_JOURNAL', help='Record of uploaded files used to resume.', show_default='in cache'
+    ),
+    detach: bool = Option(
+        False,
+        envvar='SMOKESHOW_DETACH',
+        help='Print the URL once the site is created, and upload files in the background, see "smokeshow wait".',
+    ),
+) -> None:
+    if len(paths) > 1 and journal is not None:
+        print('"--journal" can only be used when uploading one path', file=sys.stderr)
+        raise Exit(1)
+    if len(paths) > 1 and github_status_description is not None:
+        print('A GitHub status can only be set when uploading one path', file=sys.stderr)
+        raise Exit(1)
+    if len(paths) > 1 and detach and report:
+        print('"--report" can only be used with "--detach" when uploading one path', file=sys.stderr)
+        raise Exit(1)
+
+    uploader_options: dict[str, Any] = dict(
+        concurrency=concurrency,
+        http2=http2,
+        max_connections=max_connections,
+        max_keepalive=max_keepalive,
+        keepalive_expiry=keepalive_expiry,
+        minify_processes=minify_processes or os.cpu_count() or 1,
+    )
+    upload_options: dict[str, Any] = dict(
+        github_status_description=github_status_description,
+        github_coverage_threshold=github_coverage_threshold,
+        retries=retries,
+        retry_budget=retry_budget,
+        archive=archive,
+        archive_gzip=archive_gzip,
+        compress=compress,
+        optimise=optimise,
+        drop_source_maps=drop_source_maps,
+        include=include,
+        exclude=exclude,
+        follow_symlinks=follow_symlinks,
+    )
+    if detach:
+        _start_detached(
+            paths,
+            auth_key=auth_key,
+            root_url=root_url,
+            journal=journal,
+            resume=resume,
+            report_file=report_file if report else None,
+            **uploader_options,
+            **upload_options,
+        )
+        return
+
+    # imported here, so other commands don't wait for httpx and the rest of the upload code to import
+    import asyncio
+
+    from .main import Report, Uploader
+
+    upload_report = Report() if report else None
+
+    async def upload_all() -> list[Union[str, BaseException]]:
+        uploader = Uploader(auth_key=auth_key, root_url=root_url, on_span=upload_report, **uploader_options)
+        async with uploader:
+            uploads = [uploader.upload(path, resume=resume, journal=journal, **upload_options) for path in paths]
+            # one site failing doesn't stop the others
+            return await asyncio.gather(*uploads, return_exceptions=True)
+
+    try:
+        results = asyncio.run(upload_all())
+        _print_results(paths, results)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        raise Exit(1)
+    finally:
+        # written even if the upload failed, that's when it's most useful
+        if upload_report is not None:
+            report_file.write_text(upload_report.json())
+            print(f'report written to {report_file}')
+
+
+def _start_detached(paths: list[Path], **kwargs: Any) -> None:
+    from .detach import start_upload
+
+    job_ids: list[str] = []
+    for path in paths:
+        try:
+            job_id, url = start_upload(path, **kwargs)
+        except ValueError as e:
+            print(f'{path}: {e}', file=sys.stderr)
+            raise Exit(1)
+        job_ids.append(job_id)
+        print(f'{path}: {url}' if len(paths) > 1 else url)
+    print(f'\nuploading in the background, run "smokeshow wait {" ".join(job_ids)}" to wait for it to finish')
+
+
+@cli.command(
+    name='wait',
+    help='Wait for uploads started with "upload --detach" to finish, by default all started from this directory',
+)
+def cli_wait(
+    job_ids: Optional[list[str]] = Argument(None, show_default='all started from this directory'),
+    timeout: Optional[float] = Option(None, envvar='SMOKESHOW_WAIT_TIMEOUT', min=0, show_default='no timeout'),
+) -> None:
+    from .detach import wait_for_uploads
+
+    try:
+        jobs = wait_for_uploads(job_ids or (), timeout)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        raise Exit(1)
+    if not jobs:
+        print('No detached uploads found')
+        return
+
+    errors = 0
+    for job in jobs:
+        print(f'upload {job["id"]} of {job["path"]}:')
+        print(job['log'].rstrip('\n'))
+        if job['status'] == 'success':
+            print(f'{job["path"]}: {job["url"]}\n')
+        elif job['status'] == 'failed':
+            print(f'{job["path"]}: {job["error"]}\n', file=sys.stderr)
+            errors += 1
+        else:
+            print(f'{job["path"]}: still uploading after {timeout}s\n', file=sys.stderr)
+            errors += 1
+    if errors:
+        raise Exit(1)
+
+
+def _print_results(paths: list[Path], results: list[Union[str, BaseException]]) -> None:
+    """
+    With several paths, print each site's URL or error, raise the error if there's one path or any unexpected
+    errors.
+    """
+    if len(paths) == 1:
+        if isinstance(results[0], BaseException):
+            raise results[0]
+        return
+
+    print('\nsites:')
+    errors = 0
+    for path, result in zip(paths, results):
+        if isinstance(result, ValueError):
+            print(f'{path}: {result}', file=sys.stderr)
+            errors += 1
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            print(f'{path}: {result}')
+    if errors:
+        raise ValueError(f'{errors} of {len(paths)} uploads failed')
@@ -0,0 +1,32 @@
+from .version import __version__
+
+USER_AGENT = f'smokeshow-cli-v{__version__}'
+ROOT_URL = 'https://smokeshow.helpmanual.io'
+DEFAULT_TIMEOUT = 30  # seconds
+# how long after a site's created files can be added to it, the same as UPLOAD_TTL in the worker
+UPLOAD_TTL = 3600  # seconds
+# uploads are only resumed if there's at least this long left to upload
+RESUME_MIN_TIME = 60  # seconds
+UPLOAD_FILE_TIMEOUT = 300  # seconds
+REQUEST_RETRIES = 3
+DEFAULT_CONCURRENCY = 20
+DEFAULT_KEEPALIVE_EXPIRY = 5  # seconds
+# retries of each upload request, and of all requests for a site
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_BUDGET = 100
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_BASE_DELAY = 0.5  # seconds
+MAX_RETRY_DELAY = 60  # seconds
+CHECK_HASHES_PATH = '.smokeshow/check-hashes'
+CHECK_HASHES_BATCH = 500
+ARCHIVE_PATH = '.smokeshow/archive'
+# each file in an archive needs a few KV operations on the server, which limits how many files it can handle
+ARCHIVE_MAX_FILES = 300
+ARCHIVE_MAX_SIZE = 20 * 1024**2
+# files smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 1024
+COMPRESS_LEVEL = 9
+# minified files are deleted from the cache if they haven't been used for this long
+OPTIMISE_CACHE_MAX_AGE = 30 * 24 * 3600  # seconds
+# junk which shouldn't end up in a site
+DEFAULT_EXCLUDE = '.git/', '.gitignore', '.DS_Store', '__pycache__/'
@@ -0,0 +1,209 @@
+"""
+Uploads which carry on in a background process, so the command starting them can return as soon as the site is
+created, and other steps in a CI pipeline can run while files are uploaded.
+
+Each detached upload is a "job" in the cache directory: `{id}.json` describes the upload, the background process
+writes its output to `{id}.log` and its outcome to `{id}.result.json`. `wait_for_uploads` waits for jobs to finish,
+then deletes them. The cache directory can be shared by other shells or CI steps, so without job IDs only jobs
+started from the current working directory are waited for.
+
+Run as `python -m smokeshow.detach {job file}` to upload the files of a job, this is how the background process runs.
+"""
+
+import asyncio
+import json
+import os
+import secrets
+import subprocess
+import sys
+import time
+import traceback
+from collections.abc import Sequence
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Optional
+
+from .constants import ROOT_URL
+from .keys import cache_dir
+from .main import Report, Uploader, journal_path, upload
+
+__all__ = 'start_upload', 'wait_for_uploads'
+
+# how often to check if jobs have finished
+POLL_INTERVAL = 0.2  # seconds
+# processes started by this process, kept so they're reaped when they exit, rather than left as zombies which
+# look like they're still running
+_processes: dict[int, 'subprocess.Popen[bytes]'] = {}
+
+
+def jobs_dir() -> Path:
+    return cache_dir() / 'jobs'
+
+
+def start_upload(
+    root_path: Path,
+    *,
+    auth_key: Optional[str] = None,
+    root_url: str = ROOT_URL,
+    journal: Optional[Path] = None,
+    resume: bool = False,
+    report_file: Optional[Path] = None,
+    **options: Any,
+) -> tuple[str, str]:
+    """
+    Create a site for `root_path`, then upload its files in a background process, returns the job's ID and the
+    site's URL as soon as the site is created.
+
+    `options` are passed to `upload()` by the background process, so they must be JSON serialisable. With
+    `report_file`, the background process writes a report of the upload to it when it finishes.
+    """
+    journal = journal or journal_path(root_path, root_url)
+
+    async def create_site() -> str:
+        async with Uploader(auth_key=auth_key, root_url=root_url) as uploader:
+            return await uploader.create_site(root_path, journal=journal, resume=resume)
+
+    url = asyncio.run(create_site())
+
+    directory = jobs_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    job_id = f'{datetime.now():%Y%m%d-%H%M%S}-{secrets.token_hex(3)}'
+    job_file = directory / f'{job_id}.json'
+    job: dict[str, Any] = {
+        'id': job_id,
+        'path': str(root_path),
+        'cwd': os.getcwd(),
+        'url': url,
+        'root_url': root_url,
+        'journal': str(journal),
+        'report_file': report_file and str(report_file.resolve()),
+        'options': options,
+    }
+    job_file.write_text(json.dumps(job))
+    with (directory / f'{job_id}.log').open('wb') as log:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'smokeshow.detach', str(job_file)],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            # so the upload isn't stopped by signals sent to this process's group, e.g. when a shell step ends
+            start_new_session=True,
+        )
+    _processes[process.pid] = process
+    job['pid'] = process.pid
+    job_file.write_text(json.dumps(job))
+    return job_id, url
+
+
+def wait_for_uploads(job_ids: Sequence[str] = (), timeout: Optional[float] = None) -> list[dict[str, Any]]:
+    """
+    Wait for detached uploads to finish, by default all of those started from the current working directory. Returns
+    each job with its output as "log" and its "status": "success" with the site's "url", "failed" with an "error",
+    or "running" if `timeout` was reached.
+
+    Jobs which have finished are deleted.
+    """
+    directory = jobs_dir()
+    if job_ids:
+        for job_id in job_ids:
+            if not (directory / f'{job_id}.json').exists():
+                raise ValueError(f'No detached upload found with ID "{job_id}"')
+        job_files = [directory / f'{job_id}.json' for job_id in job_ids]
+    else:
+        cwd = os.getcwd()
+        job_files = [
+            p
+            for p in sorted(directory.glob('*.json'))
+            if not p.name.endswith('.result.json') and json.loads(p.read_text()).get('cwd') == cwd
+        ]
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    jobs: list[dict[str, Any]] = []
+    for job_file in job_files:
+        job = json.loads(job_file.read_text())
+        while (result := _job_result(job)) is None:
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            time.sleep(POLL_INTERVAL)
+        job.update(result or {'status': 'running'})
+        log_file = directory / f'{job["id"]}.log'
+        job['log'] = log_file.read_text(errors='replace') if log_file.exists() else ''
+        if result is not None:
+            process = _processes.pop(job.get('pid', 0), None)
+            if process is not None:
+                # the result is written last, so the process has finished or is about to
+                process.wait()
+            for path in job_file, log_file, directory / f'{job["id"]}.result.json':
+                path.unlink(missing_ok=True)
+        jobs.append(job)
+    return jobs
+
+
+def _job_result(job: dict[str, Any]) -> Optional[dict[str, Any]]:
+    result_file = jobs_dir() / f'{job["id"]}.result.json'
+    try:
+        return json.loads(result_file.read_text())
+    except FileNotFoundError:
+        pass
+    if job.get('pid') and not _is_running(job['pid']) and not result_file.exists():
+        return {'status': 'failed', 'error': 'The upload process exited without recording a result'}
+    return None
+
+
+def _is_running(pid: int) -> bool:
+    process = _processes.get(pid)
+    if process is not None:
+        return process.poll() is None
+    if os.name != 'posix':
+        # os.kill would end the process on windows, assume it's running
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running as another user
+        return True
+    return True
+
+
+def _run_job(job_file: Path) -> None:
+    """
+    Upload the files of a job, run by the background process.
+    """
+    job = json.loads(job_file.read_text())
+    report = Report() if job['report_file'] else None
+    try:
+        url = asyncio.run(
+            upload(
+                Path(job['path']),
+                root_url=job['root_url'],
+                journal=Path(job['journal']),
+                resume=True,
+                # the URL printed when the job started is for the site in the journal, never upload anywhere else
+                new_site=False,
+                on_span=report,
+                **job['options'],
+            )
+        )
+    except Exception as e:
+        if not isinstance(e, ValueError):
+            traceback.print_exc()
+        result = {'status': 'failed', 'error': str(e) or repr(e)}
+    else:
+        result = {'status': 'success', 'url': url}
+    finally:
+        if report is not None:
+            Path(job['report_file']).write_text(report.json())
+            print(f'report written to {job["report_file"]}')
+    sys.stdout.flush()
+
+    # written then renamed, so a partial result is never read
+    result_file = job_file.with_name(f'{job["id"]}.result.json')
+    tmp_file = result_file.with_name(f'.{result_file.name}')
+    tmp_file.write_text(json.dumps(result))
+    os.replace(tmp_file, result_file)
+
+
+if __name__ == '__main__':
+    _run_job(Path(sys.argv[1]))
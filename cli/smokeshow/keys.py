@@ -0,0 +1,239 @@
+import base64
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from collections.abc import Generator
+from contextlib import closing, contextmanager
+from pathlib import Path
+from typing import Optional
+
+if sys.platform != 'win32':
+    import fcntl
+
+__all__ = (
+    'generate_key',
+    'key_is_valid',
+    'get_cached_key',
+    'rotate_cached_key',
+    'clear_cached_key',
+    'cache_dir',
+    'key_cache_path',
+)
+
+KEY_HASH_THRESHOLD_POW = 234
+KEY_HASH_THRESHOLD = 2**KEY_HASH_THRESHOLD_POW
+
+
+def generate_key(processes: int = 1) -> str:
+    """
+    Search for a key with a valid hash using `processes` processes, the `generate-key` command uses one per core.
+
+    More than one process uses multiprocessing, which runs the `__main__` module again in each worker unless it's
+    guarded by `if __name__ == '__main__':`, so it's only used when asked for.
+    """
+    print(
+        'Searching for a key with valid hash '
+        f'(the numeric representation of its sha-256 hash needs to be less than 2^{KEY_HASH_THRESHOLD_POW}). '
+        f'Hold tight, this might take a minute, using {processes} process{"es" if processes > 1 else ""}...'
+    )
+    threshold = KEY_HASH_THRESHOLD.to_bytes(32, 'big')
+    expected_attempts = 2**256 // KEY_HASH_THRESHOLD
+    tty = sys.stdout.isatty()
+    attempts = 0
+    start = last_report = time.monotonic()
+    with closing(_search_key_batches(threshold, processes)) as batches:
+        for seed, batch_attempts in batches:
+            attempts += batch_attempts
+            if seed is not None:
+                key = base64.b64encode(seed).decode().rstrip('=')
+                print(f"\nSuccess! Key found after {attempts:,} attempts:\n\n    SMOKESHOW_AUTH_KEY='{key}'\n")
+                return key
+
+            now = time.monotonic()
+            if now - last_report >= 1:
+                last_report = now
+                rate = attempts / (now - start)
+                eta = max(expected_attempts - attempts, 0) / rate
+                progress = f'{attempts:,} attempts, {rate:,.0f} attempts/s, ETA ~{eta:0.0f}s'
+                if tty:
+                    print(f'\r{progress}  ', end='', flush=True)
+                else:
+                    print(progress, flush=True)
+    raise RuntimeError('unreachable')  # pragma: no cover
+
+
+KEY_SEED_PREFIX_LENGTH = 42  # plus the 8 byte counter gives a 50 byte seed
+KEY_SEARCH_BATCH = 100_000
+
+
+def _search_key_batches(threshold: bytes, processes: int) -> Generator[tuple[Optional[bytes], int], None, None]:
+    """
+    Yield `(seed, attempts)` for each completed batch, `seed` is `None` if no valid key was found in that batch.
+
+    With multiple processes, a batch is always running on every worker, closing the generator cancels
+    batches which haven't started and waits for those running to finish.
+    """
+    if processes == 1:
+        while True:
+            yield _search_key_batch(threshold)
+
+    # only needed with multiple processes, and slow to import
+    import multiprocessing
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    # spawn avoids forking a process which may have threads running, e.g. from the event loop
+    executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        pending = {executor.submit(_search_key_batch, threshold) for _ in range(processes)}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                pending.add(executor.submit(_search_key_batch, threshold))
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def _search_key_batch(threshold: bytes) -> tuple[Optional[bytes], int]:
+    """
+    Try `KEY_SEARCH_BATCH` seeds made of a random prefix plus a counter, that's much cheaper than calling
+    `os.urandom` for every attempt.
+
+    `threshold` is big-endian, so comparing digests as bytes is the same as comparing them as integers.
+    """
+    prefix = os.urandom(KEY_SEED_PREFIX_LENGTH)
+    sha256 = hashlib.sha256
+    for counter in range(KEY_SEARCH_BATCH):
+        seed = prefix + counter.to_bytes(8, 'big')
+        if sha256(seed).digest() < threshold:
+            return seed, counter + 1
+    return None, KEY_SEARCH_BATCH
+
+
+def key_is_valid(key: str) -> bool:
+    """
+    Check a key would be accepted for creating sites, this is the same check made by `check_create_auth` in the worker.
+    """
+    try:
+        seed = base64.b64decode(key + '=' * (-len(key) % 4), validate=True)
+    except ValueError:
+        return False
+    return int.from_bytes(hashlib.sha256(seed).digest(), 'big') < KEY_HASH_THRESHOLD
+
+
+def cache_dir() -> Path:
+    """
+    Directory for smokeshow's cache, following the XDG base directory spec.
+    """
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME')
+    return (Path(xdg_cache_home) if xdg_cache_home else Path.home() / '.cache') / 'smokeshow'
+
+
+def key_cache_path() -> Path:
+    return cache_dir() / 'auth_key'
+
+
+def get_cached_key() -> str:
+    """
+    Get an upload key from the cache, or generate one and cache it if there's no valid key cached.
+
+    The cache is locked while generating so parallel jobs sharing a cache wait for one key instead of all
+    generating their own. If the cache can't be used, e.g. a read-only home directory, a warning is printed and the
+    key is generated without caching it.
+    """
+    path = key_cache_path()
+    key: Optional[str] = None
+    try:
+        with _key_cache_lock(path):
+            key = _load_cached_key(path)
+            if key is None:
+                print(f'No auth key provided, generating one now and caching it at {path}...')
+                key = generate_key()
+                _write_cached_key(path, key)
+            else:
+                print(f'No auth key provided, using the key cached at {path}')
+    except OSError as e:
+        print(f'Unable to use the key cache at {path}, the key will not be cached: {e}')
+        if key is None:
+            print('No auth key provided, generating one now...')
+            key = generate_key()
+    return key
+
+
+def rotate_cached_key(old_key: str) -> str:
+    """
+    Replace `old_key` in the cache with a new key, unless another process has already replaced it.
+
+    As with `get_cached_key`, if the cache can't be used the new key isn't cached.
+    """
+    path = key_cache_path()
+    key: Optional[str] = None
+    try:
+        with _key_cache_lock(path):
+            key = _load_cached_key(path)
+            if key is None or key == old_key:
+                key = generate_key()
+                _write_cached_key(path, key)
+    except OSError as e:
+        print(f'Unable to use the key cache at {path}, the key will not be cached: {e}')
+        if key is None or key == old_key:
+            key = generate_key()
+    return key
+
+
+def clear_cached_key() -> bool:
+    """
+    Delete the cached key, returns `False` if there was no key cached.
+    """
+    path = key_cache_path()
+    with _key_cache_lock(path):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            return False
+        else:
+            return True
+
+
+def _load_cached_key(path: Path) -> Optional[str]:
+    try:
+        key = path.read_text().strip()
+    except FileNotFoundError:
+        return None
+    if key_is_valid(key):
+        return key
+    else:
+        print(f'Ignoring invalid key cached at {path}')
+        return None
+
+
+def _write_cached_key(path: Path, key: str) -> None:
+    """
+    Write the key atomically, so no process can ever read a partial key. `mkstemp` creates the file so only the
+    current user can read it.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(key)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def _key_cache_lock(path: Path) -> Generator[None, None, None]:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.with_name(f'{path.name}.lock').open('a') as f:
+        if sys.platform == 'win32':
+            # no advisory locking on windows, writes are still atomic
+            yield
+        else:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
@@ -1,87 +1,73 @@
 import asyncio
 import base64
 import hashlib
+import json
+import math
 import os
+import random
 import re
-import sys
+import tarfile
+import tempfile
+import time
+import zlib
+from collections.abc import AsyncGenerator, AsyncIterable, AsyncIterator, Awaitable, Generator, Iterable, Sequence
+from concurrent.futures import Executor
+from contextlib import asynccontextmanager, closing, contextmanager, suppress
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from importlib.util import find_spec
 from mimetypes import guess_type
 from pathlib import Path
-from typing import Optional, Union, cast
+from typing import Any, Callable, NamedTuple, Optional, TextIO, TypeVar, Union, cast
+from xml.etree import ElementTree
 
-from httpx import AsyncClient, AsyncHTTPTransport, HTTPError
-from typer import Argument, Exit, Option, Typer
+from httpx import AsyncClient, AsyncHTTPTransport, HTTPError, Limits, Response
 
-from .version import __version__
-
-__all__ = 'cli', 'upload'
-
-USER_AGENT = f'smokeshow-cli-v{__version__}'
-KEY_HASH_THRESHOLD_POW = 234
-KEY_HASH_THRESHOLD = 2**KEY_HASH_THRESHOLD_POW
-ROOT_URL = 'https://smokeshow.helpmanual.io'
-DEFAULT_TIMEOUT = 30  # seconds
-UPLOAD_FILE_TIMEOUT = 300  # seconds
-REQUEST_RETRIES = 3
-
-cli = Typer(
-    name='smokeshow', help=f'Smokeshow CLI v{__version__}, see https://smokeshow.helpmanual.io for more information.'
+from .constants import (
+    ARCHIVE_MAX_FILES,
+    ARCHIVE_MAX_SIZE,
+    ARCHIVE_PATH,
+    CHECK_HASHES_BATCH,
+    CHECK_HASHES_PATH,
+    COMPRESS_LEVEL,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_EXCLUDE,
+    DEFAULT_KEEPALIVE_EXPIRY,
+    DEFAULT_RETRIES,
+    DEFAULT_RETRY_BUDGET,
+    DEFAULT_TIMEOUT,
+    MAX_RETRY_DELAY,
+    MIN_COMPRESS_SIZE,
+    OPTIMISE_CACHE_MAX_AGE,
+    REQUEST_RETRIES,
+    RESUME_MIN_TIME,
+    RETRY_BASE_DELAY,
+    RETRY_STATUSES,
+    ROOT_URL,
+    UPLOAD_FILE_TIMEOUT,
+    UPLOAD_TTL,
+    USER_AGENT,
 )
+from .keys import cache_dir, get_cached_key, rotate_cached_key
+from .minify import MINIFY_VERSION, minifier, minify_file
 
+__all__ = 'upload', 'Uploader', 'Span'
 
-def version_callback(value: bool) -> None:
-    if value:
-        print(f'Smokeshow v{__version__}')
-        raise Exit()
+T = TypeVar('T')
 
 
-@cli.callback()
-def _cli_callback(
-    _version: bool = Option(None, '--version', callback=version_callback, is_eager=True),
-) -> None:
-    pass
+def __getattr__(name: str) -> Any:
+    # moved to `smokeshow.cli` and `smokeshow.keys`, still available here for code which imports them from this
+    # module, e.g. console scripts installed pointing at `smokeshow.main:cli`
+    if name == 'cli':
+        from .cli import cli
 
+        return cli
+    elif name == 'generate_key':
+        from .keys import generate_key
 
-@cli.command(help='Generate a new upload key')
-def generate_key() -> str:
-    print(
-        'Searching for a key with valid hash '
-        f'(the numeric representation of its sha-256 hash needs to be less than 2^{KEY_HASH_THRESHOLD_POW}). '
-        'Hold tight, this might take a minute...'
-    )
-    attempts = 0
-    while True:
-        attempts += 1
-        seed = os.urandom(50)
-        h = int.from_bytes(hashlib.sha256(seed).digest(), 'big')
-        if attempts % 100_000 == 0:
-            print('.', end='', flush=True)
-        if h < KEY_HASH_THRESHOLD:
-            key = base64.b64encode(seed).decode().rstrip('=')
-            print(f"\nSuccess! Key found after {attempts:,} attempts:\n\n    SMOKESHOW_AUTH_KEY='{key}'\n")
-            return key
-
-
-@cli.command(name='upload', help='Upload one or more files to create a new site')
-def cli_upload(
-    path: Path = Argument(..., exists=True, dir_okay=True, file_okay=True, readable=True, resolve_path=True),
-    auth_key: Optional[str] = Option(None, envvar='SMOKESHOW_AUTH_KEY'),
-    root_url: str = Option(ROOT_URL, envvar='SMOKESHOW_ROOT_URL'),
-    github_status_description: Optional[str] = Option(None, envvar='SMOKESHOW_GITHUB_STATUS_DESCRIPTION'),
-    github_coverage_threshold: Optional[float] = Option(None, envvar='SMOKESHOW_GITHUB_COVERAGE_THRESHOLD'),
-) -> None:
-    try:
-        asyncio.run(
-            upload(
-                path,
-                auth_key=auth_key,
-                github_status_description=github_status_description,
-                github_coverage_threshold=github_coverage_threshold,
-                root_url=root_url,
-            )
-        )
-    except ValueError as e:
-        print(e, file=sys.stderr)
-        raise Exit(1)
+        return generate_key
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 async def upload(
@@ -91,68 +77,1392 @@ async def upload(
     github_status_description: Optional[str] = None,
     github_coverage_threshold: Optional[float] = None,
     root_url: str = ROOT_URL,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    http2: bool = False,
+    max_connections: Optional[int] = None,
+    max_keepalive: Optional[int] = None,
+    keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY,
+    minify_processes: int = 1,
+    retries: int = DEFAULT_RETRIES,
+    retry_budget: int = DEFAULT_RETRY_BUDGET,
+    archive: bool = False,
+    archive_gzip: bool = True,
+    compress: bool = False,
+    optimise: bool = False,
+    drop_source_maps: bool = False,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    follow_symlinks: bool = False,
+    on_span: Optional[Callable[['Span'], None]] = None,
+    resume: bool = False,
+    new_site: bool = True,
+    journal: Optional[Path] = None,
 ) -> str:
-    if auth_key is None:
-        print('No auth key provided, generating one now...')
-        auth_key_use = generate_key()
-    else:
-        auth_key_use = auth_key
+    """
+    Create a site and upload `root_path` to it, returning the site's URL.
 
-    if not root_path.exists():
-        raise ValueError(f'root path "{root_path}" does not exist')
+    Each file uploaded is recorded in a journal, by default in the cache directory, with `resume=True` an
+    interrupted upload carries on with the same site, only uploading files which are new or have changed, as long
+    as the site is still accepting uploads. Otherwise a new site is created, or with `new_site=False`, a
+    `ValueError` is raised.
 
-    transport = AsyncHTTPTransport(retries=REQUEST_RETRIES)
-    async with AsyncClient(timeout=DEFAULT_TIMEOUT, transport=transport) as client:
-        try:
-            r = await client.post(
-                root_url + '/create/', headers={'Authorisation': auth_key_use, 'User-Agent': USER_AGENT}
+    `on_span` is called with a `Span` as each stage of the upload finishes: creating the site, scanning files,
+    reading each file from disk, each request to the server, setting the GitHub status, and finally the whole
+    upload, see `Span` for details.
+
+    With `optimise=True`, HTML, CSS, JavaScript and JSON files are minified before they're uploaded, minified
+    files are cached so they're only minified again when their content changes. Files are minified in a thread,
+    or with `minify_processes` above 1, in that many processes, which re-import the calling script, so it needs an
+    `if __name__ == '__main__':` guard. `drop_source_maps=True` skips `*.map` files, and source map comments in
+    minified files.
+
+    To upload several sites sharing connections, use `Uploader`.
+    """
+    uploader = Uploader(
+        auth_key=auth_key,
+        root_url=root_url,
+        concurrency=concurrency,
+        http2=http2,
+        max_connections=max_connections,
+        max_keepalive=max_keepalive,
+        keepalive_expiry=keepalive_expiry,
+        minify_processes=minify_processes,
+        on_span=on_span,
+    )
+    async with uploader:
+        return await uploader.upload(
+            root_path,
+            github_status_description=github_status_description,
+            github_coverage_threshold=github_coverage_threshold,
+            retries=retries,
+            retry_budget=retry_budget,
+            archive=archive,
+            archive_gzip=archive_gzip,
+            compress=compress,
+            optimise=optimise,
+            drop_source_maps=drop_source_maps,
+            include=include,
+            exclude=exclude,
+            follow_symlinks=follow_symlinks,
+            resume=resume,
+            new_site=new_site,
+            journal=journal,
+        )
+
+
+class Uploader:
+    """
+    Uploads any number of sites, concurrently if required, sharing one connection pool, with at most `concurrency`
+    requests in flight across all sites. Use as an async context manager:
+
+        async with Uploader(concurrency=20) as uploader:
+            urls = await asyncio.gather(uploader.upload(Path('htmlcov')), uploader.upload(Path('docs')))
+
+    Arguments are as for `upload()`, `on_span` is called with the spans of every site.
+    """
+
+    def __init__(
+        self,
+        *,
+        auth_key: Optional[str] = None,
+        root_url: str = ROOT_URL,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        http2: bool = False,
+        max_connections: Optional[int] = None,
+        max_keepalive: Optional[int] = None,
+        keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY,
+        minify_processes: int = 1,
+        on_span: Optional[Callable[['Span'], None]] = None,
+    ):
+        if concurrency < 1:
+            raise ValueError(f'concurrency must be at least 1, not {concurrency}')
+        if minify_processes < 1:
+            raise ValueError(f'minify_processes must be at least 1, not {minify_processes}')
+        if max_connections is not None and max_connections < 1:
+            raise ValueError(f'max_connections must be at least 1, not {max_connections}')
+        self.auth_key = auth_key
+        self.root_url = root_url
+        self.concurrency = concurrency
+        self.minify_processes = minify_processes
+        self._tracer = _Tracer(on_span)
+        transport = _build_transport(concurrency, http2, max_connections, max_keepalive, keepalive_expiry)
+        self._client = AsyncClient(timeout=DEFAULT_TIMEOUT, transport=transport)
+        # created on entering, so it belongs to the running event loop with python 3.9
+        self._requests: Optional[asyncio.Semaphore] = None
+        # processes for minifying files if minify_processes is above 1, created when they're first needed
+        self._minify_executor: Optional[Executor] = None
+        self._optimised = False
+
+    async def __aenter__(self) -> 'Uploader':
+        self._requests = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+        if self._minify_executor is not None:
+            self._minify_executor.shutdown(cancel_futures=True)
+            self._minify_executor = None
+        if self._optimised:
+            await asyncio.to_thread(_prune_optimise_cache)
+            self._optimised = False
+
+    def _minify_pool(self) -> Optional[Executor]:
+        """
+        Processes to minify files in, or None to use the event loop's default thread pool: processes are only
+        started when asked for, since they re-import the calling script, see `upload()`.
+        """
+        if self.minify_processes == 1:
+            return None
+        if self._minify_executor is None:
+            # slow to import, and only needed when files are minified
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # spawn avoids forking a process which may have threads running, e.g. from the event loop
+            self._minify_executor = ProcessPoolExecutor(
+                self.minify_processes, mp_context=multiprocessing.get_context('spawn')
             )
+        return self._minify_executor
+
+    async def create_site(self, root_path: Path, *, journal: Optional[Path] = None, resume: bool = False) -> str:
+        """
+        Create a site for `root_path` without uploading anything, returning its URL. Files are uploaded to it
+        later, possibly by another process, with `upload(root_path, resume=True)` and the same `journal`.
+
+        With `resume=True`, the site from the journal is used if it can still be uploaded to.
+        """
+        journal_file = journal or journal_path(root_path, self.root_url)
+        site_journal = _Journal.resume(journal_file) if resume else None
+        if site_journal is not None:
+            site_journal.close()
+            return site_journal.url
+        # the journal is how files are uploaded later, so it must be written
+        with closing(_Journal.open(journal_file, required=True)) as site_journal:
+            await _create_site(self._client, self._tracer, self.root_url, self.auth_key, site_journal)
+        return site_journal.url
+
+    async def upload(
+        self,
+        root_path: Path,
+        *,
+        github_status_description: Optional[str] = None,
+        github_coverage_threshold: Optional[float] = None,
+        retries: int = DEFAULT_RETRIES,
+        retry_budget: int = DEFAULT_RETRY_BUDGET,
+        archive: bool = False,
+        archive_gzip: bool = True,
+        compress: bool = False,
+        optimise: bool = False,
+        drop_source_maps: bool = False,
+        include: Optional[Sequence[str]] = None,
+        exclude: Optional[Sequence[str]] = None,
+        follow_symlinks: bool = False,
+        resume: bool = False,
+        new_site: bool = True,
+        journal: Optional[Path] = None,
+    ) -> str:
+        """
+        Create a site and upload `root_path` to it, returning the site's URL, see `upload()`.
+
+        Retries and the retry budget apply to each site separately.
+        """
+        if self._requests is None:
+            raise RuntimeError('Uploader must be used as an async context manager')
+        if not root_path.exists():
+            raise ValueError(f'root path "{root_path}" does not exist')
+
+        client, tracer, root_url = self._client, self._tracer, self.root_url
+        journal_file = journal or journal_path(root_path, root_url)
+        await asyncio.to_thread(_prune_journals)
+        with tracer.span('upload', path=str(root_path)) as upload_span:
+            site_journal = _Journal.resume(journal_file, required=not new_site) if resume else None
+            if site_journal is None:
+                site_journal = _Journal.open(journal_file, required=resume or journal is not None)
+                try:
+                    await _create_site(client, tracer, root_url, self.auth_key, site_journal)
+                except BaseException:
+                    site_journal.close()
+                    raise
+            else:
+                print(
+                    f'Resuming upload to {site_journal.url}, '
+                    f'{len(site_journal.files)} files were uploaded by the last attempt'
+                )
+            secret_key, upload_root = site_journal.secret_key, site_journal.url
+            upload_span['url'] = upload_root
+
+            status_info: Optional[asyncio.Task[tuple[str, str]]] = None
+            if github_status_description is not None:
+                # find coverage while files are uploading
+                status_info = asyncio.create_task(
+                    asyncio.to_thread(
+                        get_github_status_info, root_path, github_status_description, github_coverage_threshold
+                    )
+                )
+
+            try:
+                throttle = _Throttle(self.concurrency, retries, retry_budget, self._requests)
+                optimiser: Optional[_Optimiser] = None
+                if optimise:
+                    optimiser = _Optimiser(self._minify_pool, drop_source_maps)
+                    self._optimised = True
+                exclude_patterns = (*DEFAULT_EXCLUDE, *(exclude or ()), *(['*.map'] if drop_source_maps else []))
+                with _compress_dir(compress) as compress_dir, closing(site_journal):
+                    if root_path.is_dir():
+                        total_size = await _upload_dir(
+                            client,
+                            throttle,
+                            tracer,
+                            site_journal,
+                            root_path,
+                            self.concurrency,
+                            archive=archive,
+                            archive_gzip=archive_gzip,
+                            compress_dir=compress_dir,
+                            optimiser=optimiser,
+                            path_filter=_PathFilter(include or (), exclude_patterns),
+                            follow_symlinks=follow_symlinks,
+                        )
+                    else:
+                        # root_path is a file
+                        size = root_path.stat().st_size
+                        site_file, _ = await _optimise_and_prepare(
+                            root_path, root_path.name, size, optimiser, compress_dir
+                        )
+                        total_size = site_journal.site_size
+                        if site_journal.uploaded(root_path.name, site_file):
+                            print(f'{root_path.name} is unchanged since it was uploaded')
+                        else:
+                            print('uploading 1 file...')
+                            total_size = await _upload_file(
+                                client,
+                                throttle,
+                                tracer,
+                                secret_key,
+                                upload_root,
+                                site_file.file_path,
+                                root_path.name,
+                                site_file.content_encoding,
+                                site_file.size,
+                                site_file.hash,
+                            )
+                            site_journal.add(root_path.name, site_file, total_size)
+                upload_span['site_size'] = total_size
+
+                print(f'upload complete ✓ site size {fmt_size(total_size)}')
+                print('go to', upload_root)
+                if status_info is not None:
+                    state, description = await status_info
+                    with tracer.span('github-status', state=state):
+                        await set_github_commit_status(client, upload_root, state, description)
+            finally:
+                if status_info is not None and not status_info.done():
+                    # the upload failed, so the status won't be set
+                    status_info.cancel()
+                elif status_info is not None and not status_info.cancelled():
+                    # so an error finding the status isn't reported as never retrieved if the upload failed first
+                    status_info.exception()
+
+        # the upload is complete, so there's nothing to resume, and the journal contains the site's secret key
+        with suppress(OSError):
+            journal_file.unlink()
+        return upload_root
+
+
+def _build_transport(
+    concurrency: int,
+    http2: bool,
+    max_connections: Optional[int],
+    max_keepalive: Optional[int],
+    keepalive_expiry: float,
+) -> AsyncHTTPTransport:
+    """
+    Build the transport used for all requests, falling back to HTTP/1.1 if HTTP/2 is requested but "h2" isn't
+    installed.
+
+    By default the connection pool is sized to match the number of upload workers, so peak resource use depends on
+    concurrency, not on the number of files. With HTTP/2, uploads are multiplexed as streams over as few
+    connections as the server allows.
+    """
+    if http2 and find_spec('h2') is None:
+        print('HTTP/2 requires the "h2" package, install "smokeshow[http2]" to use it, falling back to HTTP/1.1')
+        http2 = False
+    max_connections = max_connections or concurrency
+    limits = Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections if max_keepalive is None else max_keepalive,
+        keepalive_expiry=keepalive_expiry,
+    )
+    return AsyncHTTPTransport(retries=REQUEST_RETRIES, limits=limits, http2=http2)
+
+
+async def _create_site(
+    client: AsyncClient, tracer: '_Tracer', root_url: str, auth_key: Optional[str], journal: '_Journal'
+) -> None:
+    """
+    Create a new site and start its journal, with no `auth_key` a cached key is used, and replaced if it's hit
+    the limit on sites created.
+    """
+    # in a thread, since generating a key can take a few seconds, in one process so library users don't get
+    # multiprocessing implicitly
+    auth_key_use = await asyncio.to_thread(get_cached_key) if auth_key is None else auth_key
+    r = await _create_site_request(client, tracer, root_url, auth_key_use)
+    if r.status_code == 429 and auth_key is None:
+        # the cached key has hit the daily site limit, replace it and try again
+        print('The cached auth key has exceeded the site creation limit, generating a new key...')
+        auth_key_use = await asyncio.to_thread(rotate_cached_key, auth_key_use)
+        r = await _create_site_request(client, tracer, root_url, auth_key_use)
+    if r.status_code != 200:
+        raise ValueError(f'Error creating ephemeral site {r.status_code}, response:\n{r.text}')
+
+    obj = r.json()
+    upload_root: str = obj['url']
+    assert upload_root.endswith('/'), upload_root
+
+    # useful when uploading to a dev endpoint where the worker returns the production host in request.url
+    if not upload_root.startswith(root_url):
+        upload_root = re.sub('^https?://[^/]+', root_url, upload_root)
+    print(f'Site created with root {upload_root}')
+    journal.start(upload_root, obj['secret_key'], _upload_expiration(obj))
+
+
+async def _create_site_request(client: AsyncClient, tracer: '_Tracer', root_url: str, auth_key: str) -> Response:
+    with tracer.span('create') as span:
+        try:
+            r = await client.post(root_url + '/create/', headers={'Authorisation': auth_key, 'User-Agent': USER_AGENT})
         except HTTPError as err:
             raise ValueError(f'Error creating ephemeral site {err}')
-        if r.status_code != 200:
-            raise ValueError(f'Error creating ephemeral site {r.status_code}, response:\n{r.text}')
-
-        obj = r.json()
-        secret_key: str = obj['secret_key']
-        upload_root: str = obj['url']
-        assert upload_root.endswith('/'), upload_root
-
-        # useful when uploading to a dev endpoint where the worker returns the production host in request.url
-        if not upload_root.startswith(root_url):
-            upload_root = re.sub('^https?://[^/]+', root_url, upload_root)
-
-        if root_path.is_dir():
-            tasks: list[asyncio.Task[int]] = []
-            for p in root_path.glob('**/*'):
-                if not p.is_file():
-                    continue
-                task = asyncio.create_task(_upload_file(client, secret_key, upload_root, p, p.relative_to(root_path)))
-                tasks.append(task)
-
-            print(f'Site created with root {upload_root}\nuploading {len(tasks)} files...')
-            # if an error occurs other tasks will still be executed which does not make much sense here so better
-            # cancel them explicitly
+        span['status'] = r.status_code
+        return r
+
+
+class _Journal:
+    """
+    Append-only record of a site being uploaded, so an interrupted upload can be resumed: the first line has the
+    site's URL and secret key, then there's a line for each file once the server has confirmed it's saved.
+
+    Lines are JSON, and written as soon as each file is uploaded so nothing is lost if the process is killed.
+
+    If the journal can't be written and wasn't asked for, the upload carries on without one, see `open`.
+    """
+
+    def __init__(self, path: Path, site: dict[str, Any], files: dict[str, dict[str, Any]]):
+        self.path = path
+        self.site = site
+        self.files = files
+        self._file: Optional[TextIO] = None
+
+    @property
+    def url(self) -> str:
+        return cast(str, self.site['url'])
+
+    @property
+    def secret_key(self) -> str:
+        return cast(str, self.site['secret_key'])
+
+    @property
+    def site_size(self) -> int:
+        return max((f['site_size'] for f in self.files.values()), default=0)
+
+    @classmethod
+    def open(cls, path: Path, *, required: bool) -> '_Journal':
+        """
+        Open a journal for a new site, before the site is created so a journal which can't be written doesn't
+        waste a site, call `start` once it's created.
+
+        If the journal can't be written, with `required` a `ValueError` is raised, otherwise a warning is printed
+        and nothing is recorded, so the upload can't be resumed.
+        """
+        journal = cls(path, {}, {})
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # only the current user can read it, as it contains the secret key; not truncated until the site is
+            # created, so a journal from an earlier upload isn't lost if creating the site fails
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o600)
+        except OSError as e:
+            if required:
+                raise ValueError(f'Unable to write upload journal at {path}: {e}')
+            print(f"Unable to write upload journal at {path}, this upload can't be resumed: {e}")
+        else:
+            journal._file = os.fdopen(fd, 'w')
+        return journal
+
+    def start(self, url: str, secret_key: str, upload_expiration: float) -> None:
+        self.site = {'url': url, 'secret_key': secret_key, 'upload_expiration': upload_expiration}
+        if self._file is not None:
+            self._file.truncate()
+        self._write(self.site)
+
+    @classmethod
+    def resume(cls, path: Path, *, required: bool = False) -> Optional['_Journal']:
+        """
+        Load a journal to continue uploading to its site, `None` if there's no journal or the site can no
+        longer be uploaded to, so a new site should be created. With `required`, a `ValueError` is raised instead.
+        """
+
+        def cant_resume(reason: str) -> None:
+            if required:
+                raise ValueError(f'Unable to resume upload, {reason}')
+            print(f'{reason}, creating a new site')
+
+        try:
+            text = path.read_text()
+        except FileNotFoundError:
+            return cant_resume(f'no upload journal found at {path}')
+        except OSError as e:
+            return cant_resume(f'unable to read upload journal at {path} ({e})')
+
+        site: Optional[dict[str, Any]] = None
+        files: dict[str, dict[str, Any]] = {}
+        for line in text.splitlines():
             try:
-                results = await asyncio.gather(*tasks)
+                record = json.loads(line)
             except ValueError:
-                await _handle_tasks(tasks)
-                raise
-            total_size = max(results)
+                # the last line can be incomplete if the process was killed while writing it
+                continue
+            if site is None:
+                site = record
+            else:
+                files[record['path']] = record
+
+        upload_expiration = None if site is None else site.get('upload_expiration')
+        if site is None or 'secret_key' not in site or not isinstance(upload_expiration, (int, float)):
+            return cant_resume(f'upload journal at {path} is invalid')
+        # leave time to upload something before the site stops accepting files
+        if upload_expiration - time.time() < RESUME_MIN_TIME:
+            return cant_resume(f'uploads to {site["url"]} are no longer allowed')
+        journal = cls(path, site, files)
+        journal._file = path.open('a')
+        if not text.endswith('\n'):
+            journal._file.write('\n')
+        return journal
+
+    def uploaded(self, url_path: str, site_file: '_SiteFile') -> bool:
+        """
+        Whether the file was uploaded with the same content by an earlier attempt.
+        """
+        f = self.files.get(url_path)
+        return f is not None and f['hash'] == site_file.hash and f['content_encoding'] == site_file.content_encoding
+
+    def skip_uploaded(self, root_path: Path, site_files: dict[Path, '_SiteFile']) -> None:
+        """
+        Remove files from `site_files` which were uploaded with the same content by an earlier attempt.
+        """
+        uploaded = [p for p, f in site_files.items() if self.uploaded(p.relative_to(root_path).as_posix(), f)]
+        if uploaded:
+            print(f'{len(uploaded)} files are unchanged since they were uploaded')
+            for p in uploaded:
+                del site_files[p]
+
+    def add(self, url_path: str, site_file: '_SiteFile', site_size: int) -> None:
+        record = {
+            'path': url_path,
+            'hash': site_file.hash,
+            'size': site_file.size,
+            'content_encoding': site_file.content_encoding,
+            'site_size': site_size,
+        }
+        self.files[url_path] = record
+        self._write(record)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, record: dict[str, Any]) -> None:
+        if self._file is not None:
+            self._file.write(json.dumps(record) + '\n')
+            # flushed so the line survives the process being killed
+            self._file.flush()
+
+
+def journal_path(root_path: Path, root_url: str) -> Path:
+    """
+    Default journal location, one per directory and server so `--resume` finds the right site.
+    """
+    key = hashlib.sha256(f'{root_url} {root_path.resolve()}'.encode()).hexdigest()[:32]
+    return cache_dir() / 'journals' / f'{key}.jsonl'
+
+
+def _prune_journals() -> None:
+    """
+    Delete journals in the cache directory for sites which no longer accept uploads, they can't be resumed, and
+    contain the site's secret key.
+    """
+    now = time.time()
+    try:
+        paths = list((cache_dir() / 'journals').iterdir())
+    except OSError:
+        return
+    for path in paths:
+        try:
+            with path.open() as f:
+                upload_expiration = json.loads(f.readline())['upload_expiration']
+        except (ValueError, KeyError, TypeError):
+            upload_expiration = None
+        except OSError:
+            continue
+        try:
+            if not isinstance(upload_expiration, (int, float)):
+                # invalid, or a journal whose site is still being created
+                upload_expiration = path.stat().st_mtime + UPLOAD_TTL
+            if upload_expiration < now:
+                path.unlink()
+        except FileNotFoundError:
+            # deleted by another process
+            pass
+
+
+def _upload_expiration(site_info: dict[str, Any]) -> float:
+    try:
+        return datetime.fromisoformat(site_info['upload_expiration'].replace('Z', '+00:00')).timestamp()
+    except (KeyError, AttributeError, ValueError):
+        return time.time() + UPLOAD_TTL
+
+
+async def _upload_dir(
+    client: AsyncClient,
+    throttle: '_Throttle',
+    tracer: '_Tracer',
+    journal: _Journal,
+    root_path: Path,
+    concurrency: int,
+    *,
+    archive: bool = False,
+    archive_gzip: bool = True,
+    compress_dir: Optional[Path] = None,
+    optimiser: Optional['_Optimiser'] = None,
+    path_filter: Optional['_PathFilter'] = None,
+    follow_symlinks: bool = False,
+) -> int:
+    """
+    Upload all files in `root_path` using a fixed pool of `concurrency` workers.
+
+    Files are uploaded largest first so big files don't end up starting last and extending the total upload time.
+    Content the server already has, or which appears more than once in the site, is linked by its hash instead
+    of being uploaded again.
+
+    With `archive=True`, files are sent in tar archives of up to `ARCHIVE_MAX_FILES` files rather than one
+    request per file. If `optimiser` is set, files are minified with it before uploading, if `compress_dir` is set,
+    text files are gzipped into it.
+
+    Files are hashed (and optimised and compressed) while the directory is still being scanned, only files matching
+    `path_filter` are included. Files already uploaded with the same content, according to `journal`, are skipped.
+    """
+    secret_key, upload_root = journal.secret_key, journal.url
+    print('scanning files...')
+    path_filter = path_filter or _PathFilter((), ())
+    site_files: dict[Path, _SiteFile] = {}
+    original_size = optimised_size = 0
+
+    async def prepare_file(file: tuple[Path, str, int]) -> None:
+        nonlocal original_size, optimised_size
+        file_path, url_path, size = file
+        original_size += size
+        site_file, size = await _optimise_and_prepare(file_path, url_path, size, optimiser, compress_dir)
+        optimised_size += size
+        site_files[file_path] = site_file
+
+    with tracer.span('scan', path=str(root_path)) as span:
+        await _run_pool(_scan_files(root_path, path_filter, follow_symlinks), prepare_file, concurrency)
+        span.update(files=len(site_files), bytes=original_size)
+    if optimiser:
+        print(
+            f'{optimiser.files} files optimised ({optimiser.cached} from cache), '
+            f'saving {fmt_size(original_size - optimised_size)}'
+        )
+    if compress_dir:
+        compressed = sum(1 for f in site_files.values() if f.content_encoding)
+        saved = optimised_size - sum(f.size for f in site_files.values())
+        print(f'{compressed} files compressed, saving {fmt_size(saved)}')
+    journal.skip_uploaded(root_path, site_files)
+    # sorted by path too, so which of several duplicates gets uploaded doesn't depend on the order of scanning
+    paths = sorted(site_files, key=lambda p: (-site_files[p].size, p))
+    print(f'uploading {len(paths)} files...')
+    hashes = {f.hash for f in site_files.values()}
+    existing = await _check_hashes(client, throttle, tracer, secret_key, upload_root, hashes)
+
+    to_upload: list[Path] = []
+    to_link: list[Path] = []
+    if existing is None:
+        # server doesn't support linking by hash or archives, upload everything file by file
+        to_upload = paths
+        if archive:
+            print('server does not support archive uploads, uploading files individually')
+            archive = False
+    else:
+        to_upload, to_link = _split_links(paths, site_files, existing)
+        if to_link:
+            print(f'{len(to_link)} files are already stored, they will be linked by hash')
+
+    total_size = journal.site_size
+
+    async def upload_file(file_path: Path) -> None:
+        nonlocal total_size
+        f = site_files[file_path]
+        rel_path = file_path.relative_to(root_path)
+        size = await _upload_file(
+            client, throttle, tracer, secret_key, upload_root, f.file_path, rel_path, f.content_encoding, f.size, f.hash
+        )
+        journal.add(rel_path.as_posix(), f, size)
+        total_size = max(total_size, size)
+
+    async def link_file(file_path: Path) -> None:
+        nonlocal total_size
+        f = site_files[file_path]
+        rel_path = file_path.relative_to(root_path)
+        size = await _link_file(client, throttle, tracer, secret_key, upload_root, rel_path, f.hash, f.content_encoding)
+        if size is None:
+            size = await _upload_file(
+                client,
+                throttle,
+                tracer,
+                secret_key,
+                upload_root,
+                f.file_path,
+                rel_path,
+                f.content_encoding,
+                f.size,
+                f.hash,
+            )
+        journal.add(rel_path.as_posix(), f, size)
+        total_size = max(total_size, size)
+
+    if archive:
+
+        def archive_entry(file_path: Path, link: bool) -> _ArchiveEntry:
+            f = site_files[file_path]
+            url_path = file_path.relative_to(root_path).as_posix()
+            return _ArchiveEntry(f.file_path, url_path, f.size, f.hash if link else None, f.content_encoding)
+
+        upload_entries = [archive_entry(p, False) for p in to_upload]
+        link_entries = [archive_entry(p, True) for p in to_link]
+        missing: list[Path] = []
+
+        async def upload_archive(entries: list[_ArchiveEntry]) -> None:
+            nonlocal total_size
+            size, archive_missing = await _upload_archive(
+                client, throttle, tracer, secret_key, upload_root, entries, archive_gzip
+            )
+            total_size = max(total_size, size)
+            for e in entries:
+                if e.url_path in archive_missing:
+                    missing.append(root_path / e.url_path)
+                else:
+                    journal.add(e.url_path, site_files[root_path / e.url_path], size)
+
+        # links have to wait for uploads, so duplicates within the site can be linked to their first copy
+        await _run_pool(_archive_batches(upload_entries), upload_archive, concurrency)
+        await _run_pool(_archive_batches(link_entries), upload_archive, concurrency)
+        # content which disappeared from the server between checking hashes and linking has to be uploaded
+        await _run_pool(missing, upload_file, concurrency)
+    else:
+        # links have to wait for uploads, so duplicates within the site can be linked to their first copy
+        await _run_pool(to_upload, upload_file, concurrency)
+        await _run_pool(to_link, link_file, concurrency)
+    return total_size
+
+
+def _split_links(
+    paths: list[Path], site_files: dict[Path, '_SiteFile'], existing: set[str]
+) -> tuple[list[Path], list[Path]]:
+    """
+    Split files into those to upload, and those to link to content which is stored or will be by an earlier upload.
+    """
+    to_upload: list[Path] = []
+    to_link: list[Path] = []
+    for p in paths:
+        file_hash = site_files[p].hash
+        if file_hash in existing:
+            to_link.append(p)
+        else:
+            existing.add(file_hash)
+            to_upload.append(p)
+    return to_upload, to_link
+
+
+async def _run_pool(
+    items: Union[Iterable[T], AsyncIterable[T]], func: Callable[[T], Awaitable[None]], concurrency: int
+) -> None:
+    """
+    Call `func` on each item with a fixed pool of `concurrency` workers, each worker takes the next item
+    from the queue as soon as it's free.
+
+    `items` may be an async iterable, in which case workers start on items as soon as they're produced.
+    """
+    # bounded so an async producer doesn't get far ahead of the workers, `None` tells a worker to stop
+    queue: asyncio.Queue[Optional[T]] = asyncio.Queue(maxsize=concurrency)
+
+    async def feed() -> None:
+        if isinstance(items, AsyncIterable):
+            async for item in items:
+                await queue.put(item)
+        else:
+            for item in items:
+                await queue.put(item)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def worker() -> None:
+        while (item := await queue.get()) is not None:
+            await func(item)
+
+    tasks = [asyncio.create_task(feed())] + [asyncio.create_task(worker()) for _ in range(concurrency)]
+    # if an error occurs other workers will still be executed which does not make much sense here so better
+    # cancel them explicitly
+    try:
+        await asyncio.gather(*tasks)
+    except ValueError:
+        await _handle_tasks(tasks)
+        raise
+
+
+class Span(NamedTuple):
+    """
+    A timed stage of an upload, passed to the `on_span` callback of `upload()`.
+
+    `name` is one of:
+    * `create` - creating the site
+    * `scan` - finding, hashing and compressing files, attributes `files` and `bytes`
+    * `read` - reading a file from disk, `duration` excludes time waiting for the request to take each chunk
+    * `post` - a request to the server including retries, attributes `kind` (`upload`, `link`, `archive` or
+      `check-hashes`), `path`, `bytes`, `retries` and `status`
+    * `github-status` - setting the commit status
+    * `upload` - the whole upload, attributes `url` and `site_size`
+
+    If the stage failed, `error` is set in `attributes`.
+    """
+
+    name: str
+    # unix timestamp
+    start: float
+    # seconds
+    duration: float
+    attributes: dict[str, Any]
+
+
+class _Tracer:
+    """
+    Times stages of an upload, with no `on_span` callback spans cost no more than a context manager.
+    """
+
+    def __init__(self, on_span: Optional[Callable[[Span], None]]):
+        self.on_span = on_span
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Generator[dict[str, Any], None, None]:
+        """
+        Time the body of the `with` block, the attributes dict is yielded so more can be added.
+        """
+        if self.on_span is None:
+            yield attributes
+            return
+
+        start = time.time()
+        t = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes['error'] = str(e) or repr(e)
+            raise
+        finally:
+            self.on_span(Span(name, start, time.perf_counter() - t, attributes))
+
+
+class Report:
+    """
+    Collects spans for the `--report` option, summarised by `json()`.
+    """
+
+    def __init__(self) -> None:
+        self.spans: list[Span] = []
+
+    def __call__(self, span: Span) -> None:
+        self.spans.append(span)
+
+    def json(self) -> str:
+        requests = [s for s in self.spans if s.name == 'post']
+        latencies = sorted(s.duration for s in requests)
+        uploads = [s for s in self.spans if s.name == 'upload']
+        if uploads:
+            # sites may have been uploaded concurrently
+            wall_time = max(s.start + s.duration for s in uploads) - min(s.start for s in uploads)
+        else:
+            wall_time = sum(s.duration for s in self.spans)
+        sites = [
+            {k: s.attributes.get(k) for k in ('path', 'url', 'site_size', 'error')}
+            for s in sorted(uploads, key=lambda s: s.start)
+        ]
+        succeeded = [s for s in requests if s.attributes.get('status') == 200]
+        uploaded = sum(s.attributes.get('bytes', 0) for s in succeeded)
+        # requests by final status, "error" if no response was received
+        statuses: dict[str, int] = {}
+        for s in requests:
+            status = 'error' if 'error' in s.attributes else str(s.attributes.get('status'))
+            statuses[status] = statuses.get(status, 0) + 1
+        # total time spent in each stage, stages run concurrently so these can add up to more than the wall time
+        stages: dict[str, float] = {}
+        for s in self.spans:
+            if s.name != 'upload':
+                stages[s.name] = stages.get(s.name, 0) + s.duration
+
+        report = {
+            # the first site's URL, and the first error of any site
+            'url': sites[0]['url'] if sites else None,
+            'error': next((site['error'] for site in sites if site['error']), None),
+            'sites': sites,
+            'totals': {
+                'wall_time': wall_time,
+                'requests': len(requests),
+                'files': sum(s.attributes.get('files', 1) for s in succeeded if s.attributes['kind'] != 'check-hashes'),
+                'bytes': uploaded,
+                'retries': sum(s.attributes.get('retries', 0) for s in requests),
+                'statuses': statuses,
+                'latency_p50': _percentile(latencies, 50),
+                'latency_p95': _percentile(latencies, 95),
+                'bytes_per_second': uploaded / wall_time if wall_time else 0,
+                'stages': stages,
+            },
+            'requests': [{**s.attributes, 'start': s.start, 'latency': s.duration} for s in requests],
+        }
+        return json.dumps(report, indent=2) + '\n'
+
+
+def _percentile(sorted_values: list[float], percent: float) -> Optional[float]:
+    # nearest rank
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(percent / 100 * len(sorted_values)) - 1, 0)]
+
+
+class _Throttle:
+    """
+    Shared by all requests while uploading a site, adapts how many requests can be in flight to the server's
+    responses and limits the total number of retries. `requests` limits requests in flight across all the sites
+    an `Uploader` is uploading.
+
+    The limit is halved when the server rate limits requests, and grows by about one for each round of
+    successful requests, so it settles just below what the server will accept (additive increase,
+    multiplicative decrease).
+    """
+
+    def __init__(self, concurrency: int, retries: int, retry_budget: int, requests: Optional[asyncio.Semaphore] = None):
+        self.requests = requests or asyncio.Semaphore(concurrency)
+        self.max_limit = concurrency
+        self.limit: float = concurrency
+        self.in_flight = 0
+        self.retries = retries
+        self.retry_budget = retry_budget
+        self._decreased_at = 0.0
+        self._changed = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncGenerator[None, None]:
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        try:
+            async with self.requests:
+                yield
+        finally:
+            async with self._changed:
+                self.in_flight -= 1
+                self._changed.notify_all()
+
+    def succeeded(self) -> None:
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def rate_limited(self, started: float) -> None:
+        # requests which were already in flight when the limit was last lowered don't lower it again
+        if started > self._decreased_at:
+            self.limit = max(1, self.limit / 2)
+            self._decreased_at = time.monotonic()
+
+    def use_retry(self, attempt: int) -> bool:
+        if attempt >= self.retries or self.retry_budget <= 0:
+            return False
+        self.retry_budget -= 1
+        return True
+
+
+async def _send(
+    throttle: _Throttle,
+    tracer: '_Tracer',
+    description: str,
+    request: Callable[[], Awaitable[Response]],
+    **attributes: Any,
+) -> Response:
+    """
+    Make a request, retrying with exponential backoff and jitter after network errors, timeouts, 429 and 5xx
+    responses, waiting as long as the server asks if it sets `Retry-After`.
+
+    Once the request's retries or the site's retry budget are used up, the last response is returned or the last
+    network error raised.
+
+    The request, including any retries, is recorded as a "post" span with `attributes`.
+    """
+    attempt = 0
+    with tracer.span('post', **attributes) as span:
+        while True:
+            span['retries'] = attempt
+            started = time.monotonic()
+            try:
+                async with throttle.slot():
+                    r = await request()
+            except HTTPError as e:
+                if not throttle.use_retry(attempt):
+                    raise
+                reason, delay = f'error={e}', _backoff(attempt)
+            else:
+                span['status'] = r.status_code
+                if r.status_code not in RETRY_STATUSES:
+                    throttle.succeeded()
+                    return r
+                if r.status_code == 429:
+                    throttle.rate_limited(started)
+                if not throttle.use_retry(attempt):
+                    return r
+                retry_after = _retry_after(r)
+                reason, delay = f'status={r.status_code}', _backoff(attempt) if retry_after is None else retry_after
+            print(f'    {description} failed {reason}, retrying in {delay:.1f}s')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def _backoff(attempt: int) -> float:
+    # "full jitter", so requests which failed together don't all retry together
+    return random.uniform(0, min(MAX_RETRY_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+
+def _retry_after(response: Response) -> Optional[float]:
+    value = response.headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        # otherwise it should be an HTTP date
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(delay, 0), MAX_RETRY_DELAY)
+
+
+async def _check_hashes(
+    client: AsyncClient, throttle: '_Throttle', tracer: '_Tracer', secret_key: str, upload_root: str, hashes: set[str]
+) -> Optional[set[str]]:
+    """
+    Find which of `hashes` the server already has content stored for.
+
+    Returns `None` if the server doesn't support checking hashes.
+    """
+    existing: set[str] = set()
+    hash_list = sorted(hashes)
+    headers = {'Authorisation': secret_key, 'User-Agent': USER_AGENT}
+    url = upload_root + CHECK_HASHES_PATH
+    for i in range(0, len(hash_list), CHECK_HASHES_BATCH):
+        batch = hash_list[i : i + CHECK_HASHES_BATCH]
+        try:
+            r = await _send(
+                throttle,
+                tracer,
+                'checking hashes',
+                lambda: client.post(url, json={'hashes': batch}, headers=headers),
+                kind='check-hashes',
+                files=len(batch),
+            )
+        except HTTPError:
+            raise ValueError('Checking stored files failed due to a network error')
+        if r.status_code in {404, 405}:
+            return None
+        elif r.status_code != 200:
+            raise ValueError(f'invalid response from "{url}" status={r.status_code} response={r.text}')
+        missing = r.json().get('missing')
+        if missing is None:
+            return None
+        existing.update(set(batch) - set(missing))
+    return existing
+
+
+class _PathFilter:
+    """
+    Decide which files to upload using gitignore style patterns:
+    * patterns without a slash match a file or directory name at any depth, e.g. `*.pyc` or `__pycache__`
+    * patterns containing a slash match paths relative to the root, e.g. `/docs/*.html` or `a/**/b`
+    * a trailing slash means the pattern only matches directories, e.g. `build/`
+    * matching a directory matches everything inside it
+
+    If there are any `include` patterns, only files they match are uploaded, `exclude` patterns always win.
+    """
+
+    def __init__(self, include: Sequence[str], exclude: Sequence[str]):
+        self.include = [_compile_pattern(p) for p in include]
+        self.exclude = [_compile_pattern(p) for p in exclude]
+
+    def skip_dir(self, rel_path: str) -> bool:
+        return _match_patterns(self.exclude, rel_path, True)
+
+    def include_file(self, rel_path: str) -> bool:
+        if _match_patterns(self.exclude, rel_path, False):
+            return False
+        return not self.include or any(_match_patterns(self.include, p, p != rel_path) for p in _parents(rel_path))
+
+
+def _compile_pattern(pattern: str) -> tuple[re.Pattern[str], bool]:
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    # like gitignore, a pattern is relative to the root if it has a slash anywhere but the end
+    anchored = '/' in pattern
+    regex = ''
+    for part in re.split(r'(\*\*/|/\*\*$|\*\*|\*|\?)', pattern.lstrip('/')):
+        if part == '**/':
+            regex += '(?:.*/)?'
+        elif part == '/**':
+            regex += '/.*'
+        elif part == '**':
+            regex += '.*'
+        elif part == '*':
+            regex += '[^/]*'
+        elif part == '?':
+            regex += '[^/]'
+        else:
+            regex += re.escape(part)
+    return re.compile(('' if anchored else '(?:.*/)?') + regex), dir_only
+
+
+def _match_patterns(patterns: list[tuple[re.Pattern[str], bool]], rel_path: str, is_dir: bool) -> bool:
+    return any(regex.fullmatch(rel_path) and (is_dir or not dir_only) for regex, dir_only in patterns)
+
+
+def _parents(rel_path: str) -> list[str]:
+    """
+    `rel_path` and all the directories it's in, e.g. `a/b/c.txt` -> `a/b/c.txt`, `a/b`, `a`.
+    """
+    parts = rel_path.split('/')
+    return ['/'.join(parts[:i]) for i in range(len(parts), 0, -1)]
+
+
+async def _scan_files(
+    root_path: Path, path_filter: _PathFilter, follow_symlinks: bool
+) -> AsyncIterator[tuple[Path, str, int]]:
+    """
+    Find files to upload, yielding each directory's files as soon as it's been scanned.
+    """
+    walk = _walk(root_path, path_filter, follow_symlinks)
+    while (files := await asyncio.to_thread(next, walk, None)) is not None:
+        for file in files:
+            yield file
+
+
+def _walk(
+    root_path: Path, path_filter: _PathFilter, follow_symlinks: bool
+) -> Generator[list[tuple[Path, str, int]], None, None]:
+    """
+    Walk `root_path` with `os.scandir`, yielding `(path, url_path, size)` for the files of one directory at a time.
+
+    Sizes come from the scan's own stat data, excluded directories are never scanned, and symlinked directories
+    are only followed if `follow_symlinks` is set, skipping links back to a directory the walk is already inside.
+    """
+    root_stat = root_path.stat()
+    # each directory to scan, with the path prefix of its files and the directories it's inside
+    stack = [(root_path, '', frozenset({(root_stat.st_dev, root_stat.st_ino)}))]
+    while stack:
+        dir_path, prefix, ancestors = stack.pop()
+        files: list[tuple[Path, str, int]] = []
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                rel_path = prefix + entry.name
+                if entry.is_dir(follow_symlinks=follow_symlinks):
+                    if path_filter.skip_dir(rel_path):
+                        continue
+                    dir_ancestors = ancestors
+                    if follow_symlinks:
+                        st = entry.stat()
+                        if (st.st_dev, st.st_ino) in ancestors:
+                            # symlink cycle
+                            continue
+                        dir_ancestors = ancestors | {(st.st_dev, st.st_ino)}
+                    stack.append((Path(entry.path), rel_path + '/', dir_ancestors))
+                elif entry.is_file() and path_filter.include_file(rel_path):
+                    files.append((Path(entry.path), rel_path, entry.stat().st_size))
+        yield files
+
+
+class _SiteFile(NamedTuple):
+    # the file to upload, either the original or a compressed copy
+    file_path: Path
+    size: int
+    hash: str
+    content_encoding: Optional[str]
+
+
+async def _optimise_and_prepare(
+    file_path: Path, url_path: str, size: int, optimiser: Optional['_Optimiser'], compress_dir: Optional[Path]
+) -> tuple[_SiteFile, int]:
+    """
+    Minify a file if `optimiser` is set, then prepare it for upload, returns the file and its size after minifying.
+    """
+    if optimiser is not None:
+        file_path, size = await optimiser.optimise(file_path, url_path, size)
+    return await asyncio.to_thread(_prepare_file, file_path, url_path, size, compress_dir), size
+
+
+def _prepare_file(file_path: Path, url_path: str, size: int, compress_dir: Optional[Path]) -> _SiteFile:
+    """
+    Hash a file ready for upload, if `compress_dir` is set text files are first gzipped into that directory.
+
+    Compressed copies are only used if they're smaller than the original.
+    """
+    if compress_dir is not None and size >= MIN_COMPRESS_SIZE and _is_compressible(get_content_type(url_path)):
+        gz_path = compress_dir / f'{hashlib.sha1(url_path.encode()).hexdigest()}.gz'
+        h = hashlib.sha256()
+        # gzip with no timestamp, so the same content always compresses to the same bytes and hash
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+        with file_path.open('rb') as src, gz_path.open('wb') as dst:
+            while chunk := src.read(UPLOAD_CHUNK_SIZE):
+                out = compressor.compress(chunk)
+                h.update(out)
+                dst.write(out)
+            out = compressor.flush()
+            h.update(out)
+            dst.write(out)
+        gz_size = gz_path.stat().st_size
+        if gz_size < size:
+            return _SiteFile(gz_path, gz_size, base64.b64encode(h.digest()).decode(), 'gzip')
+        gz_path.unlink()
+    return _SiteFile(file_path, size, _file_hash(file_path), None)
+
+
+COMPRESSIBLE_TYPES = {'application/javascript', 'application/json', 'application/xml', 'image/svg+xml'}
+
+
+def _is_compressible(content_type: Optional[str]) -> bool:
+    return content_type is not None and (content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES)
+
+
+@contextmanager
+def _compress_dir(compress: bool) -> Generator[Optional[Path], None, None]:
+    """
+    Temporary directory for compressed copies of files, or `None` if compression is off.
+    """
+    if compress:
+        with tempfile.TemporaryDirectory(prefix='smokeshow-') as tmp_dir:
+            yield Path(tmp_dir)
+    else:
+        yield None
+
+
+class _Optimiser:
+    """
+    Minifies HTML, CSS, JavaScript and JSON files before they're uploaded, see `smokeshow.minify`.
+
+    Files are minified in `executor`, a thread pool if it returns None, results are cached on disk by a hash of the
+    file's content, so files which haven't changed aren't minified again by the next upload, e.g. on CI.
+    """
+
+    def __init__(self, executor: Callable[[], Optional[Executor]], drop_source_maps: bool):
+        self._executor = executor
+        self.drop_source_maps = drop_source_maps
+        self.cache = _optimise_cache_dir()
+        self.cache.mkdir(parents=True, exist_ok=True)
+        # files made smaller, and how many of those were found in the cache
+        self.files = 0
+        self.cached = 0
+
+    async def optimise(self, file_path: Path, url_path: str, size: int) -> tuple[Path, int]:
+        """
+        Get the path and size of the file to upload, a minified copy of `file_path` if that's smaller.
+        """
+        content_type = get_content_type(url_path)
+        if size == 0 or content_type is None or minifier(content_type) is None:
+            return file_path, size
+
+        key = await asyncio.to_thread(self._cache_key, file_path, content_type)
+        min_path = self.cache / key
+        try:
+            min_size = min_path.stat().st_size
+        except FileNotFoundError:
+            cached = False
+            loop = asyncio.get_running_loop()
+            min_size = await loop.run_in_executor(
+                self._executor(), minify_file, file_path, min_path, content_type, self.drop_source_maps
+            )
         else:
-            # root_path is a file
-            print(f'Site created with root {upload_root}\nuploading 1 file...')
-            total_size = await _upload_file(client, secret_key, upload_root, root_path, root_path.name)
+            cached = True
+            # so it's not pruned from the cache while it's still being used
+            os.utime(min_path)
+
+        # an empty file in the cache means minifying didn't make the file smaller
+        if min_size == 0:
+            return file_path, size
+        self.files += 1
+        self.cached += cached
+        return min_path, min_size
 
-        print(f'upload complete ✓ site size {fmt_size(total_size)}')
-        print('go to', upload_root)
-        if github_status_description is not None:
-            state, description = get_github_status_info(root_path, github_status_description, github_coverage_threshold)
-            await set_github_commit_status(client, upload_root, state, description)
+    def _cache_key(self, file_path: Path, content_type: str) -> str:
+        h = hashlib.sha256(f'{MINIFY_VERSION} {content_type} {self.drop_source_maps}\n'.encode())
+        with file_path.open('rb') as f:
+            while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                h.update(chunk)
+        return h.hexdigest()
 
-    return upload_root
 
+def _optimise_cache_dir() -> Path:
+    return cache_dir() / 'optimised'
 
-async def _handle_tasks(tasks: list[asyncio.Task[int]]) -> None:
+
+def _prune_optimise_cache() -> None:
+    """
+    Delete minified files which haven't been used for `OPTIMISE_CACHE_MAX_AGE`.
+    """
+    cutoff = time.time() - OPTIMISE_CACHE_MAX_AGE
+    for path in _optimise_cache_dir().iterdir():
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            # deleted by another process
+            pass
+
+
+def _file_hash(file_path: Path) -> str:
+    """
+    Base64 encoded sha-256 hash of a file's content, this is how the server identifies stored content.
+    """
+    h = hashlib.sha256()
+    with file_path.open('rb') as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            h.update(chunk)
+    return base64.b64encode(h.digest()).decode()
+
+
+class _ArchiveEntry(NamedTuple):
+    file_path: Path
+    url_path: str
+    size: int
+    # if set, the file is linked to content already stored under this hash instead of included in the archive
+    link_hash: Optional[str]
+    content_encoding: Optional[str]
+
+
+def _archive_batches(entries: list[_ArchiveEntry]) -> list[list[_ArchiveEntry]]:
+    """
+    Split entries into batches the server can handle in one request, limited both by the number of files
+    and by their total size.
+    """
+    batches: list[list[_ArchiveEntry]] = []
+    batch: list[_ArchiveEntry] = []
+    batch_size = 0
+    for entry in entries:
+        entry_size = 0 if entry.link_hash else entry.size
+        if batch and (len(batch) >= ARCHIVE_MAX_FILES or batch_size + entry_size > ARCHIVE_MAX_SIZE):
+            batches.append(batch)
+            batch, batch_size = [], 0
+        batch.append(entry)
+        batch_size += entry_size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+async def _upload_archive(
+    client: AsyncClient,
+    throttle: '_Throttle',
+    tracer: '_Tracer',
+    secret_key: str,
+    upload_root: str,
+    entries: list[_ArchiveEntry],
+    gzip: bool,
+) -> tuple[int, set[str]]:
+    """
+    Upload files in a single streamed tar archive, the server unpacks it into individual files.
+
+    Returns the total site size and the paths of any linked files whose content the server no longer has.
+    """
+    headers = {
+        'Authorisation': secret_key,
+        'User-Agent': USER_AGENT,
+        'Content-Type': 'application/gzip' if gzip else 'application/x-tar',
+        # lets the server reserve space for the whole archive at once
+        'Smokeshow-Archive-Size': str(sum(e.size for e in entries)),
+    }
+    url = upload_root + ARCHIVE_PATH
+    try:
+        r = await _send(
+            throttle,
+            tracer,
+            f'archive of {len(entries)} files',
+            # a new archive stream for each attempt
+            lambda: client.post(
+                url, content=_tar_chunks(entries, gzip, tracer), headers=headers, timeout=UPLOAD_FILE_TIMEOUT
+            ),
+            kind='archive',
+            files=len(entries),
+            bytes=sum(0 if e.link_hash else e.size for e in entries),
+        )
+    except HTTPError:
+        print(f'    ERROR! Error uploading archive of {len(entries)} files')
+        raise ValueError(f'Uploading archive of {len(entries)} files failed due to a network error')
+
+    if r.status_code != 200:
+        print(f'    ERROR! archive of {len(entries)} files status={r.status_code} response={r.text}')
+        raise ValueError(f'invalid response from "{url}" status={r.status_code} response={r.text}')
+
+    upload_info = r.json()
+    for f in upload_info['files']:
+        linked = ' linked' if f['linked'] else ''
+        print(f'    {f["path"].lstrip("/")} ct={f["content_type"]} size={fmt_size(f["size"])}{linked}')
+    missing = {m.lstrip('/') for m in upload_info['missing']}
+    return cast(int, upload_info['total_site_size']), missing
+
+
+async def _tar_chunks(entries: list[_ArchiveEntry], gzip: bool, tracer: '_Tracer') -> AsyncIterator[bytes]:
+    """
+    Generate a tar archive, optionally gzipped, reading each file in chunks so the archive is never held in memory.
+
+    The content type, content encoding, and hash for linked files, are stored in PAX headers for the server.
+    """
+    compressor = zlib.compressobj(wbits=31) if gzip else None  # wbits=31 means gzip format
+
+    def compress(data: bytes) -> bytes:
+        return compressor.compress(data) if compressor else data
+
+    for entry in entries:
+        info = tarfile.TarInfo(entry.url_path)
+        pax_headers: dict[str, str] = {}
+        ct = get_content_type(entry.url_path)
+        if ct:
+            pax_headers['SMOKESHOW.content_type'] = ct
+        if entry.content_encoding:
+            pax_headers['SMOKESHOW.content_encoding'] = entry.content_encoding
+        if entry.link_hash:
+            pax_headers['SMOKESHOW.hash'] = entry.link_hash
+        else:
+            info.size = entry.size
+        info.pax_headers = pax_headers
+        yield compress(info.tobuf(tarfile.PAX_FORMAT))
+
+        if not entry.link_hash:
+            read = 0
+            async for chunk in _read_chunks(entry.file_path, tracer):
+                read += len(chunk)
+                yield compress(chunk)
+            if read != entry.size:
+                raise ValueError(f'{entry.file_path} changed size while uploading')
+            yield compress(tarfile.NUL * (-entry.size % tarfile.BLOCKSIZE))
+
+    # end of archive marker
+    yield compress(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+    if compressor:
+        yield compressor.flush()
+
+
+async def _handle_tasks(tasks: list[asyncio.Task[None]]) -> None:
     """cancel all tasks and ignore all exceptions along the way"""
     for task in tasks:
         task.cancel()
@@ -165,22 +1475,46 @@ async def _handle_tasks(tasks: list[asyncio.Task[int]]) -> None:
 
 
 async def _upload_file(
-    client: AsyncClient, secret_key: str, upload_root: str, file_path: Path, rel_path: Union[Path, str]
+    client: AsyncClient,
+    throttle: '_Throttle',
+    tracer: '_Tracer',
+    secret_key: str,
+    upload_root: str,
+    file_path: Path,
+    rel_path: Union[Path, str],
+    content_encoding: Optional[str] = None,
+    size: Optional[int] = None,
+    file_hash: Optional[str] = None,
 ) -> int:
     """
+    `file_hash` is sent so the server can stream the file into storage, rather than reading it into memory to hash it.
+
     Raises:
         ValueError:
             - If the connecting to the host fails or the post request fails in any other way.
             - If the post request yields any other response code than 200
     """
     url_path = str(rel_path)
-    headers = {'Authorisation': secret_key, 'User-Agent': USER_AGENT}
-    ct = get_content_type(url_path)
-    if ct:
-        headers['Content-Type'] = ct
+    headers, ct = _file_headers(secret_key, url_path, content_encoding)
+    # set the length up front, otherwise httpx would fall back to chunked transfer encoding for the streamed body
+    headers['Content-Length'] = content_length = str(file_path.stat().st_size if size is None else size)
+    if file_hash is not None:
+        headers['Smokeshow-Content-Hash'] = file_hash
     try:
-        r2 = await client.post(
-            upload_root + url_path, content=file_path.read_bytes(), headers=headers, timeout=UPLOAD_FILE_TIMEOUT
+        r2 = await _send(
+            throttle,
+            tracer,
+            url_path,
+            # a new stream of the file for each attempt
+            lambda: client.post(
+                upload_root + url_path,
+                content=_read_chunks(file_path, tracer),
+                headers=headers,
+                timeout=UPLOAD_FILE_TIMEOUT,
+            ),
+            kind='upload',
+            path=url_path,
+            bytes=int(content_length),
         )
     except HTTPError:
         print(f'    ERROR! Error uploading file {file_path}')
@@ -195,6 +1529,93 @@ async def _upload_file(
         raise ValueError(f'invalid response from "{url_path}" status={r2.status_code} response={r2.text}')
 
 
+async def _link_file(
+    client: AsyncClient,
+    throttle: '_Throttle',
+    tracer: '_Tracer',
+    secret_key: str,
+    upload_root: str,
+    rel_path: Union[Path, str],
+    file_hash: str,
+    content_encoding: Optional[str] = None,
+) -> Optional[int]:
+    """
+    Add a file to the site using content the server already has stored under `file_hash`.
+
+    Returns `None` if the server no longer has that content, so the file needs to be uploaded instead.
+    """
+    url_path = str(rel_path)
+    headers, ct = _file_headers(secret_key, url_path, content_encoding)
+    headers['Smokeshow-Hash'] = file_hash
+    try:
+        r = await _send(
+            throttle,
+            tracer,
+            url_path,
+            lambda: client.post(upload_root + url_path, headers=headers),
+            kind='link',
+            path=url_path,
+            bytes=0,
+        )
+    except HTTPError:
+        print(f'    ERROR! Error linking file {url_path}')
+        raise ValueError(f'Linking {url_path} failed due to a network error')
+
+    if r.status_code == 200:
+        upload_info = r.json()
+        print(f'    {url_path} ct={ct} size={fmt_size(upload_info["size"])} linked')
+        return cast(int, upload_info['total_site_size'])
+    elif r.status_code == 404:
+        return None
+    else:
+        print(f'    ERROR! {url_path} status={r.status_code} response={r.text}')
+        raise ValueError(f'invalid response from "{url_path}" status={r.status_code} response={r.text}')
+
+
+def _file_headers(
+    secret_key: str, url_path: str, content_encoding: Optional[str]
+) -> tuple[dict[str, str], Optional[str]]:
+    headers = {'Authorisation': secret_key, 'User-Agent': USER_AGENT}
+    ct = get_content_type(url_path)
+    if ct:
+        headers['Content-Type'] = ct
+    if content_encoding:
+        # not "Content-Encoding", the body is stored as it is rather than decoded on the way in
+        headers['Smokeshow-Content-Encoding'] = content_encoding
+    return headers, ct
+
+
+async def _read_chunks(file_path: Path, tracer: '_Tracer') -> AsyncIterator[bytes]:
+    """
+    Stream a file from disk, reads happen in a thread so they don't block other uploads, and only one chunk per
+    upload is held in memory at a time.
+
+    If tracing, a "read" span is recorded with the time spent reading, not waiting for the request to take chunks.
+    """
+    if tracer.on_span is None:
+        with file_path.open('rb') as f:
+            while chunk := await asyncio.to_thread(f.read, UPLOAD_CHUNK_SIZE):
+                yield chunk
+        return
+
+    start = time.time()
+    duration = 0.0
+    size = 0
+    try:
+        with file_path.open('rb') as f:
+            while True:
+                t = time.perf_counter()
+                chunk = await asyncio.to_thread(f.read, UPLOAD_CHUNK_SIZE)
+                duration += time.perf_counter() - t
+                if not chunk:
+                    break
+                size += len(chunk)
+                yield chunk
+    finally:
+        # also recorded if the request stopped reading early
+        tracer.on_span(Span('read', start, duration, {'path': str(file_path), 'bytes': size}))
+
+
 def get_content_type(url: str) -> Optional[str]:
     if re.search(r'\.(js|css)\.map$', url):
         return 'application/json'
@@ -204,6 +1625,7 @@ def get_content_type(url: str) -> Optional[str]:
 
 KB = 1024
 MB = KB**2
+UPLOAD_CHUNK_SIZE = 64 * KB
 
 
 def fmt_size(num: int) -> str:
@@ -222,6 +1644,10 @@ COVERAGE_REGEXES = (
     # for diff-cover
     re.compile(r'<li><b>Coverage</b>: *([\d.]+)%</li>'),
 )
+# all of COVERAGE_REGEXES, so HTML reports are only searched once
+COVERAGE_HTML_REGEX = re.compile('|'.join(r.pattern for r in COVERAGE_REGEXES))
+# the "totals" object in coverage.py's JSON report, which contains no nested objects
+COVERAGE_JSON_REGEX = re.compile(r'"totals":\s*\{[^{}]*?"percent_covered":\s*([\d.]+(?:[eE][-+]?\d+)?)')
 
 
 def get_github_status_info(path: Path, description: str, coverage_threshold: Optional[float]) -> tuple[str, str]:
@@ -230,27 +1656,108 @@ def get_github_status_info(path: Path, description: str, coverage_threshold: Opt
         return state, description
 
     cov_sub = '{COVERAGE NOT FOUND}'
-    index_path = path / 'index.html'
-    if index_path.is_file():
-        for regex in COVERAGE_REGEXES:
-            m = regex.search(index_path.read_text())
-            if m:
-                coverage = float(m.group(1))
-                if coverage_threshold is not None and coverage < coverage_threshold:
-                    state = 'failure'
-                    cov_sub = f'{coverage:0.2f}% < {coverage_threshold:0.2f}%'
-                else:
-                    cov_sub = f'{coverage:0.2f}%'
-                break
+    coverage = find_coverage(path)
+    if coverage is not None:
+        if coverage_threshold is not None and coverage < coverage_threshold:
+            state = 'failure'
+            cov_sub = f'{coverage:0.2f}% < {coverage_threshold:0.2f}%'
+        else:
+            cov_sub = f'{coverage:0.2f}%'
 
     description = re.sub('{coverage-percentage}', cov_sub, description, flags=re.I)
     return state, description
 
 
+def find_coverage(path: Path) -> Optional[float]:
+    """
+    Find the total coverage percentage from a report in the directory `path`, the first of:
+    * coverage.py or diff-cover HTML, `index.html`
+    * coverage.py JSON, `coverage.json`
+    * Cobertura XML, `coverage.xml` or `cobertura.xml`
+    * lcov, `lcov.info` or `coverage.lcov`
+
+    Each file is streamed, and only read as far as the coverage figure.
+    """
+    for name, parse in COVERAGE_REPORTS:
+        report_path = path / name
+        if report_path.is_file():
+            coverage = parse(report_path)
+            if coverage is not None:
+                return coverage
+    return None
+
+
+def _html_coverage(path: Path) -> Optional[float]:
+    m = _search_file(path, COVERAGE_HTML_REGEX)
+    return float(next(g for g in m.groups() if g is not None)) if m else None
+
+
+def _json_coverage(path: Path) -> Optional[float]:
+    m = _search_file(path, COVERAGE_JSON_REGEX)
+    return float(m.group(1)) if m else None
+
+
+def _cobertura_coverage(path: Path) -> Optional[float]:
+    # the overall line rate is on the root element, so parsing stops at the first tag
+    with path.open('rb') as f:
+        try:
+            for _, element in ElementTree.iterparse(f, events=('start',)):
+                line_rate = element.get('line-rate')
+                if element.tag == 'coverage' and line_rate is not None:
+                    return float(line_rate) * 100
+                return None
+        except (ElementTree.ParseError, ValueError):
+            pass
+    return None
+
+
+def _lcov_coverage(path: Path) -> Optional[float]:
+    # lcov has no total, so sum lines found (LF) and lines hit (LH) over every file's record
+    found = hit = 0
+    with path.open() as f:
+        try:
+            for line in f:
+                if line.startswith('LF:'):
+                    found += int(line[3:])
+                elif line.startswith('LH:'):
+                    hit += int(line[3:])
+        except ValueError:
+            return None
+    return hit / found * 100 if found else None
+
+
+COVERAGE_REPORTS: tuple[tuple[str, Callable[[Path], Optional[float]]], ...] = (
+    ('index.html', _html_coverage),
+    ('coverage.json', _json_coverage),
+    ('coverage.xml', _cobertura_coverage),
+    ('cobertura.xml', _cobertura_coverage),
+    ('lcov.info', _lcov_coverage),
+    ('coverage.lcov', _lcov_coverage),
+)
+
+
+def _search_file(path: Path, regex: re.Pattern[str]) -> Optional[re.Match[str]]:
+    """
+    Search a file in chunks, stopping at the first match.
+    """
+    # overlap chunks, so matches which span two chunks are still found
+    overlap = 1024
+    buffer = ''
+    with path.open(errors='replace') as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            buffer = buffer[-overlap:] + chunk
+            m = regex.search(buffer)
+            if m:
+                return m
+    return None
+
+
 async def set_github_commit_status(client: AsyncClient, target_url: str, state: str, description: str) -> None:
     github_repo = os.environ['GITHUB_REPOSITORY']
     github_sha = os.environ.get('SMOKESHOW_GITHUB_PR_HEAD_SHA') or os.environ['GITHUB_SHA']
-    url = f'{GITHUB_API_ROOT}/repos/{github_repo}/statuses/{github_sha}'
+    # can be changed to use the testing server, see `smokeshow.testing`
+    api_root = os.environ.get('SMOKESHOW_GITHUB_API_ROOT', GITHUB_API_ROOT)
+    url = f'{api_root}/repos/{github_repo}/statuses/{github_sha}'
     print(f'setting status on github.com/{github_repo}#{github_sha:.7}, {state}: "{description}"')
 
     github_token = os.environ['SMOKESHOW_GITHUB_TOKEN']
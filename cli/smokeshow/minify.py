@@ -0,0 +1,170 @@
+"""
+Conservative minifiers for HTML, CSS, JavaScript and JSON, using only the standard library.
+
+They only remove what can't change how a file behaves: comments and whitespace which isn't significant. Content
+which can't be decoded, or isn't valid, is left unchanged.
+
+These run in worker processes, so this module should stay quick to import.
+"""
+
+import json
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import Callable, Optional
+
+__all__ = 'MINIFY_VERSION', 'minifier', 'minify_file', 'minify_html', 'minify_css', 'minify_js', 'minify_json'
+
+# part of the cache key for minified files, increment when the output of any minifier changes
+MINIFY_VERSION = 2
+
+# content is kept exactly as it is inside these elements, and inside tags. Only ASCII whitespace is HTML whitespace,
+# non-breaking spaces are content, so patterns use re.ASCII
+_HTML_WHITESPACE = ' \t\n\r\f'
+_HTML_TOKENS = re.compile(
+    r'(?P<raw><(?P<tag>pre|textarea|script|style)(?=[\s/>]).*?</(?P=tag)\s*>)'
+    # conditional comments are kept, whitespace around a comment is replaced along with it
+    r'|(?P<before>\s*)(?P<comment><!--(?!\[if|<!).*?-->)(?P<after>\s*)'
+    r'|(?P<element></?[a-zA-Z!?](?:"[^"]*"|\'[^\']*\'|[^\'">])*>)'
+    r'|(?P<space>[ \t\r\f]*\n\s*)',
+    re.S | re.I | re.A,
+)
+
+
+def minify_html(html: str, drop_source_maps: bool = False) -> str:
+    """
+    Remove comments, and replace whitespace containing a new line with a single new line, except in `<pre>`,
+    `<textarea>`, `<script>` and `<style>` elements.
+
+    Whitespace without a new line is left alone, so text styled with `white-space: pre` keeps its alignment.
+    """
+
+    def replace(m: 're.Match[str]') -> str:
+        if m['comment']:
+            space = m['before'] + m['after']
+            return '\n' if '\n' in space else space[:1]
+        elif m['space']:
+            return '\n'
+        else:
+            return m[0]
+
+    return _HTML_TOKENS.sub(replace, html).strip(_HTML_WHITESPACE)
+
+
+_CSS_TOKENS = re.compile(
+    r'(?P<string>"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\')'
+    r'|(?P<comment>/\*.*?\*/)'
+    r'|(?P<space>\s+)'
+    r'|(?P<other>[^"\'/\s]+|.)',
+    re.S | re.A,
+)
+# space is never needed after these characters
+_CSS_NO_SPACE_AFTER = frozenset('{};,>:(')
+# or before these, space before ":" is kept since "a :hover" isn't the same as "a:hover"
+_CSS_NO_SPACE_BEFORE = frozenset('{};,>)')
+
+
+def minify_css(css: str, drop_source_maps: bool = False) -> str:
+    """
+    Remove comments other than `/*! ... */`, and whitespace which isn't needed, strings are left untouched.
+    """
+    out: list[str] = []
+    space = False
+    for m in _CSS_TOKENS.finditer(css):
+        token = m[0]
+        if m['space']:
+            space = True
+            continue
+        elif m['comment']:
+            keep = token.startswith('/*!') or (not drop_source_maps and token.startswith('/*# sourceMappingURL='))
+            if not keep:
+                # a comment separates tokens, like whitespace
+                space = True
+                continue
+        elif m['other']:
+            token = re.sub(r';+(?=})', '', token)
+            if token[0] == '}' and out and out[-1][-1] == ';':
+                out[-1] = out[-1].rstrip(';')
+                if not out[-1]:
+                    out.pop()
+        if space and out and out[-1][-1] not in _CSS_NO_SPACE_AFTER and token[0] not in _CSS_NO_SPACE_BEFORE:
+            out.append(' ')
+        out.append(token)
+        space = False
+    return ''.join(out)
+
+
+# only removed from the end of a file, since the same text can appear in strings
+_JS_SOURCE_MAP_COMMENT = re.compile(r'\n?//[#@] sourceMappingURL=[^\n]*\s*\Z')
+
+
+def minify_js(js: str, drop_source_maps: bool = False) -> str:
+    """
+    Remove indentation, trailing whitespace, blank lines and lines which are only a `//` comment, other than the
+    source map comment or a line which could end a block comment.
+
+    JavaScript can't be changed safely without parsing it, except that line by line changes can't affect strings
+    if none of them span lines, so files with template literals or line continuations are left as they are, apart
+    from the source map comment.
+    """
+    if drop_source_maps:
+        js = _JS_SOURCE_MAP_COMMENT.sub('', js)
+    if '`' in js or re.search(r'\\\r?\n', js):
+        return js
+    # only "\n" is split on, str.splitlines() also splits on characters like U+2028 which can appear in strings
+    lines = (line.strip(' \t\r\f\v') for line in js.split('\n'))
+    # new lines are kept, so automatic semicolon insertion works as before
+    return '\n'.join(line for line in lines if line and not _is_line_comment(line))
+
+
+def _is_line_comment(line: str) -> bool:
+    return line.startswith('//') and '*/' not in line and 'sourceMappingURL=' not in line
+
+
+_JSON_TOKENS = re.compile(r'("(?:[^"\\]|\\.)*")|\s+', re.S)
+
+
+def minify_json(text: str, drop_source_maps: bool = False) -> str:
+    """
+    Remove whitespace outside strings, content is otherwise unchanged, e.g. numbers keep their exact form.
+    """
+    json.loads(text)
+    return _JSON_TOKENS.sub(lambda m: m[1] or '', text)
+
+
+_MINIFIERS: dict[str, Callable[[str, bool], str]] = {
+    'text/html': minify_html,
+    'text/css': minify_css,
+    'application/javascript': minify_js,
+    'text/javascript': minify_js,
+    'application/json': minify_json,
+}
+
+
+def minifier(content_type: Optional[str]) -> Optional[Callable[[str, bool], str]]:
+    return _MINIFIERS.get(content_type or '')
+
+
+def minify_file(src: Path, dst: Path, content_type: str, drop_source_maps: bool) -> int:
+    """
+    Minify `src` into `dst`, returning the size of the result. If minifying doesn't make the file smaller,
+    `dst` is left empty, so it can still be cached.
+
+    `dst` is written to a temporary file first, then renamed, so it's never seen incomplete.
+    """
+    data = src.read_bytes()
+    minify = minifier(content_type)
+    assert minify is not None, f'no minifier for {content_type}'
+    try:
+        out = minify(data.decode(), drop_source_maps).encode()
+    except ValueError:
+        # not UTF-8, or not valid JSON
+        out = data
+    if len(out) >= len(data):
+        out = b''
+    fd, tmp_path = tempfile.mkstemp(dir=dst.parent, prefix='.tmp-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(out)
+    os.replace(tmp_path, dst)
+    return len(out)
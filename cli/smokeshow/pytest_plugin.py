@@ -0,0 +1,103 @@
+"""
+pytest plugin which uploads reports, e.g. `htmlcov`, once the test session ends, enabled with `--smokeshow`:
+
+    pytest --cov --cov-report=html --smokeshow htmlcov --smokeshow-github-status 'coverage {coverage-percentage}'
+
+Reports are uploaded in the background, see `smokeshow.detach`, so pytest exits as soon as each site is created,
+run `smokeshow wait` before the CI job ends to wait for the uploads to finish, or use `--smokeshow-wait`.
+
+The auth key and root URL are taken from `SMOKESHOW_AUTH_KEY` and `SMOKESHOW_ROOT_URL`.
+"""
+
+import os
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from .constants import ROOT_URL
+
+__all__ = 'pytest_addoption', 'pytest_unconfigure'
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    group = parser.getgroup('smokeshow', 'upload reports with smokeshow')
+    group.addoption(
+        '--smokeshow',
+        action='append',
+        default=[],
+        metavar='PATH',
+        help='Upload this directory or file when the test session ends, can be used more than once.',
+    )
+    group.addoption(
+        '--smokeshow-github-status',
+        default=None,
+        metavar='DESCRIPTION',
+        help='Set a GitHub commit status with this description once the first path is uploaded.',
+    )
+    group.addoption(
+        '--smokeshow-coverage-threshold',
+        type=float,
+        default=None,
+        help='Set the GitHub commit status to failed if coverage is below this threshold.',
+    )
+    group.addoption(
+        '--smokeshow-wait',
+        action='store_true',
+        default=False,
+        help='Wait for uploads to finish before pytest exits.',
+    )
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_unconfigure(config: pytest.Config) -> None:
+    # reports are written by the controller process when using pytest-xdist, not workers
+    paths: list[str] = config.getoption('smokeshow') or []
+    if not paths or hasattr(config, 'workerinput'):
+        return
+
+    # imported here, so test sessions without --smokeshow don't import the upload code
+    from .detach import start_upload, wait_for_uploads
+
+    job_ids: list[str] = []
+    for i, path_str in enumerate(paths):
+        path = Path(path_str).resolve()
+        if not path.exists():
+            _write(config, f'smokeshow: {path_str} does not exist, not uploaded')
+            continue
+        options: dict[str, Any] = {}
+        if i == 0:
+            options.update(
+                github_status_description=config.getoption('smokeshow_github_status'),
+                github_coverage_threshold=config.getoption('smokeshow_coverage_threshold'),
+            )
+        try:
+            job_id, url = start_upload(
+                path,
+                auth_key=os.getenv('SMOKESHOW_AUTH_KEY'),
+                root_url=os.getenv('SMOKESHOW_ROOT_URL', ROOT_URL),
+                **options,
+            )
+        except Exception as e:
+            # the tests have already run, a failed upload shouldn't hide their result
+            _write(config, f'smokeshow: uploading {path_str} failed, {e}')
+        else:
+            job_ids.append(job_id)
+            _write(config, f'smokeshow: uploading {path_str} to {url}')
+
+    if job_ids and config.getoption('smokeshow_wait'):
+        for job in wait_for_uploads(job_ids):
+            if job['status'] == 'success':
+                _write(config, f'smokeshow: {job["path"]} uploaded to {job["url"]}')
+            else:
+                _write(config, f'smokeshow: uploading {job["path"]} failed, {job["error"]}\n{job["log"]}')
+    elif job_ids:
+        _write(config, f'smokeshow: run "smokeshow wait {" ".join(job_ids)}" to wait for uploads to finish')
+
+
+def _write(config: pytest.Config, line: str) -> None:
+    reporter = config.pluginmanager.get_plugin('terminalreporter')
+    if reporter is not None:
+        reporter.write_line(line)
+    else:
+        print(line)
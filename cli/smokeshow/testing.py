@@ -0,0 +1,554 @@
+"""
+Local stand-in for the smokeshow service, for load testing and rehearsing uploads offline, with configurable
+latency, bandwidth, rate limiting and server errors.
+
+Requires aiohttp, install `smokeshow[testing]`. Run it with:
+
+    python -m smokeshow.testing --port 8000 --latency lognormal:50ms:0.5 --error-rate 0.01
+
+then upload with `SMOKESHOW_ROOT_URL=http://localhost:8000 smokeshow upload ...`, counters of requests are
+served at `/.testing/stats`. Set `SMOKESHOW_GITHUB_API_ROOT` to the server's URL to test setting GitHub statuses.
+
+From Python, use `Server` as an async context manager:
+
+    async with Server(ServerConfig(latency=parse_latency('20ms'))) as server:
+        await upload(path, auth_key='testing', root_url=server.url)
+    print(server.stats.json())
+"""
+
+import asyncio
+import base64
+import gzip
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import secrets
+import string
+import tarfile
+import time
+from collections.abc import Awaitable
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Callable, NamedTuple, Optional
+
+try:
+    from aiohttp import web
+except ImportError as e:  # pragma: no cover
+    raise ImportError('smokeshow.testing requires aiohttp, install "smokeshow[testing]" to use it') from e
+
+from .keys import key_is_valid
+
+__all__ = 'Server', 'ServerConfig', 'Stats', 'parse_latency', 'parse_size'
+
+# limits matching the real service
+MAX_SITE_SIZE = 50 * 1024**2
+MAX_FILE_SIZE = 25 * 1024**2
+SITES_PER_DAY = 200
+UPLOAD_TTL = 3600
+SITE_TTL = 365 * 24 * 3600
+MAX_CHECK_HASHES = 500
+MAX_ARCHIVE_FILES = 300
+PUBLIC_KEY_LENGTH = 20
+INFO_FILE_NAME = '/.smokeshow.json'
+RESERVED_PATH_PREFIX = '/.smokeshow/'
+
+Latency = Callable[[random.Random], float]
+
+
+@dataclass
+class ServerConfig:
+    # seconds to wait before handling each request, see `parse_latency`
+    latency: Latency = field(default=lambda _: 0.0)
+    # bytes per second request bodies are read at, shared by all requests, None for no limit
+    bandwidth: Optional[float] = None
+    # fraction of upload requests (including linking, archives and checking hashes) which get a 429 response
+    rate_limit_rate: float = 0
+    # "Retry-After" header of 429 responses, None to omit it
+    retry_after: Optional[float] = 1
+    # fraction of upload requests which get a 500, 502 or 503 response
+    error_rate: float = 0
+    max_site_size: int = MAX_SITE_SIZE
+    # sites each auth key can create in 24 hours
+    sites_per_day: int = SITES_PER_DAY
+    # seconds after a site is created that files can be uploaded
+    upload_ttl: float = UPLOAD_TTL
+    # only accept auth keys with a valid hash, like the real service
+    check_auth_keys: bool = False
+    # seed for latencies and faults
+    seed: Optional[int] = None
+
+
+@dataclass
+class Stats:
+    # responses by kind of request, then status
+    requests: dict[str, dict[int, int]] = field(default_factory=dict[str, dict[int, int]])
+    bytes_received: int = 0
+    in_flight: int = 0
+    max_in_flight: int = 0
+    sites_created: int = 0
+    # 429 and 5xx responses added by the server's configuration, not the request
+    faults: int = 0
+
+    def count(self, kind: str, status: int) -> None:
+        statuses = self.requests.setdefault(kind, {})
+        statuses[status] = statuses.get(status, 0) + 1
+
+    def json(self) -> str:
+        return json.dumps(self.__dict__, indent=2) + '\n'
+
+
+class _HttpError(Exception):
+    def __init__(self, status: int, message: str, headers: Optional[dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+    def response(self) -> web.Response:
+        return web.Response(text=f'{self.status}: {self.message}', status=self.status, headers=self.headers)
+
+
+class _File(NamedTuple):
+    hash: str
+    size: int
+    content_type: Optional[str]
+    content_encoding: Optional[str]
+
+
+@dataclass
+class _Site:
+    public_key: str
+    secret_key: str
+    url: str
+    creation: float
+    files: dict[str, _File] = field(default_factory=dict[str, _File])
+    # sum of every file uploaded, including any overwritten, as counted by the real service
+    total_size: int = 0
+
+    def info(self) -> dict[str, Any]:
+        return {
+            'url': self.url,
+            'site_creation': _iso_format(self.creation),
+            'site_expiration': _iso_format(self.creation + SITE_TTL),
+        }
+
+
+class Server:
+    """
+    Serves the site creation, upload and site endpoints of smokeshow, plus GitHub's commit status endpoint,
+    everything is kept in memory.
+    """
+
+    def __init__(self, config: Optional[ServerConfig] = None, *, host: str = 'localhost', port: int = 0):
+        self.config = config or ServerConfig()
+        self.host = host
+        self.port = port
+        self.url = ''
+        self.stats = Stats()
+        self.sites: dict[str, _Site] = {}
+        # statuses set with the GitHub API
+        self.statuses: list[dict[str, Any]] = []
+        # content stored by hash, shared by all sites
+        self._content: dict[str, bytes] = {}
+        self._created: dict[str, list[float]] = {}
+        self._random = random.Random(self.config.seed)
+        # when the bandwidth limit allows the next chunk of a request body to be read
+        self._next_read = 0.0
+        self._runner: Optional[web.AppRunner] = None
+
+        self.app = web.Application(middlewares=[self._middleware], client_max_size=1024**3)
+        public_key = f'{{public_key:[a-z0-9]{{{PUBLIC_KEY_LENGTH}}}}}'
+        self.app.add_routes(
+            [
+                web.post('/create/', self._create),
+                web.get('/.testing/stats', self._stats),
+                web.post('/repos/{owner}/{repo}/statuses/{sha}', self._github_status),
+                web.post(f'/{public_key}{{path:/.*}}', self._site_post),
+                web.get(f'/{public_key}{{path:/.*}}', self._site_get),
+            ]
+        )
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.port = self._runner.addresses[0][1]
+        self.url = f'http://{self.host}:{self.port}'
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self) -> 'Server':
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        await self.stop()
+
+    @web.middleware
+    async def _middleware(
+        self, request: web.Request, handler: Callable[[web.Request], Awaitable[web.StreamResponse]]
+    ) -> web.StreamResponse:
+        kind = _request_kind(request)
+        self.stats.in_flight += 1
+        self.stats.max_in_flight = max(self.stats.max_in_flight, self.stats.in_flight)
+        try:
+            await asyncio.sleep(self.config.latency(self._random))
+            fault = self._fault() if request.method == 'POST' and kind not in {'create', 'github'} else None
+            if fault is not None:
+                self.stats.faults += 1
+                await self._read_body(request)
+                response = fault.response()
+            else:
+                try:
+                    response = await handler(request)
+                except _HttpError as e:
+                    response = e.response()
+        finally:
+            self.stats.in_flight -= 1
+        self.stats.count(kind, response.status)
+        return response
+
+    def _fault(self) -> Optional[_HttpError]:
+        r = self._random.random()
+        if r < self.config.rate_limit_rate:
+            retry_after = self.config.retry_after
+            headers = {} if retry_after is None else {'Retry-After': f'{retry_after:g}'}
+            return _HttpError(429, 'Too many requests, injected by the testing server', headers)
+        elif r < self.config.rate_limit_rate + self.config.error_rate:
+            return _HttpError(self._random.choice((500, 502, 503)), 'Server error, injected by the testing server')
+        return None
+
+    async def _read_body(self, request: web.Request) -> bytes:
+        chunks: list[bytes] = []
+        async for chunk in request.content.iter_chunked(64 * 1024):
+            self.stats.bytes_received += len(chunk)
+            chunks.append(chunk)
+            if self.config.bandwidth:
+                # chunks are read one after another at the limit, whichever request they're from
+                now = time.monotonic()
+                self._next_read = max(now, self._next_read) + len(chunk) / self.config.bandwidth
+                await asyncio.sleep(self._next_read - now)
+        return b''.join(chunks)
+
+    async def _create(self, request: web.Request) -> web.Response:
+        auth_key = request.headers.get('authorisation')
+        if not auth_key:
+            raise _HttpError(401, 'Authorisation header required')
+        if self.config.check_auth_keys and not key_is_valid(auth_key):
+            raise _HttpError(403, 'Invalid Authorisation header, you need to generate a key with a valid hash')
+        if not request.headers.get('user-agent'):
+            raise _HttpError(400, 'No "User-Agent" header found')
+
+        now = time.time()
+        created = [t for t in self._created.get(auth_key, []) if t > now - 24 * 3600]
+        if len(created) >= self.config.sites_per_day:
+            raise _HttpError(429, f"You've exceeded the site creation limit of {self.config.sites_per_day} sites.")
+        self._created[auth_key] = created + [now]
+
+        public_key = ''.join(self._random.choice(string.ascii_lowercase + string.digits) for _ in range(20))
+        url = f'{request.url.origin()}/{public_key}/'
+        site = self.sites[public_key] = _Site(public_key, secrets.token_urlsafe(32), url, now)
+        self.stats.sites_created += 1
+        return web.json_response(
+            {
+                'message': 'New site created successfully',
+                'sites_created_24h': len(created) + 1,
+                'secret_key': site.secret_key,
+                'upload_expiration': _iso_format(now + self.config.upload_ttl),
+                **site.info(),
+            }
+        )
+
+    async def _site_post(self, request: web.Request) -> web.Response:
+        site = self._get_site(request)
+        authorisation = re.sub('^bearer ', '', request.headers.get('authorisation', ''), flags=re.I)
+        if not authorisation:
+            raise _HttpError(401, 'Authorisation header required')
+        if authorisation != site.secret_key:
+            raise _HttpError(403, 'Invalid Authorisation header, you need to use the "secret_key" returned')
+        if time.time() > site.creation + self.config.upload_ttl:
+            raise _HttpError(410, 'Too late, uploads are no longer allowed for this site')
+
+        path = request.match_info['path']
+        if path == f'{RESERVED_PATH_PREFIX}check-hashes':
+            return await self._check_hashes(request)
+        elif path == f'{RESERVED_PATH_PREFIX}archive':
+            return await self._archive(request, site)
+        elif path == INFO_FILE_NAME:
+            raise _HttpError(403, f'Overwriting "{INFO_FILE_NAME}" is forbidden')
+        elif path.startswith(RESERVED_PATH_PREFIX):
+            raise _HttpError(403, f'Paths starting "{RESERVED_PATH_PREFIX}" are reserved')
+
+        content_type = request.headers.get('content-type')
+        content_encoding = _check_content_encoding(request.headers.get('smokeshow-content-encoding'))
+        link_hash = request.headers.get('smokeshow-hash')
+        if link_hash:
+            await self._read_body(request)
+            if link_hash not in self._content:
+                raise _HttpError(404, f'No file found with hash "{link_hash}", upload the file\'s content instead')
+            file_hash = link_hash
+        else:
+            # checked before reading the body, as the worker does
+            content_length = request.content_length
+            if content_length is not None and content_length > MAX_FILE_SIZE:
+                raise _HttpError(413, f'Files can be at most {MAX_FILE_SIZE} bytes')
+            if content_length is not None and site.total_size + content_length > self.config.max_site_size:
+                raise _HttpError(429, f"You've exceeded the site size limit of {self.config.max_site_size}.")
+            content_hash = request.headers.get('smokeshow-content-hash')
+            file_hash = self._store(await self._read_body(request))
+            if content_hash and content_hash != file_hash:
+                raise _HttpError(400, 'File content does not match "Smokeshow-Content-Hash"')
+        size = len(self._content[file_hash])
+        self._add_files(site, [(path, _File(file_hash, size, content_type, content_encoding))])
+        return web.json_response(
+            {'path': path, 'content_type': content_type, 'size': size, 'total_site_size': site.total_size}
+        )
+
+    async def _check_hashes(self, request: web.Request) -> web.Response:
+        try:
+            hashes = json.loads(await self._read_body(request))['hashes']
+        except (ValueError, TypeError, KeyError):
+            raise _HttpError(400, 'Invalid JSON body')
+        if not isinstance(hashes, list) or not all(isinstance(h, str) for h in hashes):  # pyright: ignore
+            raise _HttpError(400, '"hashes" must be an array of strings')
+        if len(hashes) > MAX_CHECK_HASHES:  # pyright: ignore[reportUnknownArgumentType]
+            raise _HttpError(413, f'At most {MAX_CHECK_HASHES} hashes can be checked in one request')
+        return web.json_response({'missing': [h for h in hashes if h not in self._content]})  # pyright: ignore
+
+    async def _archive(self, request: web.Request, site: _Site) -> web.Response:
+        if request.content_type not in {'application/x-tar', 'application/gzip'}:
+            raise _HttpError(415, 'Archives must have content-type "application/x-tar" or "application/gzip"')
+        try:
+            declared_size = int(request.headers['smokeshow-archive-size'])
+        except (KeyError, ValueError):
+            raise _HttpError(
+                400, 'The "Smokeshow-Archive-Size" header must be set to the total size of files in the archive'
+            )
+        body = await self._read_body(request)
+        new_files: list[tuple[str, _File]] = []
+        results: list[dict[str, Any]] = []
+        missing: list[str] = []
+        try:
+            with tarfile.open(fileobj=io.BytesIO(body), mode='r:*') as tar:
+                for info in tar:
+                    if not info.isfile():
+                        continue
+                    if len(results) + len(missing) >= MAX_ARCHIVE_FILES:
+                        raise _HttpError(413, f'Archives can contain at most {MAX_ARCHIVE_FILES} files')
+                    path = '/' + info.name.lstrip('/')
+                    content_type = info.pax_headers.get('SMOKESHOW.content_type')
+                    content_encoding = _check_content_encoding(info.pax_headers.get('SMOKESHOW.content_encoding'))
+                    link_hash = info.pax_headers.get('SMOKESHOW.hash')
+                    if link_hash and link_hash not in self._content:
+                        missing.append(path)
+                        continue
+                    extracted = tar.extractfile(info)
+                    file_hash = link_hash or self._store(extracted.read() if extracted else b'')
+                    size = len(self._content[file_hash])
+                    new_files.append((path, _File(file_hash, size, content_type, content_encoding)))
+                    results.append(
+                        {'path': path, 'content_type': content_type, 'size': size, 'linked': bool(link_hash)}
+                    )
+        except tarfile.TarError as e:
+            raise _HttpError(400, f'Invalid archive: {e}')
+        size = sum(f.size for _, f in new_files)
+        if size > declared_size:
+            raise _HttpError(400, 'Files in the archive are larger than "Smokeshow-Archive-Size"')
+        self._add_files(site, new_files)
+        return web.json_response(
+            {'files': results, 'missing': missing, 'size': size, 'total_site_size': site.total_size}
+        )
+
+    def _store(self, content: bytes) -> str:
+        file_hash = base64.b64encode(hashlib.sha256(content).digest()).decode()
+        self._content[file_hash] = content
+        return file_hash
+
+    def _add_files(self, site: _Site, files: list[tuple[str, _File]]) -> None:
+        total_size = site.total_size + sum(f.size for _, f in files)
+        if total_size > self.config.max_site_size:
+            raise _HttpError(429, f"You've exceeded the site size limit of {self.config.max_site_size}.")
+        site.total_size = total_size
+        site.files.update(files)
+
+    async def _site_get(self, request: web.Request) -> web.Response:
+        site = self._get_site(request)
+        path = request.match_info['path']
+        if '.' not in path and not path.endswith('/'):
+            path += '/'
+        if path == INFO_FILE_NAME:
+            return web.json_response({**site.info(), 'files': list(site.files), 'total_site_size': site.total_size})
+
+        status = 200
+        options = [path]
+        if path.endswith('/'):
+            options += [f'{path}index.html', f'{path[:-1]}.html', f'{path}index.json']
+        if path == '/' and len(site.files) == 1:
+            options += list(site.files)
+        found = next((p for p in options if p in site.files), None)
+        if found is None:
+            if path == '/':
+                return web.json_response({'message': f'The site "{site.public_key}" has no index file'})
+            status = 404
+            found = next((p for p in ('/404.html', '/404.txt') if p in site.files), None)
+            if found is None:
+                raise _HttpError(404, f'File "{path}" not found in site "{site.public_key}"')
+
+        f = site.files[found]
+        body = self._content[f.hash]
+        headers = {'content-type': f.content_type or 'application/octet-stream'}
+        if f.content_encoding == 'gzip':
+            headers['vary'] = 'accept-encoding'
+            if 'gzip' in request.headers.get('accept-encoding', ''):
+                headers['content-encoding'] = 'gzip'
+            else:
+                body = gzip.decompress(body)
+        return web.Response(body=body, status=status, headers=headers)
+
+    def _get_site(self, request: web.Request) -> _Site:
+        public_key = request.match_info['public_key']
+        site = self.sites.get(public_key)
+        if site is None:
+            raise _HttpError(404, f'Site "{public_key}" not found')
+        return site
+
+    async def _stats(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.stats.json(), content_type='application/json')
+
+    async def _github_status(self, request: web.Request) -> web.Response:
+        status = {**request.match_info, **await request.json()}
+        self.statuses.append(status)
+        return web.json_response(status, status=201)
+
+
+def _request_kind(request: web.Request) -> str:
+    path = request.path
+    if path == '/create/':
+        return 'create'
+    elif path.startswith('/repos/'):
+        return 'github'
+    elif path.startswith('/.testing/'):
+        return 'stats'
+    elif request.method != 'POST':
+        return 'get'
+    elif path.endswith(f'{RESERVED_PATH_PREFIX}check-hashes'):
+        return 'check-hashes'
+    elif path.endswith(f'{RESERVED_PATH_PREFIX}archive'):
+        return 'archive'
+    elif 'smokeshow-hash' in request.headers:
+        return 'link'
+    else:
+        return 'upload'
+
+
+def _check_content_encoding(content_encoding: Optional[str]) -> Optional[str]:
+    if content_encoding and content_encoding != 'gzip':
+        raise _HttpError(415, f'Unsupported content encoding "{content_encoding}", only "gzip" is supported')
+    return content_encoding or None
+
+
+def _iso_format(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def parse_latency(spec: str) -> Latency:
+    """
+    Parse a latency distribution, durations are in seconds, or with a "ms" or "s" suffix:
+    * `50ms` - always the same
+    * `uniform:10ms:100ms` - uniformly distributed between two durations
+    * `exp:50ms` - exponentially distributed with this mean
+    * `lognormal:50ms:0.5` - log-normally distributed with this median and sigma, a long tail like real networks
+    """
+    kind, *args = spec.split(':')
+    try:
+        if not args:
+            value = _parse_duration(kind)
+            return lambda _: value
+        elif kind == 'uniform' and len(args) == 2:
+            low, high = map(_parse_duration, args)
+            return lambda r: r.uniform(low, high)
+        elif kind == 'exp' and len(args) == 1:
+            mean = _parse_duration(args[0])
+            return lambda r: r.expovariate(1 / mean) if mean else 0
+        elif kind == 'lognormal' and len(args) == 2:
+            median, sigma = _parse_duration(args[0]), float(args[1])
+            return lambda r: r.lognormvariate(math.log(median), sigma) if median else 0
+    except ValueError:
+        pass
+    raise ValueError(f'invalid latency "{spec}", see `parse_latency` for the formats supported')
+
+
+def _parse_duration(value: str) -> float:
+    if value.endswith('ms'):
+        seconds = float(value[:-2]) / 1000
+    else:
+        seconds = float(value[:-1] if value.endswith('s') else value)
+    if seconds < 0:
+        raise ValueError(value)
+    return seconds
+
+
+def parse_size(value: str) -> int:
+    """
+    Parse a size in bytes, with an optional "KB", "MB" or "GB" suffix, e.g. "10MB".
+    """
+    m = re.fullmatch(r'\s*([\d.]+)\s*([KMG]?)B?\s*', value, flags=re.I)
+    if not m:
+        raise ValueError(f'invalid size "{value}"')
+    return int(float(m.group(1)) * 1024 ** ' KMG'.index(m.group(2).upper() or ' '))
+
+
+def main() -> None:
+    from typer import Option, run
+
+    def cli(
+        host: str = Option('localhost', help='Host to listen on.'),
+        port: int = Option(8000, help='Port to listen on.'),
+        latency: str = Option('0', help='Latency of each request, e.g. "50ms" or "lognormal:50ms:0.5".'),
+        bandwidth: Optional[str] = Option(None, help='Bytes per second received across all requests, e.g. "10MB".'),
+        rate_limit_rate: float = Option(0, help='Fraction of upload requests which get a 429 response.'),
+        retry_after: Optional[float] = Option(1, help='"Retry-After" header of 429 responses.'),
+        error_rate: float = Option(0, help='Fraction of upload requests which get a 5xx response.'),
+        max_site_size: str = Option(str(MAX_SITE_SIZE), help='Maximum size of each site, e.g. "50MB".'),
+        sites_per_day: int = Option(SITES_PER_DAY, help='Sites each auth key can create in 24 hours.'),
+        upload_ttl: float = Option(UPLOAD_TTL, help='Seconds after a site is created that files can be uploaded.'),
+        check_auth_keys: bool = Option(False, help='Only accept auth keys with a valid hash.'),
+        seed: Optional[int] = Option(None, help='Seed for random latencies and faults.'),
+    ) -> None:
+        config = ServerConfig(
+            latency=parse_latency(latency),
+            bandwidth=parse_size(bandwidth) if bandwidth else None,
+            rate_limit_rate=rate_limit_rate,
+            retry_after=retry_after,
+            error_rate=error_rate,
+            max_site_size=parse_size(max_site_size),
+            sites_per_day=sites_per_day,
+            upload_ttl=upload_ttl,
+            check_auth_keys=check_auth_keys,
+            seed=seed,
+        )
+        try:
+            asyncio.run(_serve(Server(config, host=host, port=port)))
+        except KeyboardInterrupt:
+            pass
+
+    run(cli)
+
+
+async def _serve(server: Server) -> None:
+    async with server:
+        print(f'smokeshow testing server running at {server.url}, stats at {server.url}/.testing/stats')
+        try:
+            await asyncio.Event().wait()
+        finally:
+            print(f'stats:\n{server.stats.json()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,9 @@
 import asyncio
+import base64
+import hashlib
+import io
 import os
+import tarfile
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 
@@ -14,7 +18,10 @@ from httpx import AsyncClient
 async def create(request: Request):
     now = datetime.now()
     host = request.headers['host']
-    request.app['sites'].append(request.headers['authorisation'])
+    auth_key = request.headers['authorisation']
+    if auth_key in request.app['rate_limited_keys']:
+        return web.Response(text="You've exceeded the site creation limit of 200 sites.", status=429)
+    request.app['sites'].append(auth_key)
     return json_response(
         {
             'message': 'New site created successfully',
@@ -29,11 +36,88 @@ async def create(request: Request):
 
 
 async def upload(request: Request):
-    body = await request.read()
-    request.app['files'][request.path] = {'body': body, 'content-type': request.headers.get('content-type')}
+    # the app is frozen once the server starts, so mutable state lives in a dict
+    uploads = request.app['uploads']
+    # statuses to respond with before accepting the file, to test retries
+    faults = uploads['faults'].get(request.path)
+    if faults:
+        status = faults.pop(0)
+        await request.read()
+        return web.Response(text='Fault', status=status, headers={'Retry-After': '0'} if status == 429 else {})
+    ct = request.headers.get('content-type')
+    encoding = request.headers.get('smokeshow-content-encoding')
+    link_hash = request.headers.get('smokeshow-hash')
+    if link_hash:
+        if link_hash not in request.app['stored']:
+            return web.Response(text='File not found', status=404)
+        body = request.app['stored'][link_hash]
+        request.app['files'][request.path] = file_record(body, ct, encoding, linked=True)
+        return json_response({'size': len(body), 'total_site_size': 1234})
+
+    uploads['in_flight'] += 1
+    uploads['max_in_flight'] = max(uploads['max_in_flight'], uploads['in_flight'])
+    try:
+        if uploads['store_body']:
+            body = await request.read()
+            body_hash = base64.b64encode(hashlib.sha256(body).digest()).decode()
+            # the worker streams the body into storage under this hash, so it must match
+            assert request.headers['smokeshow-content-hash'] == body_hash
+            request.app['stored'][body_hash] = body
+        else:
+            # just count the bytes so the server doesn't hold the whole body in memory
+            size = 0
+            async for chunk in request.content.iter_any():
+                size += len(chunk)
+            body = size
+        if uploads['delay']:
+            await asyncio.sleep(uploads['delay'])
+        request.app['files'][request.path] = file_record(body, ct, encoding)
+    finally:
+        uploads['in_flight'] -= 1
     return json_response({'size': 123, 'total_site_size': 1234})
 
 
+def file_record(body, ct, encoding, linked=False):
+    record = {'body': body, 'content-type': ct}
+    if encoding:
+        record['content-encoding'] = encoding
+    if linked:
+        record['linked'] = True
+    return record
+
+
+async def check_hashes(request: Request):
+    if not request.app['uploads']['check_hashes']:
+        return web.Response(text='Not found', status=404)
+    obj = await request.json()
+    return json_response({'missing': [h for h in obj['hashes'] if h not in request.app['stored']]})
+
+
+async def upload_archive(request: Request):
+    app = request.app
+    app['archives'].append(request.headers['content-type'])
+    body = await request.read()
+    files, missing = [], []
+    with tarfile.open(fileobj=io.BytesIO(body), mode='r:*') as tar:
+        for info in tar:
+            path = f'/testing-site/{info.name}'
+            ct = info.pax_headers.get('SMOKESHOW.content_type')
+            encoding = info.pax_headers.get('SMOKESHOW.content_encoding')
+            link_hash = info.pax_headers.get('SMOKESHOW.hash')
+            if link_hash:
+                if link_hash not in app['stored']:
+                    missing.append(info.name)
+                    continue
+                app['files'][path] = file_record(app['stored'][link_hash], ct, encoding, linked=True)
+            else:
+                file_body = tar.extractfile(info).read()
+                app['stored'][base64.b64encode(hashlib.sha256(file_body).digest()).decode()] = file_body
+                app['files'][path] = file_record(file_body, ct, encoding)
+            files.append({'path': info.name, 'content_type': ct, 'size': info.size, 'linked': bool(link_hash)})
+    assert int(request.headers['smokeshow-archive-size']) >= sum(f['size'] for f in files)
+    return json_response({'files': files, 'missing': missing, 'total_site_size': 1234})
+
+
 async def commit_update(request: Request):
     obj = await request.json()
     request.app['statuses'][request.match_info['path']] = obj
@@ -42,11 +126,19 @@ async def commit_update(request: Request):
 
 routes = [
     web.post('/create/', create),
+    web.post('/testing-site/.smokeshow/check-hashes', check_hashes),
+    web.post('/testing-site/.smokeshow/archive', upload_archive),
     web.post('/testing-site/{file:.*}', upload),
     web.post('/github/{path:.*}', commit_update),
 ]
 
 
+@pytest.fixture(autouse=True)
+def _fix_cache_dir(tmp_path_factory, monkeypatch):
+    # never touch the real cache, e.g. for cached auth keys
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path_factory.mktemp('cache')))
+
+
 @pytest.fixture(name='loop')
 def _fix_loop():
     try:
@@ -85,7 +177,23 @@ class DummyServer:
 
 @pytest.fixture(name='dummy_server')
 def _fix_dummy_server(loop):
-    ctx = {'sites': [], 'files': {}, 'statuses': {}}
+    ctx = {
+        'sites': [],
+        'rate_limited_keys': set(),
+        'files': {},
+        'archives': [],
+        # content stored by hash, shared by all sites
+        'stored': {},
+        'statuses': {},
+        'uploads': {
+            'delay': 0,
+            'store_body': True,
+            'check_hashes': True,
+            'in_flight': 0,
+            'max_in_flight': 0,
+            'faults': {},
+        },
+    }
     ds = loop.run_until_complete(DummyServer.create(loop, ctx))
 
     yield ds
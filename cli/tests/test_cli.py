@@ -1,4 +1,7 @@
+import json
+import os
 import re
+import subprocess
 import sys
 
 import httpx
@@ -6,7 +9,8 @@ import pytest
 from dirty_equals import IsStr
 from typer.testing import CliRunner
 
-from smokeshow.main import cli
+from smokeshow.cli import cli
+from smokeshow.keys import generate_key, key_cache_path, key_is_valid
 
 runner = CliRunner()
 
@@ -19,6 +23,16 @@ def test_help():
     )
 
 
+def test_main_compatibility():
+    # importable from `smokeshow.main`, where they were before the CLI and key generation moved
+    from smokeshow.main import cli as main_cli, generate_key as main_generate_key
+
+    assert main_cli is cli
+    assert main_generate_key is generate_key
+    with pytest.raises(ImportError):
+        from smokeshow.main import missing  # noqa: F401
+
+
 def test_version():
     result = runner.invoke(cli, ['--version'])
     assert result.exit_code == 0
@@ -26,17 +40,90 @@ def test_version():
 
 
 def test_generate_key(mocker):
-    mocker.patch('smokeshow.main.KEY_HASH_THRESHOLD', 2**237)
+    mocker.patch('smokeshow.keys.KEY_HASH_THRESHOLD', 2**237)
 
     result = runner.invoke(cli, ['generate-key'])
     assert result.exit_code == 0
+    assert f'using {os.cpu_count()} process' in result.stdout
     assert 'Success! Key found after' in result.stdout
     assert '    SMOKESHOW_AUTH_KEY=' in result.stdout
 
 
+def test_generate_key_processes(mocker, capsys):
+    mocker.patch('smokeshow.keys.KEY_HASH_THRESHOLD', 2**240)
+
+    key = generate_key(processes=2)
+    assert key_is_valid(key)
+    assert 'using 2 processes...' in capsys.readouterr().out
+
+
+def test_generate_key_single_process(mocker):
+    mocker.patch('smokeshow.keys.KEY_HASH_THRESHOLD', 2**240)
+
+    key = generate_key(processes=1)
+    assert key_is_valid(key)
+
+
+def test_cached_key_unguarded_script(tmp_path):
+    # the key is generated in one process, so a script without `if __name__ == '__main__':` isn't run again
+    script = tmp_path / 'script.py'
+    script.write_text(
+        'import os\n'
+        'from pathlib import Path\n'
+        'import smokeshow.keys\n'
+        # as if there are several cores, so the test doesn't depend on the machine
+        'os.cpu_count = lambda: 2\n'
+        'smokeshow.keys.KEY_HASH_THRESHOLD = 2**240\n'
+        'with Path(__file__).with_name("runs.txt").open("a") as f:\n'
+        '    f.write("run\\n")\n'
+        'smokeshow.keys.get_cached_key()\n'
+    )
+    subprocess.run([sys.executable, str(script)], check=True, timeout=30, capture_output=True)
+    assert (tmp_path / 'runs.txt').read_text() == 'run\n'
+    assert key_cache_path().exists()
+
+
+@pytest.mark.parametrize('key', ['', 'not-base64!', 'dGVzdGluZw'])
+def test_key_not_valid(key):
+    assert not key_is_valid(key)
+
+
+def test_key_show_clear(mocker):
+    mocker.patch('smokeshow.keys.KEY_HASH_THRESHOLD', 2**256)
+
+    result = runner.invoke(cli, ['key', 'show'])
+    assert result.exit_code == 0
+    assert result.stdout == f'No key cached at {key_cache_path()}\n'
+
+    key_cache_path().parent.mkdir(parents=True)
+    key_cache_path().write_text('dGVzdGluZw')
+    result = runner.invoke(cli, ['key', 'show'])
+    assert result.exit_code == 0
+    assert result.stdout == IsStr(
+        regex=r"Key cached at .+, created .+, valid:\n\n    SMOKESHOW_AUTH_KEY='dGVzdGluZw'\n\n"
+    )
+
+    result = runner.invoke(cli, ['key', 'clear'])
+    assert result.exit_code == 0
+    assert result.stdout == f'Cached key at {key_cache_path()} deleted\n'
+    assert not key_cache_path().exists()
+
+    result = runner.invoke(cli, ['key', 'clear'])
+    assert result.exit_code == 0
+    assert result.stdout == f'No key cached at {key_cache_path()}\n'
+
+
+def test_key_show_invalid():
+    key_cache_path().parent.mkdir(parents=True)
+    key_cache_path().write_text('invalid')
+    result = runner.invoke(cli, ['key', 'show'])
+    assert result.exit_code == 0
+    assert 'invalid, it will be replaced next time a key is needed' in result.stdout
+
+
 @pytest.mark.skipif(sys.version_info < (3, 8), reason="Mock doesn't work well with async code in 3.7")
 def test_upload_success(tmp_path, mocker):
-    mocker.patch('smokeshow.main.upload')
+    mocker.patch('smokeshow.main.Uploader.upload')
     f = tmp_path / 'test.html'
     f.write_text('<h1>testing</h1>')
 
@@ -46,7 +133,9 @@ def test_upload_success(tmp_path, mocker):
 
 
 def test_upload_error(tmp_path, mocker):
-    mocker_upload = mocker.patch('smokeshow.main.upload', side_effect=ValueError('intentional error testing upload'))
+    mocker_upload = mocker.patch(
+        'smokeshow.main.Uploader.upload', side_effect=ValueError('intentional error testing upload')
+    )
     f = tmp_path / 'test.html'
     f.write_text('<h1>testing</h1>')
 
@@ -57,6 +146,50 @@ def test_upload_error(tmp_path, mocker):
     mocker_upload.assert_called_once()
 
 
+def test_upload_report(tmp_path, mocker):
+    mocker.patch('smokeshow.main.Uploader.upload', side_effect=ValueError('intentional error testing upload'))
+    (tmp_path / 'site').mkdir()
+    report_file = tmp_path / 'report.json'
+
+    result = runner.invoke(
+        cli, ['upload', str(tmp_path / 'site'), '--report', 'json', '--report-file', str(report_file)]
+    )
+    assert result.exit_code == 1, result.stdout
+    assert result.stdout == f'intentional error testing upload\nreport written to {report_file}\n'
+    assert json.loads(report_file.read_text())['totals']['requests'] == 0
+
+
+def test_upload_multiple_paths(tmp_path, mocker):
+    async def upload(path, **kwargs):
+        if path.name == 'broken':
+            raise ValueError('intentional error testing upload')
+        return f'https://example.com/{path.name}/'
+
+    mocker.patch('smokeshow.main.Uploader.upload', side_effect=upload)
+    for name in 'coverage', 'docs', 'broken':
+        (tmp_path / name).mkdir()
+
+    result = runner.invoke(cli, ['upload', str(tmp_path / 'coverage'), str(tmp_path / 'docs')])
+    assert result.exit_code == 0, result.stdout
+    assert result.stdout == (
+        f'\nsites:\n{tmp_path}/coverage: https://example.com/coverage/\n{tmp_path}/docs: https://example.com/docs/\n'
+    )
+
+    result = runner.invoke(cli, ['upload', str(tmp_path / 'broken'), str(tmp_path / 'docs')])
+    assert result.exit_code == 1, result.stdout
+    assert result.stdout == (
+        f'\nsites:\n{tmp_path}/broken: intentional error testing upload\n'
+        f'{tmp_path}/docs: https://example.com/docs/\n'
+        '1 of 2 uploads failed\n'
+    )
+
+
+def test_upload_multiple_paths_journal(tmp_path):
+    result = runner.invoke(cli, ['upload', str(tmp_path), str(tmp_path), '--journal', str(tmp_path / 'journal')])
+    assert result.exit_code == 1, result.stdout
+    assert result.stdout == '"--journal" can only be used when uploading one path\n'
+
+
 def test_upload_http_error(tmp_path, mocker):
     mocker_upload = mocker.patch.object(
         httpx.AsyncClient, 'post', side_effect=httpx.HTTPError('testing file upload failure')
@@ -69,3 +202,24 @@ def test_upload_http_error(tmp_path, mocker):
     assert result.exit_code == 1, result.stdout
     assert result.stdout == 'Error creating ephemeral site testing file upload failure\n'
     mocker_upload.assert_called_once()
+
+
+# microseconds, generous so slow CI runners don't fail, it's about 0.2s locally, mostly importing typer
+IMPORT_TIME_BUDGET = 500_000
+
+
+def test_version_import_time():
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'smokeshow', '--version'], capture_output=True, text=True, check=True
+    )
+    assert result.stdout == IsStr(regex=r'Smokeshow v\d\.[\d.]+\n')
+    # lines look like "import time: <self us> | <cumulative us> | <indent><module>"
+    imports = {}
+    for line in result.stderr.splitlines():
+        m = re.fullmatch(r'import time:\s+\d+ \|\s+(\d+) \| +(\S+)', line)
+        if m:
+            imports[m.group(2)] = int(m.group(1))
+
+    # only needed for uploading
+    assert {'httpx', 'asyncio', 'smokeshow.main', 'tarfile', 'xml.etree.ElementTree'}.isdisjoint(imports)
+    assert imports['smokeshow.cli'] < IMPORT_TIME_BUDGET
@@ -0,0 +1,154 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+from typer.testing import CliRunner
+
+from smokeshow.cli import cli
+from smokeshow.detach import _run_job, jobs_dir, start_upload, wait_for_uploads
+
+pytest_plugins = 'pytester'
+
+runner = CliRunner()
+
+
+def test_detached_upload(tmp_path, dummy_server, await_):
+    (tmp_path / 'index.html').write_text('<h1>testing</h1>')
+    (tmp_path / 'app.js').write_text('console.log(1)')
+
+    # in threads, so the dummy server keeps running
+    job_id, url = await_(
+        asyncio.to_thread(start_upload, tmp_path, auth_key='testing', root_url=dummy_server.server_name)
+    )
+    assert url == f'{dummy_server.server_name}/testing-site/'
+    assert (jobs_dir() / f'{job_id}.json').exists()
+
+    (job,) = await_(asyncio.to_thread(wait_for_uploads, [job_id], 30))
+    assert job['status'] == 'success', job['log']
+    assert job['url'] == url
+    assert 'Resuming upload to' in job['log']
+    assert sorted(dummy_server.app['files']) == ['/testing-site/app.js', '/testing-site/index.html']
+    assert dummy_server.app['sites'] == ['testing']
+    # finished jobs are deleted
+    assert list(jobs_dir().iterdir()) == []
+
+
+def test_detached_upload_failed(tmp_path, dummy_server, await_):
+    (tmp_path / 'index.html').write_text('<h1>testing</h1>')
+    dummy_server.app['uploads']['faults']['/testing-site/index.html'] = [500]
+
+    job_id, _ = await_(
+        asyncio.to_thread(start_upload, tmp_path, auth_key='testing', root_url=dummy_server.server_name, retries=0)
+    )
+    (job,) = await_(asyncio.to_thread(wait_for_uploads, [job_id], 30))
+    assert job['status'] == 'failed'
+    assert 'status=500' in job['error']
+
+
+def test_process_exited(tmp_path):
+    jobs_dir().mkdir(parents=True)
+    # a process which has already exited, without writing a result
+    pid = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], capture_output=True).stdout
+    (jobs_dir() / 'dead.json').write_text(json.dumps({'id': 'dead', 'path': str(tmp_path), 'pid': int(pid)}))
+
+    (job,) = wait_for_uploads(['dead'], timeout=5)
+    assert job['status'] == 'failed'
+    assert job['error'] == 'The upload process exited without recording a result'
+
+
+def test_wait_timeout(tmp_path):
+    jobs_dir().mkdir(parents=True)
+    (jobs_dir() / 'slow.json').write_text(json.dumps({'id': 'slow', 'path': str(tmp_path), 'cwd': os.getcwd()}))
+
+    (job,) = wait_for_uploads(timeout=0)
+    assert job['status'] == 'running'
+    assert (jobs_dir() / 'slow.json').exists()
+
+    result = runner.invoke(cli, ['wait', '--timeout', '0'])
+    assert result.exit_code == 1, result.stdout
+    assert f'{tmp_path}: still uploading after 0.0s' in result.stdout
+
+
+def test_wait_other_directory(tmp_path):
+    jobs_dir().mkdir(parents=True)
+    # e.g. started by another CI step sharing the cache directory
+    (jobs_dir() / 'other.json').write_text(json.dumps({'id': 'other', 'path': str(tmp_path), 'cwd': str(tmp_path)}))
+
+    assert wait_for_uploads(timeout=0) == []
+    assert (jobs_dir() / 'other.json').exists()
+    (job,) = wait_for_uploads(['other'], timeout=0)
+    assert job['status'] == 'running'
+
+
+def test_detached_upload_resume_failed(tmp_path, dummy_server, await_):
+    (tmp_path / 'index.html').write_text('<h1>testing</h1>')
+    journal = tmp_path / 'journal.jsonl'
+    journal.write_text('invalid')
+    jobs_dir().mkdir(parents=True)
+    job = {'id': 'job', 'path': str(tmp_path), 'root_url': dummy_server.server_name, 'journal': str(journal)}
+    (jobs_dir() / 'job.json').write_text(json.dumps({**job, 'report_file': None, 'options': {}}))
+
+    # as the background process would
+    await_(asyncio.to_thread(_run_job, jobs_dir() / 'job.json'))
+    (job,) = wait_for_uploads(['job'])
+    assert job['status'] == 'failed'
+    assert job['error'] == f'Unable to resume upload, upload journal at {journal} is invalid'
+    # the site the journal was for is the only one which can be uploaded to, no other site is created
+    assert dummy_server.app['sites'] == []
+
+
+def test_wait_unknown():
+    result = runner.invoke(cli, ['wait', 'missing'])
+    assert result.exit_code == 1, result.stdout
+    assert result.stdout == 'No detached upload found with ID "missing"\n'
+
+    result = runner.invoke(cli, ['wait'])
+    assert result.exit_code == 0, result.stdout
+    assert result.stdout == 'No detached uploads found\n'
+
+
+def test_cli_detach(tmp_path, dummy_server, await_):
+    (tmp_path / 'index.html').write_text('<h1>testing</h1>')
+    args = ['upload', str(tmp_path), '--detach', '--auth-key', 'testing', '--root-url', dummy_server.server_name]
+
+    result = await_(asyncio.to_thread(runner.invoke, cli, args))
+    assert result.exit_code == 0, result.stdout
+    url = f'{dummy_server.server_name}/testing-site/'
+    created, url_line, _, message = result.stdout.split('\n', 3)
+    assert created == f'Site created with root {url}'
+    assert url_line == url
+    assert message.startswith('uploading in the background, run "smokeshow wait ')
+
+    result = await_(asyncio.to_thread(runner.invoke, cli, ['wait']))
+    assert result.exit_code == 0, result.stdout
+    assert f'{tmp_path}: {url}\n' in result.stdout
+    assert list(dummy_server.app['files']) == ['/testing-site/index.html']
+
+
+def test_cli_detach_report(tmp_path):
+    result = runner.invoke(cli, ['upload', str(tmp_path), str(tmp_path), '--detach', '--report', 'json'])
+    assert result.exit_code == 1, result.stdout
+    assert result.stdout == '"--report" can only be used with "--detach" when uploading one path\n'
+
+
+def test_pytest_plugin(pytester, tmp_path, dummy_server, await_, env):
+    htmlcov = tmp_path / 'htmlcov'
+    htmlcov.mkdir()
+    (htmlcov / 'index.html').write_text('<h1>coverage</h1>')
+    env.set('SMOKESHOW_AUTH_KEY', 'testing')
+    env.set('SMOKESHOW_ROOT_URL', dummy_server.server_name)
+    pytester.makepyfile('def test_ok():\n    pass\n')
+
+    args = ['--smokeshow', str(htmlcov), '--smokeshow', 'missing', '--smokeshow-wait']
+    result = await_(asyncio.to_thread(pytester.runpytest_subprocess, *args))
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(
+        [
+            f'smokeshow: uploading {htmlcov} to {dummy_server.server_name}/testing-site/',
+            'smokeshow: missing does not exist, not uploaded',
+            f'smokeshow: {htmlcov} uploaded to {dummy_server.server_name}/testing-site/',
+        ]
+    )
+    assert list(dummy_server.app['files']) == ['/testing-site/index.html']
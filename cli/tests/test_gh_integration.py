@@ -1,6 +1,11 @@
+import asyncio
+import json
+import threading
+
 import pytest
 
-from smokeshow.main import get_github_status_info, set_github_commit_status
+from smokeshow import upload
+from smokeshow.main import find_coverage, get_github_status_info, set_github_commit_status
 
 from .conftest import DummyServer, SetEnv
 
@@ -57,6 +62,71 @@ def test_coverage_not_found(tmp_path):
     assert get_github_status_info(tmp_path, 'test {coverage-percentage}', 1) == ('success', 'test {COVERAGE NOT FOUND}')
 
 
+def test_html_chunk_boundary(tmp_path, mocker):
+    mocker.patch('smokeshow.main.UPLOAD_CHUNK_SIZE', 64)
+    f = tmp_path / 'index.html'
+    f.write_text('x' * 50 + '<span class="pc_cov">55.44%</span>' + 'x' * 100)
+    assert find_coverage(tmp_path) == 55.44
+
+
+def test_coverage_json(tmp_path):
+    report = {
+        'meta': {'version': '7.6.1'},
+        'files': {'foo.py': {'summary': {'percent_covered': 12.5}}},
+        'totals': {
+            'covered_lines': 91,
+            'num_statements': 100,
+            'percent_covered': 91.0,
+            'percent_covered_display': '91',
+        },
+    }
+    (tmp_path / 'coverage.json').write_text(json.dumps(report, indent=2))
+    assert get_github_status_info(tmp_path, 'test {coverage-percentage}', 90) == ('success', 'test 91.00%')
+
+
+@pytest.mark.parametrize('name', ['coverage.xml', 'cobertura.xml'])
+def test_cobertura(tmp_path, name):
+    (tmp_path / name).write_text(
+        '<?xml version="1.0" ?>\n'
+        '<coverage version="7.6.1" line-rate="0.8765" branch-rate="0.5">\n'
+        '  <packages><package name="foo" line-rate="0.1"/></packages>\n'
+        '</coverage>'
+    )
+    assert get_github_status_info(tmp_path, 'test {coverage-percentage}', 90) == ('failure', 'test 87.65% < 90.00%')
+
+
+@pytest.mark.parametrize('name', ['lcov.info', 'coverage.lcov'])
+def test_lcov(tmp_path, name):
+    (tmp_path / name).write_text(
+        'TN:\nSF:a.js\nDA:1,1\nLF:10\nLH:9\nend_of_record\nSF:b.js\nLF:30\nLH:21\nend_of_record\n'
+    )
+    assert find_coverage(tmp_path) == 75
+
+
+@pytest.mark.parametrize(
+    'name,content',
+    [
+        ('coverage.json', '{"totals": {}}'),
+        ('coverage.xml', '<coverage>'),
+        ('coverage.xml', '<report line-rate="0.5"/>'),
+        ('coverage.xml', 'not xml'),
+        ('lcov.info', 'SF:a.js\nLF:x\n'),
+        ('lcov.info', 'SF:a.js\nend_of_record\n'),
+    ],
+)
+def test_coverage_invalid(tmp_path, name, content):
+    (tmp_path / name).write_text(content)
+    assert find_coverage(tmp_path) is None
+
+
+def test_coverage_html_first(tmp_path):
+    (tmp_path / 'index.html').write_text('<span class="pc_cov">55%</span>')
+    (tmp_path / 'lcov.info').write_text('LF:10\nLH:9\n')
+    assert find_coverage(tmp_path) == 55
+    (tmp_path / 'index.html').write_text('<h1>no coverage</h1>')
+    assert find_coverage(tmp_path) == 90
+
+
 def test_set_status(env: SetEnv, mocker, dummy_server: DummyServer, await_, async_client):
     mocker.patch('smokeshow.main.GITHUB_API_ROOT', dummy_server.server_name + '/github')
 
@@ -74,3 +144,51 @@ def test_set_status(env: SetEnv, mocker, dummy_server: DummyServer, await_, asyn
             'context': 'smokeshow',
         },
     }
+
+
+def test_upload_set_status(tmp_path, env: SetEnv, mocker, dummy_server: DummyServer, await_):
+    mocker.patch('smokeshow.main.GITHUB_API_ROOT', dummy_server.server_name + '/github')
+    env.set('GITHUB_REPOSITORY', 'samuelcolvin/foobar')
+    env.set('SMOKESHOW_GITHUB_PR_HEAD_SHA', 'abc1234')
+    env.set('SMOKESHOW_GITHUB_TOKEN', 'xxx')
+    (tmp_path / 'index.html').write_text('<span class="pc_cov">55.44%</span>')
+
+    url = await_(
+        upload(
+            tmp_path,
+            auth_key='testing-auth-key',
+            root_url=dummy_server.server_name,
+            github_status_description='coverage {coverage-percentage}',
+            github_coverage_threshold=60,
+        )
+    )
+    assert dummy_server.app['statuses'] == {
+        'repos/samuelcolvin/foobar/statuses/abc1234': {
+            'state': 'failure',
+            'target_url': url,
+            'description': 'coverage 55.44% < 60.00%',
+            'context': 'smokeshow',
+        },
+    }
+
+
+def test_status_cancelled_when_upload_fails(tmp_path, dummy_server: DummyServer, await_, loop, mocker):
+    dummy_server.app['uploads']['faults'] = {'/testing-site/index.html': [503]}
+    (tmp_path / 'index.html').write_text('<h1>testing</h1>')
+    finish_status = threading.Event()
+    mocker.patch('smokeshow.main.get_github_status_info', side_effect=lambda *args: finish_status.wait(5))
+
+    with pytest.raises(ValueError, match='invalid response from "index.html" status=503'):
+        await_(
+            upload(
+                tmp_path,
+                auth_key='testing-auth-key',
+                root_url=dummy_server.server_name,
+                github_status_description='testing',
+                retries=0,
+            )
+        )
+    await_(asyncio.sleep(0))
+    # finding the status was cancelled, rather than left pending
+    assert asyncio.all_tasks(loop) == set()
+    finish_status.set()
@@ -0,0 +1,96 @@
+import pytest
+
+from smokeshow.minify import minify_css, minify_file, minify_html, minify_js, minify_json
+
+
+@pytest.mark.parametrize(
+    'html,expected',
+    [
+        ('<p>\n  <b>x</b>\n  <i>y</i>\n</p>\n', '<p>\n<b>x</b>\n<i>y</i>\n</p>'),
+        ('<p>a   b</p>', '<p>a   b</p>'),
+        ('<p>a <!-- c --> b</p>\n  <!-- c -->\n<p>c</p>', '<p>a b</p>\n<p>c</p>'),
+        ('<p>a<!-- c -->b</p>', '<p>ab</p>'),
+        ('<!--[if IE]><p>ie</p><![endif]-->', '<!--[if IE]><p>ie</p><![endif]-->'),
+        ('<pre>\n  a\n\n    b\n</pre>', '<pre>\n  a\n\n    b\n</pre>'),
+        ('<TEXTAREA>\n  a\n</TEXTAREA>', '<TEXTAREA>\n  a\n</TEXTAREA>'),
+        ('<script>\n  var a = "<!-- x -->";\n</script>', '<script>\n  var a = "<!-- x -->";\n</script>'),
+        ('<div title="a\n   b">x</div>', '<div title="a\n   b">x</div>'),
+        ('<preview>\n  a\n</preview>', '<preview>\na\n</preview>'),
+    ],
+)
+def test_minify_html(html, expected):
+    assert minify_html(html) == expected
+
+
+@pytest.mark.parametrize(
+    'css,expected',
+    [
+        ('a {\n  color: red;\n  margin: 0 auto;\n}\n', 'a{color:red;margin:0 auto}'),
+        ('a , b > c {}', 'a,b>c{}'),
+        ('div :hover {}', 'div :hover{}'),
+        ('a { content: "a  ;  }" }', 'a{content:"a  ;  }"}'),
+        ('/* comment */ a {}', 'a{}'),
+        ('a/**/b {}', 'a b{}'),
+        ('/*! licence */\na {}', '/*! licence */ a{}'),
+        (
+            '@media screen and (max-width: 10px) { a { width: calc(1px + 2px) } }',
+            '@media screen and (max-width:10px){a{width:calc(1px + 2px)}}',
+        ),
+        ('a {}\n/*# sourceMappingURL=a.css.map */', 'a{}/*# sourceMappingURL=a.css.map */'),
+    ],
+)
+def test_minify_css(css, expected):
+    assert minify_css(css) == expected
+
+
+def test_minify_non_breaking_space():
+    # non-breaking spaces are content, not whitespace
+    assert minify_html('<p>\n\xa0\xa0\xa0indented</p>\xa0') == '<p>\n\xa0\xa0\xa0indented</p>\xa0'
+    assert minify_css('a::after { content: x\xa0y; }') == 'a::after{content:x\xa0y}'
+
+
+def test_minify_css_source_map():
+    assert minify_css('a {}\n/*# sourceMappingURL=a.css.map */', True) == 'a{}'
+
+
+@pytest.mark.parametrize(
+    'js,expected',
+    [
+        ('function a() {\n    return 1;  \n}\n\n// comment\n', 'function a() {\nreturn 1;\n}'),
+        ('/* a\n// b */ var c = 1;\n', '/* a\n// b */ var c = 1;'),
+        ('var a = `x\n  y`;\n  var b = 1;\n', 'var a = `x\n  y`;\n  var b = 1;\n'),
+        ('var a = "x\\\n  y";\n', 'var a = "x\\\n  y";\n'),
+        ('var a = 1;\n//# sourceMappingURL=a.js.map\n', 'var a = 1;\n//# sourceMappingURL=a.js.map'),
+        # line separators are allowed in strings, they mustn't be split on
+        ('var a = "c\x85d";\r\n  var b = "e\u2028f";\n', 'var a = "c\x85d";\nvar b = "e\u2028f";'),
+    ],
+)
+def test_minify_js(js, expected):
+    assert minify_js(js) == expected
+
+
+def test_minify_js_source_map():
+    assert minify_js('var a = `x`;\n//# sourceMappingURL=a.js.map\n', True) == 'var a = `x`;'
+    assert minify_js('var a = "//# sourceMappingURL=";\nvar b;', True) == 'var a = "//# sourceMappingURL=";\nvar b;'
+
+
+def test_minify_json():
+    assert minify_json('{\n  "a b": [1.50, 2e3],\n  "c": "x \\" y"\n}') == '{"a b":[1.50,2e3],"c":"x \\" y"}'
+    with pytest.raises(ValueError):
+        minify_json('{"a": ')
+
+
+def test_minify_file(tmp_path):
+    src = tmp_path / 'src.css'
+    src.write_text('a {\n  color: red;\n}\n')
+    dst = tmp_path / 'dst'
+    assert minify_file(src, dst, 'text/css', False) == 12
+    assert dst.read_text() == 'a{color:red}'
+
+    # invalid, or not made smaller
+    src.write_text('{"a": ')
+    assert minify_file(src, dst, 'application/json', False) == 0
+    assert dst.read_bytes() == b''
+    src.write_bytes(b'\xff\n\n\n')
+    assert minify_file(src, dst, 'text/html', False) == 0
+    assert [p.name for p in tmp_path.iterdir()] == ['src.css', 'dst']
@@ -0,0 +1,201 @@
+import gzip
+import random
+import time
+
+import httpx
+import pytest
+
+from smokeshow import upload
+from smokeshow.testing import Server, ServerConfig, parse_latency, parse_size
+
+
+@pytest.fixture(name='server')
+def _fix_server(loop):
+    servers = []
+
+    def start(**kwargs):
+        server = Server(ServerConfig(**kwargs))
+        loop.run_until_complete(server.start())
+        servers.append(server)
+        return server
+
+    yield start
+
+    for server in servers:
+        loop.run_until_complete(server.stop())
+
+
+def test_upload_and_get(tmp_path, server, await_, async_client: httpx.AsyncClient):
+    s = server(latency=parse_latency('1ms'))
+    (tmp_path / 'index.html').write_text('<h1>index</h1>' * 100)
+    (tmp_path / 'docs').mkdir()
+    (tmp_path / 'docs' / 'index.html').write_text('<h1>docs</h1>')
+    (tmp_path / 'copy.html').write_text('<h1>docs</h1>')
+
+    url = await_(upload(tmp_path, auth_key='testing', root_url=s.url, compress=True))
+    assert url.startswith(f'{s.url}/')
+
+    r = await_(async_client.get(url))
+    assert r.status_code == 200
+    assert r.text == '<h1>index</h1>' * 100
+    assert r.headers['content-encoding'] == 'gzip'
+    r = await_(async_client.get(url + 'docs', headers={'accept-encoding': 'identity'}))
+    assert r.status_code == 200
+    assert r.text == '<h1>docs</h1>'
+    r = await_(async_client.get(url + 'missing.html'))
+    assert r.status_code == 404
+    r = await_(async_client.get(url + '.smokeshow.json'))
+    assert sorted(r.json()['files']) == ['/copy.html', '/docs/index.html', '/index.html']
+
+    assert s.stats.sites_created == 1
+    assert s.stats.requests['create'] == {200: 1}
+    assert s.stats.requests['check-hashes'] == {200: 1}
+    assert sum(s.stats.requests['upload'].values()) + sum(s.stats.requests['link'].values()) == 3
+    assert s.stats.bytes_received > 0
+
+
+def test_archive(tmp_path, server, await_):
+    s = server()
+    for i in range(5):
+        (tmp_path / f'{i}.txt').write_text(f'file {i}')
+
+    await_(upload(tmp_path, auth_key='testing', root_url=s.url, archive=True))
+    (site,) = s.sites.values()
+    assert sorted(site.files) == [f'/{i}.txt' for i in range(5)]
+    assert s.stats.requests['archive'] == {200: 1}
+
+
+def test_rate_limit_retried(tmp_path, server, await_):
+    s = server(rate_limit_rate=0.5, retry_after=0, seed=123)
+    for i in range(20):
+        (tmp_path / f'{i}.txt').write_text(f'file {i}')
+
+    await_(upload(tmp_path, auth_key='testing', root_url=s.url, retries=20, retry_budget=1000))
+    (site,) = s.sites.values()
+    assert len(site.files) == 20
+    assert s.stats.faults > 0
+    assert set(s.stats.requests['upload']) == {200, 429}
+
+
+def test_server_errors(tmp_path, server, await_):
+    s = server(error_rate=1)
+    (tmp_path / 'a.txt').write_text('a')
+
+    with pytest.raises(ValueError, match=r'status=50\d response=50\d: Server error, injected by the testing server'):
+        await_(upload(tmp_path, auth_key='testing', root_url=s.url, retries=0))
+    assert s.stats.faults == 1
+
+
+def test_site_size_limit(tmp_path, server, await_):
+    s = server(max_site_size=100)
+    (tmp_path / 'big.txt').write_text('x' * 101)
+
+    with pytest.raises(ValueError, match="You've exceeded the site size limit of 100"):
+        await_(upload(tmp_path, auth_key='testing', root_url=s.url, retries=0))
+
+
+def test_sites_per_day(tmp_path, server, await_):
+    s = server(sites_per_day=1)
+    (tmp_path / 'a.txt').write_text('a')
+
+    await_(upload(tmp_path, auth_key='testing', root_url=s.url))
+    with pytest.raises(ValueError, match="You've exceeded the site creation limit of 1 sites"):
+        await_(upload(tmp_path, auth_key='testing', root_url=s.url))
+
+
+def test_bandwidth(tmp_path, server, await_):
+    s = server(bandwidth=parse_size('200KB'))
+    (tmp_path / 'a.bin').write_bytes(b'x' * 40 * 1024)
+    (tmp_path / 'b.bin').write_bytes(b'y' * 40 * 1024)
+
+    start = time.perf_counter()
+    await_(upload(tmp_path, auth_key='testing', root_url=s.url))
+    # the limit is shared by both uploads
+    assert time.perf_counter() - start >= 0.35
+
+
+def test_github_status(tmp_path, server, await_, env):
+    s = server()
+    (tmp_path / 'index.html').write_text('<h1>index</h1>')
+    env.set('SMOKESHOW_GITHUB_API_ROOT', s.url)
+    env.set('GITHUB_REPOSITORY', 'foo/bar')
+    env.set('GITHUB_SHA', 'abc1234')
+    env.set('SMOKESHOW_GITHUB_TOKEN', 'xxx')
+
+    url = await_(upload(tmp_path, auth_key='testing', root_url=s.url, github_status_description='testing'))
+    assert s.statuses == [
+        {
+            'owner': 'foo',
+            'repo': 'bar',
+            'sha': 'abc1234',
+            'state': 'success',
+            'target_url': url,
+            'description': 'testing',
+            'context': 'smokeshow',
+        }
+    ]
+
+
+def test_upload_expired(tmp_path, server, await_):
+    s = server(upload_ttl=0)
+    (tmp_path / 'a.txt').write_text('a')
+
+    with pytest.raises(ValueError, match='Too late, uploads are no longer allowed for this site'):
+        await_(upload(tmp_path, auth_key='testing', root_url=s.url))
+
+
+def test_parse_latency():
+    r = random.Random(1)
+    assert parse_latency('0')(r) == 0
+    assert parse_latency('50ms')(r) == 0.05
+    assert parse_latency('2s')(r) == 2
+    assert 0.01 <= parse_latency('uniform:10ms:20ms')(r) <= 0.02
+    assert parse_latency('exp:50ms')(r) > 0
+    assert parse_latency('lognormal:50ms:0.5')(r) > 0
+    with pytest.raises(ValueError, match='invalid latency "normal:50ms"'):
+        parse_latency('normal:50ms')
+    with pytest.raises(ValueError, match='invalid latency "-1"'):
+        parse_latency('-1')
+
+
+def test_parse_size():
+    assert parse_size('123') == 123
+    assert parse_size('10KB') == 10 * 1024
+    assert parse_size('1.5mb') == 1536 * 1024
+    with pytest.raises(ValueError, match='invalid size "lots"'):
+        parse_size('lots')
+
+
+def test_gzip_decompressed(server, await_, async_client: httpx.AsyncClient):
+    s = server()
+    body = gzip.compress(b'hello')
+
+    async def post():
+        r = await async_client.post(f'{s.url}/create/', headers={'authorisation': 'x', 'user-agent': 'y'})
+        site = r.json()
+        headers = {'authorisation': site['secret_key'], 'smokeshow-content-encoding': 'gzip'}
+        await async_client.post(site['url'] + 'a.txt', content=body, headers=headers)
+        return await async_client.get(site['url'] + 'a.txt', headers={'accept-encoding': 'identity'})
+
+    r = await_(post())
+    assert r.status_code == 200
+    assert r.content == b'hello'
+
+
+def test_upload_checks(server, await_, async_client: httpx.AsyncClient):
+    s = server(max_site_size=10)
+
+    async def post():
+        r = await async_client.post(f'{s.url}/create/', headers={'authorisation': 'x', 'user-agent': 'y'})
+        site = r.json()
+        url = site['url'] + 'a.txt'
+        headers = {'authorisation': site['secret_key'], 'smokeshow-content-hash': 'wrong'}
+        r1 = await async_client.post(url, content=b'hello', headers=headers)
+        # the length is checked before the body is read
+        r2 = await async_client.post(url, content=b'x' * 11, headers=headers)
+        return r1, r2
+
+    r1, r2 = await_(post())
+    assert r1.status_code == 400, r1.text
+    assert r1.text == '400: File content does not match "Smokeshow-Content-Hash"'
+    assert r2.status_code == 429, r2.text
@@ -1,10 +1,20 @@
+import asyncio
+import gzip
+import json
+import os
 import re
+import subprocess
+import sys
+import time
+import tracemalloc
 
 import httpx
 import pytest
 
-from smokeshow import upload
-from smokeshow.main import fmt_size
+import smokeshow.main
+from smokeshow import Uploader, upload
+from smokeshow.keys import cache_dir, key_cache_path
+from smokeshow.main import MB, Report, _PathFilter, _retry_after, _Throttle, _walk, fmt_size, journal_path
 
 from .conftest import DummyServer
 
@@ -46,6 +56,754 @@ def test_upload_dir(tmp_path, dummy_server: DummyServer, await_):
     }
 
 
+def test_upload_dir_concurrency(tmp_path, dummy_server: DummyServer, await_):
+    dummy_server.app['uploads']['delay'] = 0.01
+    for i in range(10):
+        (tmp_path / f'{i}.txt').write_text(str(i))
+
+    await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name, concurrency=3))
+
+    assert len(dummy_server.app['files']) == 10
+    assert dummy_server.app['uploads']['max_in_flight'] == 3
+
+
+def test_uploader_multiple_sites(tmp_path, dummy_server: DummyServer, await_):
+    dummy_server.app['uploads']['delay'] = 0.01
+    for site in 'a', 'b':
+        (tmp_path / site).mkdir()
+        for i in range(10):
+            (tmp_path / site / f'{site}{i}.txt').write_text(f'{site} {i}')
+    report = Report()
+
+    async def upload_sites():
+        async with Uploader(
+            auth_key='testing-auth-key', root_url=dummy_server.server_name, concurrency=3, on_span=report
+        ) as uploader:
+            return await asyncio.gather(uploader.upload(tmp_path / 'a'), uploader.upload(tmp_path / 'b'))
+
+    assert await_(upload_sites()) == [f'{dummy_server.server_name}/testing-site/'] * 2
+    assert dummy_server.app['sites'] == ['testing-auth-key', 'testing-auth-key']
+    assert len(dummy_server.app['files']) == 20
+    # the limit applies to requests for both sites together
+    assert dummy_server.app['uploads']['max_in_flight'] == 3
+    data = json.loads(report.json())
+    assert {(s['path'], s['error']) for s in data['sites']} == {
+        (str(tmp_path / 'a'), None),
+        (str(tmp_path / 'b'), None),
+    }
+    assert data['totals']['files'] == 20
+
+
+def test_uploader_not_entered(tmp_path, await_):
+    with pytest.raises(RuntimeError, match='Uploader must be used as an async context manager'):
+        await_(Uploader().upload(tmp_path))
+
+
+def test_upload_dir_largest_first(tmp_path, dummy_server: DummyServer, await_):
+    (tmp_path / 'small.txt').write_text('x')
+    (tmp_path / 'large.txt').write_text('x' * 100)
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'medium.txt').write_text('x' * 10)
+
+    await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name, concurrency=1))
+
+    assert list(dummy_server.app['files']) == [
+        '/testing-site/large.txt',
+        '/testing-site/sub/medium.txt',
+        '/testing-site/small.txt',
+    ]
+
+
+def test_upload_invalid_concurrency(tmp_path, await_):
+    with pytest.raises(ValueError, match='concurrency must be at least 1, not 0'):
+        await_(upload(tmp_path, auth_key='testing-auth-key', concurrency=0))
+
+
+def test_upload_pool_limits(tmp_path, dummy_server: DummyServer, await_, mocker):
+    transport = mocker.spy(smokeshow.main, 'AsyncHTTPTransport')
+    (tmp_path / 'index.html').write_text('<h1>testing</h1>')
+
+    await_(
+        upload(
+            tmp_path,
+            auth_key='testing-auth-key',
+            root_url=dummy_server.server_name,
+            concurrency=4,
+            max_connections=2,
+            max_keepalive=1,
+            keepalive_expiry=1,
+        )
+    )
+    assert transport.call_args.kwargs == {
+        'retries': 3,
+        'limits': httpx.Limits(max_connections=2, max_keepalive_connections=1, keepalive_expiry=1),
+        'http2': False,
+    }
+    assert len(dummy_server.app['files']) == 1
+
+
+def test_upload_http2(tmp_path, dummy_server: DummyServer, await_, mocker):
+    pytest.importorskip('h2')
+    transport = mocker.spy(smokeshow.main, 'AsyncHTTPTransport')
+    (tmp_path / 'index.html').write_text('<h1>testing</h1>')
+
+    # the dummy server only speaks HTTP/1.1, which httpx still uses for plain http
+    await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name, http2=True))
+    assert transport.call_args.kwargs['http2'] is True
+    assert transport.call_args.kwargs['limits'] == httpx.Limits(max_connections=20, max_keepalive_connections=20)
+    assert len(dummy_server.app['files']) == 1
+
+
+def test_upload_http2_not_installed(tmp_path, dummy_server: DummyServer, await_, mocker, capsys):
+    mocker.patch('smokeshow.main.find_spec', return_value=None)
+    transport = mocker.spy(smokeshow.main, 'AsyncHTTPTransport')
+    (tmp_path / 'index.html').write_text('<h1>testing</h1>')
+
+    await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name, http2=True))
+    assert 'falling back to HTTP/1.1' in capsys.readouterr().out
+    assert transport.call_args.kwargs['http2'] is False
+    assert len(dummy_server.app['files']) == 1
+
+
+def test_upload_invalid_max_connections(tmp_path, await_):
+    with pytest.raises(ValueError, match='max_connections must be at least 1, not 0'):
+        await_(upload(tmp_path, auth_key='testing-auth-key', max_connections=0))
+
+
+def test_upload_retry(tmp_path, dummy_server: DummyServer, await_, mocker, capsys):
+    mocker.patch('smokeshow.main.RETRY_BASE_DELAY', 0)
+    dummy_server.app['uploads']['faults'] = {'/testing-site/a.css': [503, 429], '/testing-site/b.css': [502]}
+    (tmp_path / 'a.css').write_text('a {}')
+    (tmp_path / 'b.css').write_text('b {}')
+    (tmp_path / 'c.css').write_text('c {}')
+
+    await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name))
+    assert set(dummy_server.app['files']) == {'/testing-site/a.css', '/testing-site/b.css', '/testing-site/c.css'}
+    out = capsys.readouterr().out
+    assert 'a.css failed status=503, retrying in 0.0s' in out
+    assert 'a.css failed status=429, retrying in 0.0s' in out
+    assert 'b.css failed status=502, retrying in 0.0s' in out
+
+
+def test_upload_retries_exhausted(tmp_path, dummy_server: DummyServer, await_, mocker):
+    mocker.patch('smokeshow.main.RETRY_BASE_DELAY', 0)
+    dummy_server.app['uploads']['faults'] = {'/testing-site/a.css': [503] * 3}
+    (tmp_path / 'a.css').write_text('a {}')
+
+    with pytest.raises(ValueError, match='invalid response from "a.css" status=503'):
+        await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name, retries=2))
+    assert dummy_server.app['uploads']['faults'] == {'/testing-site/a.css': []}
+
+
+def test_upload_retry_budget(tmp_path, dummy_server: DummyServer, await_, mocker):
+    mocker.patch('smokeshow.main.RETRY_BASE_DELAY', 0)
+    dummy_server.app['uploads']['faults'] = {'/testing-site/a.css': [503], '/testing-site/b.css': [503]}
+    (tmp_path / 'a.css').write_text('a {}')
+    (tmp_path / 'b.css').write_text('b {}')
+
+    with pytest.raises(ValueError, match='status=503'):
+        await_(
+            upload(
+                tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name, concurrency=1, retry_budget=1
+            )
+        )
+
+
+@pytest.mark.parametrize(
+    'value,expected',
+    [
+        ('2', 2),
+        ('1.5', 1.5),
+        ('-1', 0),
+        ('1000', 60),
+        ('Wed, 21 Oct 2015 07:28:00 GMT', 0),
+        ('not a date', None),
+    ],
+)
+def test_retry_after(value, expected):
+    assert _retry_after(httpx.Response(429, headers={'Retry-After': value})) == expected
+
+
+def test_throttle(await_):
+    async def run():
+        throttle = _Throttle(8, retries=3, retry_budget=10)
+        started = time.monotonic()
+        throttle.rate_limited(started)
+        assert throttle.limit == 4
+        # requests which started before the limit was lowered don't lower it again
+        throttle.rate_limited(started)
+        assert throttle.limit == 4
+        throttle.rate_limited(time.monotonic())
+        assert throttle.limit == 2
+        for _ in range(4):
+            throttle.succeeded()
+        assert 3 < throttle.limit < 4
+
+        async with throttle.slot(), throttle.slot(), throttle.slot():
+            assert throttle.in_flight == 3
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(throttle.slot().__aenter__(), 0.01)
+        assert throttle.in_flight == 0
+
+    await_(run())
+
+
+def test_upload_spans(tmp_path, dummy_server: DummyServer, await_):
+    dummy_server.app['uploads']['faults'] = {'/testing-site/a.css': [503]}
+    (tmp_path / 'index.html').write_text('<h1>testing</h1>')
+    (tmp_path / 'a.css').write_text('body {}')
+    (tmp_path / 'b.css').write_text('body {}')
+
+    spans = []
+    await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name, on_span=spans.append))
+    assert sorted({s.name for s in spans}) == ['create', 'post', 'read', 'scan', 'upload']
+    assert spans[-1].name == 'upload'
+    assert spans[-1].attributes == {
+        'path': str(tmp_path),
+        'url': f'{dummy_server.server_name}/testing-site/',
+        'site_size': 1234,
+    }
+    assert all(s.duration >= 0 for s in spans)
+    scan = next(s for s in spans if s.name == 'scan')
+    assert scan.attributes == {'path': str(tmp_path), 'files': 3, 'bytes': 30}
+
+    requests = sorted((s.attributes for s in spans if s.name == 'post'), key=lambda a: a.get('path', ''))
+    assert requests == [
+        {'kind': 'check-hashes', 'files': 2, 'retries': 0, 'status': 200},
+        {'kind': 'upload', 'path': 'a.css', 'bytes': 7, 'retries': 1, 'status': 200},
+        {'kind': 'link', 'path': 'b.css', 'bytes': 0, 'retries': 0, 'status': 200},
+        {'kind': 'upload', 'path': 'index.html', 'bytes': 16, 'retries': 0, 'status': 200},
+    ]
+    # a.css is read twice, once for each attempt
+    reads = sorted(s.attributes['path'] for s in spans if s.name == 'read')
+    assert reads == [str(tmp_path / 'a.css'), str(tmp_path / 'a.css'), str(tmp_path / 'index.html')]
+
+
+def test_upload_report(tmp_path, dummy_server: DummyServer, await_):
+    dummy_server.app['uploads']['faults'] = {'/testing-site/a.css': [503]}
+    (tmp_path / 'index.html').write_text('<h1>testing</h1>')
+    (tmp_path / 'a.css').write_text('body {}')
+
+    report = Report()
+    await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name, on_span=report))
+    data = json.loads(report.json())
+    assert data['url'] == f'{dummy_server.server_name}/testing-site/'
+    assert data['error'] is None
+    totals = data['totals']
+    assert totals['requests'] == 3
+    assert totals['files'] == 2
+    assert totals['bytes'] == 23
+    assert totals['retries'] == 1
+    assert totals['statuses'] == {'200': 3}
+    assert 0 < totals['latency_p50'] <= totals['latency_p95'] <= totals['wall_time']
+    assert totals['bytes_per_second'] > 0
+    assert set(totals['stages']) == {'create', 'scan', 'read', 'post'}
+    a = next(r for r in data['requests'] if r.get('path') == 'a.css')
+    assert a['retries'] == 1
+    assert a['latency'] > 0
+
+
+def test_upload_resume(tmp_path, dummy_server: DummyServer, await_, capsys):
+    dummy_server.app['uploads']['faults'] = {'/testing-site/c.css': [503]}
+    site = tmp_path / 'site'
+    site.mkdir()
+    (site / 'a.css').write_text('a {}' * 3)
+    (site / 'b.css').write_text('b {}' * 2)
+    (site / 'c.css').write_text('c {}')
+    journal = tmp_path / 'journal.jsonl'
+    kwargs = dict(auth_key='testing-auth-key', root_url=dummy_server.server_name, journal=journal, concurrency=1)
+
+    with pytest.raises(ValueError, match='invalid response from "c.css" status=503'):
+        await_(upload(site, retries=0, **kwargs))
+    assert set(dummy_server.app['files']) == {'/testing-site/a.css', '/testing-site/b.css'}
+    assert journal.stat().st_mode & 0o777 == 0o600
+    lines = [json.loads(line) for line in journal.read_text().splitlines()]
+    assert lines[0]['url'] == f'{dummy_server.server_name}/testing-site/'
+    assert lines[0]['secret_key'] == 'testing'
+    assert [line['path'] for line in lines[1:]] == ['a.css', 'b.css']
+
+    dummy_server.app['files'].clear()
+    (site / 'b.css').write_text('b {} changed')
+    (site / 'd.css').write_text('d {}')
+    capsys.readouterr()
+    url = await_(upload(site, resume=True, **kwargs))
+    assert url == f'{dummy_server.server_name}/testing-site/'
+    # the site wasn't created again, and only new or changed files were uploaded
+    assert dummy_server.app['sites'] == ['testing-auth-key']
+    assert set(dummy_server.app['files']) == {'/testing-site/b.css', '/testing-site/c.css', '/testing-site/d.css'}
+    out = capsys.readouterr().out
+    assert 'Resuming upload to' in out
+    assert '1 files are unchanged since they were uploaded' in out
+
+    # the upload is complete, so the journal is deleted, and another upload creates a new site
+    assert not journal.exists()
+    dummy_server.app['files'].clear()
+    await_(upload(site, resume=True, **kwargs))
+    assert 'no upload journal found at' in capsys.readouterr().out
+    assert dummy_server.app['sites'] == ['testing-auth-key', 'testing-auth-key']
+    assert len(dummy_server.app['files']) == 4
+
+
+def test_upload_resume_file(tmp_path, dummy_server: DummyServer, await_):
+    dummy_server.app['uploads']['faults'] = {'/testing-site/test.html': [503]}
+    f = tmp_path / 'test.html'
+    f.write_text('<h1>testing</h1>')
+    kwargs = dict(auth_key='testing-auth-key', root_url=dummy_server.server_name)
+    with pytest.raises(ValueError, match='invalid response from "test.html" status=503'):
+        await_(upload(f, retries=0, **kwargs))
+    assert journal_path(f, dummy_server.server_name).exists()
+
+    await_(upload(f, resume=True, **kwargs))
+    assert dummy_server.app['sites'] == ['testing-auth-key']
+    assert list(dummy_server.app['files']) == ['/testing-site/test.html']
+    assert not journal_path(f, dummy_server.server_name).exists()
+
+
+@pytest.mark.parametrize(
+    'journal_text,message',
+    [
+        (None, 'no upload journal found at'),
+        ('', 'is invalid, creating a new site'),
+        ('{"url": "https://example.com/x/", "secret_key": "x"}\n', 'is invalid, creating a new site'),
+        ('{"url": "https://example.com/x/", "secret_key": "x", "upload_expiration": 0}\n', 'no longer allowed'),
+    ],
+)
+def test_upload_resume_new_site(tmp_path, dummy_server: DummyServer, await_, capsys, journal_text, message):
+    site = tmp_path / 'site'
+    site.mkdir()
+    (site / 'a.css').write_text('a {}')
+    journal = tmp_path / 'journal.jsonl'
+    if journal_text is not None:
+        journal.write_text(journal_text)
+
+    url = await_(
+        upload(site, auth_key='testing-auth-key', root_url=dummy_server.server_name, journal=journal, resume=True)
+    )
+    assert url == f'{dummy_server.server_name}/testing-site/'
+    assert message in capsys.readouterr().out
+    assert dummy_server.app['sites'] == ['testing-auth-key']
+    assert set(dummy_server.app['files']) == {'/testing-site/a.css'}
+
+
+def test_upload_resume_incomplete_line(tmp_path, dummy_server: DummyServer, await_):
+    # c.css fails both times, so the journal is kept
+    dummy_server.app['uploads']['faults'] = {'/testing-site/c.css': [503, 503]}
+    site = tmp_path / 'site'
+    site.mkdir()
+    (site / 'a.css').write_text('a {}')
+    (site / 'b.css').write_text('b {}')
+    (site / 'c.css').write_text('c {}')
+    journal = tmp_path / 'journal.jsonl'
+    kwargs = dict(
+        auth_key='testing-auth-key', root_url=dummy_server.server_name, journal=journal, concurrency=1, retries=0
+    )
+    with pytest.raises(ValueError, match='status=503'):
+        await_(upload(site, **kwargs))
+    # as if the process was killed while writing the last line
+    journal.write_text(journal.read_text()[:-10])
+    dummy_server.app['files'].clear()
+    # so it's uploaded rather than linked to the content already stored
+    (site / 'b.css').write_text('b {} changed')
+
+    with pytest.raises(ValueError, match='status=503'):
+        await_(upload(site, resume=True, **kwargs))
+    assert list(dummy_server.app['files']) == ['/testing-site/b.css']
+    # the new record starts on a new line, after the incomplete one
+    lines = journal.read_text().splitlines()
+    assert len(lines) == 4
+    assert json.loads(lines[3])['path'] == 'b.css'
+
+
+def test_journals_pruned(tmp_path, dummy_server: DummyServer, await_):
+    journals = cache_dir() / 'journals'
+    journals.mkdir(parents=True)
+    site = {'url': 'https://example.com/x/', 'secret_key': 'x'}
+    (journals / 'expired.jsonl').write_text(json.dumps({**site, 'upload_expiration': time.time() - 10}) + '\n')
+    (journals / 'current.jsonl').write_text(json.dumps({**site, 'upload_expiration': time.time() + 3600}) + '\n')
+    (journals / 'invalid.jsonl').write_text('')
+    os.utime(journals / 'invalid.jsonl', (0, 0))
+    # e.g. a site still being created
+    (journals / 'new.jsonl').write_text('')
+
+    f = tmp_path / 'test.html'
+    f.write_text('<h1>testing</h1>')
+    await_(upload(f, auth_key='testing-auth-key', root_url=dummy_server.server_name))
+    # the journal of the upload is deleted once it's complete
+    assert sorted(p.name for p in journals.iterdir()) == ['current.jsonl', 'new.jsonl']
+
+
+def test_upload_journal_not_writable(tmp_path, dummy_server: DummyServer, await_, capsys, env):
+    site = tmp_path / 'site'
+    site.mkdir()
+    (site / 'a.css').write_text('a {}')
+    # the cache directory can't be created inside a file
+    (tmp_path / 'not-a-dir').write_text('x')
+    env.set('XDG_CACHE_HOME', str(tmp_path / 'not-a-dir'))
+    kwargs = dict(auth_key='testing-auth-key', root_url=dummy_server.server_name)
+
+    # without resume, the journal isn't needed
+    url = await_(upload(site, **kwargs))
+    assert url == f'{dummy_server.server_name}/testing-site/'
+    assert "this upload can't be resumed" in capsys.readouterr().out
+    assert set(dummy_server.app['files']) == {'/testing-site/a.css'}
+
+    # with resume it is, the error is raised before a site is created
+    with pytest.raises(ValueError, match='Unable to write upload journal at'):
+        await_(upload(site, resume=True, **kwargs))
+    with pytest.raises(ValueError, match='Unable to write upload journal at'):
+        await_(upload(site, journal=tmp_path / 'not-a-dir' / 'journal.jsonl', **kwargs))
+    assert dummy_server.app['sites'] == ['testing-auth-key']
+
+
+def test_upload_dedup(tmp_path, dummy_server: DummyServer, await_):
+    (tmp_path / 'index.html').write_text('<h1>testing</h1>')
+    (tmp_path / 'a.css').write_text('body {}')
+    (tmp_path / 'b.css').write_text('body {}')
+
+    await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name))
+    assert dummy_server.app['files'] == {
+        '/testing-site/index.html': {'body': b'<h1>testing</h1>', 'content-type': 'text/html'},
+        '/testing-site/a.css': {'body': b'body {}', 'content-type': 'text/css'},
+        '/testing-site/b.css': {'body': b'body {}', 'content-type': 'text/css', 'linked': True},
+    }
+
+    dummy_server.app['files'].clear()
+    (tmp_path / 'index.html').write_text('<h1>changed</h1>')
+    await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name))
+    assert dummy_server.app['files'] == {
+        '/testing-site/index.html': {'body': b'<h1>changed</h1>', 'content-type': 'text/html'},
+        '/testing-site/a.css': {'body': b'body {}', 'content-type': 'text/css', 'linked': True},
+        '/testing-site/b.css': {'body': b'body {}', 'content-type': 'text/css', 'linked': True},
+    }
+
+
+def test_upload_dedup_not_supported(tmp_path, dummy_server: DummyServer, await_):
+    dummy_server.app['uploads']['check_hashes'] = False
+    (tmp_path / 'a.css').write_text('body {}')
+    (tmp_path / 'b.css').write_text('body {}')
+
+    await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name))
+    assert dummy_server.app['files'] == {
+        '/testing-site/a.css': {'body': b'body {}', 'content-type': 'text/css'},
+        '/testing-site/b.css': {'body': b'body {}', 'content-type': 'text/css'},
+    }
+
+
+def test_upload_link_missing(tmp_path, dummy_server: DummyServer, await_, mocker):
+    # content disappears from the server between checking hashes and linking, e.g. because it expired
+    mocker.patch('smokeshow.main._check_hashes', return_value={'YjaKGiklmzC6wjXA513HAMmzus8VE61XCOT+SmwNZWA='})
+    (tmp_path / 'a.css').write_text('body {}')
+
+    await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name))
+    assert dummy_server.app['files'] == {
+        '/testing-site/a.css': {'body': b'body {}', 'content-type': 'text/css'},
+    }
+
+
+@pytest.mark.parametrize('gzip,content_type', [(True, 'application/gzip'), (False, 'application/x-tar')])
+def test_upload_archive(tmp_path, dummy_server: DummyServer, await_, gzip, content_type):
+    (tmp_path / 'index.html').write_text('<h1>testing</h1>')
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'a.css').write_text('body {}')
+    (tmp_path / 'sub' / 'b.css').write_text('body {}')
+    (tmp_path / 'bar.unknown_extension').write_text('x' * 1000)
+
+    url = await_(
+        upload(
+            tmp_path,
+            auth_key='testing-auth-key',
+            root_url=dummy_server.server_name,
+            archive=True,
+            archive_gzip=gzip,
+        )
+    )
+    assert re.fullmatch(r'http://localhost:\d+/testing-site/', url)
+    # one archive for the uploaded content, one for the duplicate which is linked
+    assert dummy_server.app['archives'] == [content_type, content_type]
+    assert dummy_server.app['files'] == {
+        '/testing-site/index.html': {'body': b'<h1>testing</h1>', 'content-type': 'text/html'},
+        '/testing-site/sub/a.css': {'body': b'body {}', 'content-type': 'text/css'},
+        '/testing-site/sub/b.css': {'body': b'body {}', 'content-type': 'text/css', 'linked': True},
+        '/testing-site/bar.unknown_extension': {'body': b'x' * 1000, 'content-type': None},
+    }
+
+
+def test_upload_archive_batches(tmp_path, dummy_server: DummyServer, await_, mocker):
+    mocker.patch('smokeshow.main.ARCHIVE_MAX_FILES', 3)
+    for i in range(7):
+        (tmp_path / f'{i}.txt').write_text(str(i))
+
+    await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name, archive=True))
+    assert len(dummy_server.app['archives']) == 3
+    assert len(dummy_server.app['files']) == 7
+
+
+def test_upload_archive_link_missing(tmp_path, dummy_server: DummyServer, await_, mocker):
+    mocker.patch('smokeshow.main._check_hashes', return_value={'YjaKGiklmzC6wjXA513HAMmzus8VE61XCOT+SmwNZWA='})
+    (tmp_path / 'a.css').write_text('body {}')
+
+    await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name, archive=True))
+    assert len(dummy_server.app['archives']) == 1
+    assert dummy_server.app['files'] == {
+        '/testing-site/a.css': {'body': b'body {}', 'content-type': 'text/css'},
+    }
+
+
+def test_upload_archive_not_supported(tmp_path, dummy_server: DummyServer, await_):
+    dummy_server.app['uploads']['check_hashes'] = False
+    (tmp_path / 'a.css').write_text('body {}')
+
+    await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name, archive=True))
+    assert dummy_server.app['archives'] == []
+    assert dummy_server.app['files'] == {
+        '/testing-site/a.css': {'body': b'body {}', 'content-type': 'text/css'},
+    }
+
+
+@pytest.mark.parametrize('archive', [False, True])
+def test_upload_compress(tmp_path, dummy_server: DummyServer, await_, archive):
+    html = '<p>testing</p>' * 200
+    (tmp_path / 'index.html').write_text(html)
+    (tmp_path / 'copy.html').write_text(html)
+    (tmp_path / 'small.css').write_text('body {}')
+    (tmp_path / 'data.bin').write_bytes(b'x' * 2000)
+
+    await_(
+        upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name, compress=True, archive=archive)
+    )
+    files = dummy_server.app['files']
+    for path in '/testing-site/index.html', '/testing-site/copy.html':
+        assert gzip.decompress(files[path]['body']).decode() == html
+        assert files[path]['content-type'] == 'text/html'
+        assert files[path]['content-encoding'] == 'gzip'
+    # compression is deterministic, so duplicates can still be linked
+    assert sum(f.get('linked', False) for f in files.values()) == 1
+    # too small, or not a text type
+    assert files['/testing-site/small.css'] == {'body': b'body {}', 'content-type': 'text/css'}
+    assert files['/testing-site/data.bin'] == {'body': b'x' * 2000, 'content-type': 'application/octet-stream'}
+
+
+def test_upload_compress_file(tmp_path, dummy_server: DummyServer, await_):
+    f = tmp_path / 'test.json'
+    f.write_text('[' + '1, ' * 1000 + '1]')
+    await_(upload(f, auth_key='testing-auth-key', root_url=dummy_server.server_name, compress=True))
+    uploaded = dummy_server.app['files']['/testing-site/test.json']
+    assert uploaded['content-encoding'] == 'gzip'
+    assert gzip.decompress(uploaded['body']) == f.read_bytes()
+
+
+def test_upload_optimise(tmp_path, dummy_server: DummyServer, await_, capsys):
+    (tmp_path / 'index.html').write_text(
+        '<html>\n  <!-- comment -->\n  <body>\n    <p>testing</p>\n  </body>\n</html>\n'
+    )
+    (tmp_path / 'style.css').write_text('body {\n  color: red;\n}\n')
+    (tmp_path / 'data.json').write_text('{\n  "a": [1, 2]\n}')
+    (tmp_path / 'app.js').write_text('var x = 1;\n//# sourceMappingURL=app.js.map\n')
+    (tmp_path / 'app.js.map').write_text('{"version": 3}')
+    (tmp_path / 'small.txt').write_text('  not minified  ')
+
+    kwargs = dict(auth_key='testing-auth-key', root_url=dummy_server.server_name, optimise=True)
+    await_(upload(tmp_path, **kwargs))
+    files = dummy_server.app['files']
+    assert files['/testing-site/index.html']['body'] == b'<html>\n<body>\n<p>testing</p>\n</body>\n</html>'
+    assert files['/testing-site/style.css']['body'] == b'body{color:red}'
+    assert files['/testing-site/data.json']['body'] == b'{"a":[1,2]}'
+    assert files['/testing-site/app.js']['body'] == b'var x = 1;\n//# sourceMappingURL=app.js.map'
+    assert files['/testing-site/app.js.map']['body'] == b'{"version":3}'
+    assert files['/testing-site/small.txt']['body'] == b'  not minified  '
+    assert '5 files optimised (0 from cache), saving ' in capsys.readouterr().out
+
+    # the second upload uses minified files from the cache
+    (tmp_path / 'style.css').write_text('body {\n  color: blue;\n}\n')
+    await_(upload(tmp_path, **kwargs))
+    assert dummy_server.app['files']['/testing-site/style.css']['body'] == b'body{color:blue}'
+    assert '5 files optimised (4 from cache), saving ' in capsys.readouterr().out
+
+
+def test_optimise_unguarded_script(tmp_path, dummy_server: DummyServer, await_):
+    # files are minified in this process, so a script without `if __name__ == '__main__':` isn't run again
+    site = tmp_path / 'site'
+    site.mkdir()
+    (site / 'index.html').write_text('<p>\n  testing\n</p>\n')
+    script = tmp_path / 'script.py'
+    script.write_text(
+        'import asyncio\n'
+        'from pathlib import Path\n'
+        'import smokeshow\n'
+        f'asyncio.run(smokeshow.upload(Path({str(site)!r}), auth_key="testing", root_url={dummy_server.server_name!r}, '
+        'optimise=True))\n'
+    )
+    await_(
+        asyncio.to_thread(subprocess.run, [sys.executable, str(script)], check=True, timeout=30, capture_output=True)
+    )
+    assert dummy_server.app['sites'] == ['testing']
+    assert dummy_server.app['files']['/testing-site/index.html']['body'] == b'<p>\ntesting\n</p>'
+
+
+def test_minify_processes(tmp_path, dummy_server: DummyServer, await_):
+    (tmp_path / 'index.html').write_text('<p>\n  testing\n</p>\n')
+
+    await_(upload(tmp_path, auth_key='testing', root_url=dummy_server.server_name, optimise=True, minify_processes=2))
+    assert dummy_server.app['files']['/testing-site/index.html']['body'] == b'<p>\ntesting\n</p>'
+
+    with pytest.raises(ValueError, match='minify_processes must be at least 1, not 0'):
+        Uploader(minify_processes=0)
+
+
+def test_optimise_cache_pruned(tmp_path, dummy_server: DummyServer, await_):
+    site = tmp_path / 'site'
+    site.mkdir()
+    (site / 'index.html').write_text('<p>\n  testing\n</p>\n')
+    cache = cache_dir() / 'optimised'
+    cache.mkdir(parents=True)
+    (cache / 'old').write_text('old')
+    (cache / 'new').write_text('new')
+    os.utime(cache / 'old', (0, 0))
+
+    await_(upload(site, auth_key='testing-auth-key', root_url=dummy_server.server_name, optimise=True))
+    # the minified index.html is added, the entry which hasn't been used for a long time is deleted
+    assert len(list(cache.iterdir())) == 2
+    assert not (cache / 'old').exists()
+    assert (cache / 'new').exists()
+
+
+def test_upload_optimise_compress(tmp_path, dummy_server: DummyServer, await_):
+    html = '<div>\n    <p>testing</p>\n</div>\n' * 100
+    (tmp_path / 'index.html').write_text(html)
+
+    await_(
+        upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name, optimise=True, compress=True)
+    )
+    uploaded = dummy_server.app['files']['/testing-site/index.html']
+    assert uploaded['content-encoding'] == 'gzip'
+    assert (
+        gzip.decompress(uploaded['body']).decode()
+        == '<div>\n<p>testing</p>\n</div>\n' * 99 + '<div>\n<p>testing</p>\n</div>'
+    )
+
+
+def test_upload_drop_source_maps(tmp_path, dummy_server: DummyServer, await_):
+    (tmp_path / 'app.js').write_text('var x = 1;\n//# sourceMappingURL=app.js.map\n')
+    (tmp_path / 'app.js.map').write_text('{"version": 3}')
+
+    kwargs = dict(auth_key='testing-auth-key', root_url=dummy_server.server_name, drop_source_maps=True)
+    await_(upload(tmp_path, **kwargs))
+    # without optimising, files are uploaded as they are
+    files = dummy_server.app['files']
+    assert list(files) == ['/testing-site/app.js']
+    assert files['/testing-site/app.js']['body'] == b'var x = 1;\n//# sourceMappingURL=app.js.map\n'
+
+    await_(upload(tmp_path, **kwargs, optimise=True))
+    assert dummy_server.app['files']['/testing-site/app.js']['body'] == b'var x = 1;'
+
+
+def test_upload_include_exclude(tmp_path, dummy_server: DummyServer, await_):
+    (tmp_path / 'index.html').write_text('index')
+    (tmp_path / 'style.css').write_text('style')
+    (tmp_path / '.gitignore').write_text('*')
+    (tmp_path / '__pycache__').mkdir()
+    (tmp_path / '__pycache__' / 'x.html').write_text('x')
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'a.html').write_text('a')
+    (tmp_path / 'sub' / 'b.html.map').write_text('b')
+
+    await_(
+        upload(
+            tmp_path,
+            auth_key='testing-auth-key',
+            root_url=dummy_server.server_name,
+            include=['*.html', '*.map'],
+            exclude=['sub/*.map'],
+        )
+    )
+    assert set(dummy_server.app['files']) == {'/testing-site/index.html', '/testing-site/sub/a.html'}
+
+
+@pytest.mark.parametrize(
+    'include,exclude,expected',
+    [
+        ((), (), {'a.html', 'b/c.html', 'b/d/e.js', 'f/b/g.html'}),
+        ((), ('b',), {'a.html'}),
+        ((), ('/b',), {'a.html', 'f/b/g.html'}),
+        ((), ('b/',), {'a.html'}),
+        ((), ('*.html',), {'b/d/e.js'}),
+        ((), ('b/**/*.js',), {'a.html', 'b/c.html', 'f/b/g.html'}),
+        (('b/',), (), {'b/c.html', 'b/d/e.js', 'f/b/g.html'}),
+        (('/b/',), ('d/',), {'b/c.html'}),
+        (('**/b/*.html',), (), {'b/c.html', 'f/b/g.html'}),
+        (('?.html',), (), {'a.html', 'b/c.html', 'f/b/g.html'}),
+        (('/?.html',), (), {'a.html'}),
+    ],
+)
+def test_path_filter(tmp_path, include, exclude, expected):
+    for path in 'a.html', 'b/c.html', 'b/d/e.js', 'f/b/g.html':
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text(path)
+    files = [f for dir_files in _walk(tmp_path, _PathFilter(include, exclude), False) for f in dir_files]
+    assert {url_path for _, url_path, _ in files} == expected
+    assert all(size == len(url_path) for _, url_path, size in files)
+
+
+@pytest.mark.parametrize('follow_symlinks', [False, True])
+def test_upload_symlinks(tmp_path, dummy_server: DummyServer, await_, follow_symlinks):
+    (tmp_path / 'site').mkdir()
+    (tmp_path / 'site' / 'index.html').write_text('index')
+    (tmp_path / 'site' / 'loop').symlink_to(tmp_path / 'site')
+    (tmp_path / 'assets').mkdir()
+    (tmp_path / 'assets' / 'a.css').write_text('a')
+    (tmp_path / 'site' / 'assets').symlink_to(tmp_path / 'assets')
+    (tmp_path / 'site' / 'link.html').symlink_to(tmp_path / 'site' / 'index.html')
+
+    await_(
+        upload(
+            tmp_path / 'site',
+            auth_key='testing-auth-key',
+            root_url=dummy_server.server_name,
+            follow_symlinks=follow_symlinks,
+        )
+    )
+    expected = {'/testing-site/index.html', '/testing-site/link.html'}
+    if follow_symlinks:
+        # the link back to the site root is skipped, rather than being followed forever
+        expected.add('/testing-site/assets/a.css')
+    assert set(dummy_server.app['files']) == expected
+
+
+def test_walk_matches_glob(tmp_path):
+    # without follow_symlinks, the same files are found as by `glob('**/*')`, used before scanning with os.scandir,
+    # which follows symlinks to files but not to directories
+    (tmp_path / 'site' / 'docs').mkdir(parents=True)
+    (tmp_path / 'site' / 'index.html').write_text('index')
+    (tmp_path / 'site' / 'docs' / 'page.html').write_text('page')
+    (tmp_path / 'assets').mkdir()
+    (tmp_path / 'assets' / 'a.css').write_text('a')
+    (tmp_path / 'site' / 'assets').symlink_to(tmp_path / 'assets')
+    (tmp_path / 'site' / 'docs' / 'link.html').symlink_to(tmp_path / 'site' / 'index.html')
+    (tmp_path / 'site' / 'docs' / 'up').symlink_to(tmp_path / 'site')
+    root = tmp_path / 'site'
+
+    files = [f for dir_files in _walk(root, _PathFilter((), ()), False) for f in dir_files]
+    globbed = {p.relative_to(root).as_posix() for p in root.glob('**/*') if p.is_file()}
+    assert {url_path for _, url_path, _ in files} == globbed == {'index.html', 'docs/page.html', 'docs/link.html'}
+
+
+def test_upload_memory_ceiling(tmp_path, dummy_server: DummyServer, await_):
+    dummy_server.app['uploads']['store_body'] = False
+    for i in range(4):
+        (tmp_path / f'{i}.bin').write_bytes(bytes([i]) * 8 * MB)
+
+    tracemalloc.start()
+    try:
+        await_(upload(tmp_path, auth_key='testing-auth-key', root_url=dummy_server.server_name, concurrency=4))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert dummy_server.app['files']['/testing-site/0.bin']['body'] == 8 * MB
+    # 32MB is uploaded, bodies are streamed so peak memory should be well below the size of one file
+    assert peak < 8 * MB
+
+
 def test_upload_dir_error(tmp_path, dummy_server: DummyServer, await_, mocker):
     mocker_upload = mocker.patch(
         'smokeshow.main._upload_file', side_effect=ValueError('intentional error testing upload')
@@ -71,7 +829,7 @@ def test_upload_file_http_error(tmp_path, dummy_server: DummyServer, await_, moc
 
 
 def test_upload_generate(mocker, tmp_path, dummy_server: DummyServer, await_):
-    mocker_generate_key = mocker.patch('smokeshow.main.generate_key', return_value='mocked-generate-key')
+    mocker_generate_key = mocker.patch('smokeshow.keys.generate_key', return_value='mocked-generate-key')
 
     f = tmp_path / 'test.html'
     f.write_text('<h1>testing</h1>')
@@ -82,7 +840,79 @@ def test_upload_generate(mocker, tmp_path, dummy_server: DummyServer, await_):
     assert dummy_server.app['files'] == {
         '/testing-site/test.html': {'body': b'<h1>testing</h1>', 'content-type': 'text/html'}
     }
+    # one process, so library users don't get multiprocessing without asking for it
+    mocker_generate_key.assert_called_once_with()
+
+
+def test_upload_cached_key(mocker, tmp_path, dummy_server: DummyServer, await_):
+    mocker.patch('smokeshow.keys.KEY_HASH_THRESHOLD', 2**256)
+    mocker_generate_key = mocker.patch('smokeshow.keys.generate_key', return_value='Y2FjaGVkLWtleQ')
+
+    f = tmp_path / 'test.html'
+    f.write_text('<h1>testing</h1>')
+    await_(upload(f, root_url=dummy_server.server_name))
+    await_(upload(f, root_url=dummy_server.server_name))
+
+    assert dummy_server.app['sites'] == ['Y2FjaGVkLWtleQ', 'Y2FjaGVkLWtleQ']
+    mocker_generate_key.assert_called_once()
+    assert key_cache_path().read_text() == 'Y2FjaGVkLWtleQ'
+
+
+def test_upload_cached_key_invalid(mocker, tmp_path, dummy_server: DummyServer, await_):
+    mocker_generate_key = mocker.patch('smokeshow.keys.generate_key', return_value='new-key')
+    key_cache_path().parent.mkdir(parents=True)
+    key_cache_path().write_text('invalid-key')
+
+    f = tmp_path / 'test.html'
+    f.write_text('<h1>testing</h1>')
+    await_(upload(f, root_url=dummy_server.server_name))
+
+    assert dummy_server.app['sites'] == ['new-key']
     mocker_generate_key.assert_called_once()
+    assert key_cache_path().read_text() == 'new-key'
+
+
+def test_upload_cached_key_rotate(mocker, tmp_path, dummy_server: DummyServer, await_):
+    mocker.patch('smokeshow.keys.KEY_HASH_THRESHOLD', 2**256)
+    mocker_generate_key = mocker.patch('smokeshow.keys.generate_key', return_value='bmV3LWtleQ')
+    key_cache_path().parent.mkdir(parents=True)
+    key_cache_path().write_text('b2xkLWtleQ')
+    dummy_server.app['rate_limited_keys'].add('b2xkLWtleQ')
+
+    f = tmp_path / 'test.html'
+    f.write_text('<h1>testing</h1>')
+    await_(upload(f, root_url=dummy_server.server_name))
+
+    assert dummy_server.app['sites'] == ['bmV3LWtleQ']
+    mocker_generate_key.assert_called_once()
+    assert key_cache_path().read_text() == 'bmV3LWtleQ'
+
+
+def test_upload_cached_key_unwritable(mocker, monkeypatch, tmp_path, dummy_server: DummyServer, await_, capsys):
+    mocker_generate_key = mocker.patch('smokeshow.keys.generate_key', return_value='bmV3LWtleQ')
+    # e.g. a read-only home directory, the cache directory can't be created
+    (tmp_path / 'not-a-directory').write_text('')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'not-a-directory'))
+
+    f = tmp_path / 'test.html'
+    f.write_text('<h1>testing</h1>')
+    await_(upload(f, root_url=dummy_server.server_name))
+
+    assert dummy_server.app['sites'] == ['bmV3LWtleQ']
+    mocker_generate_key.assert_called_once_with()
+    assert f'Unable to use the key cache at {key_cache_path()}, the key will not be cached' in capsys.readouterr().out
+
+
+def test_upload_rate_limited_auth_key(mocker, tmp_path, dummy_server: DummyServer, await_):
+    mocker_generate_key = mocker.patch('smokeshow.keys.generate_key')
+    dummy_server.app['rate_limited_keys'].add('testing-auth-key')
+
+    f = tmp_path / 'test.html'
+    f.write_text('<h1>testing</h1>')
+    with pytest.raises(ValueError, match='Error creating ephemeral site 429'):
+        await_(upload(f, auth_key='testing-auth-key', root_url=dummy_server.server_name))
+
+    mocker_generate_key.assert_not_called()
 
 
 @pytest.mark.parametrize(
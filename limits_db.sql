@@ -1,18 +1,88 @@
--- schema for postgrest database used for limits
+-- schema for postgrest database used for limits, benchmarks/limits/run.sh compares it with the old schema
 
+-- sites are partitioned by month of creation, so partitions of expired sites can be dropped instead of deleting rows,
+-- see maintain_sites, partitions are created ahead of time, the default partition only catches sites if that stops,
+-- and its sites are moved to their month's partition once it's created.
+-- public keys are random so they're not checked for uniqueness, that would need an index covering every partition.
 create table sites (
-  id bigserial primary key,
-  public_key varchar(30) not null unique,
+  id bigserial not null,
+  public_key varchar(30) not null,
   auth_key varchar(72) not null,
   created timestamptz not null default current_timestamp,
   site_size int not null default 0,
   user_agent varchar(200),
-  ip_address varchar(50)
-);
+  ip_address varchar(50),
+  primary key (id, created)
+) partition by range (created);
 create index idx_site_public_key on sites using btree (public_key);
-create index idx_site_auth_key on sites using btree (auth_key);
-create index idx_site_created on sites using btree (created);
+create table sites_default partition of sites default;
+
+-- sites created by each auth key in each hour, so the number created in the last 24 hours is a sum of at most 24 rows
+-- however many sites the key has created
+create table site_counts (
+  auth_key varchar(72) not null,
+  hour timestamptz not null,
+  sites int not null,
+  primary key (auth_key, hour)
+);
+
+-- create monthly partitions of sites covering from_date to to_date, months are in UTC.
+-- sites in the default partition for a month are moved to the new partition, a partition can't be attached while
+-- the default partition has rows which belong in it, so this recovers if partitions weren't created in time.
+create or replace function create_site_partitions(from_date timestamptz, to_date timestamptz) returns void as $$
+  declare
+    month_start timestamptz := date_trunc('month', from_date at time zone 'utc') at time zone 'utc';
+    partition_name text;
+  begin
+    while month_start < to_date loop
+      partition_name := 'sites_' || to_char(month_start at time zone 'utc', 'YYYY_MM');
+      if to_regclass(partition_name) is null then
+        execute format('create table %I (like sites including defaults)', partition_name);
+        execute format(
+          'with moved as (delete from sites_default where created >= %L and created < %L returning *) '
+          'insert into %I select * from moved',
+          month_start,
+          month_start + interval '1 month',
+          partition_name
+        );
+        execute format(
+          'alter table sites attach partition %I for values from (%L) to (%L)',
+          partition_name,
+          month_start,
+          month_start + interval '1 month'
+        );
+      end if;
+      month_start := month_start + interval '1 month';
+    end loop;
+  end;
+$$ language plpgsql;
+
+-- create partitions for the next two months, drop partitions where every site has expired, and delete hourly counts
+-- which are no longer needed. site_ttl is the same as SITE_TTL in the worker.
+-- this needs to run at least monthly, sites are still recorded if it doesn't, but in the default partition.
+create or replace function maintain_sites(site_ttl interval default interval '365 days') returns void as $$
+  declare
+    partition_name text;
+  begin
+    perform create_site_partitions(now(), now() + interval '2 months');
+
+    for partition_name in
+      select c.relname from pg_inherits i join pg_class c on c.oid = i.inhrelid
+      where i.inhparent = 'sites'::regclass and c.relname ~ '^sites_\d{4}_\d{2}$'
+    loop
+      -- the end of the month the partition covers
+      if to_date(substr(partition_name, 7), 'YYYY_MM') + interval '1 month' < now() - site_ttl then
+        execute format('drop table %I', partition_name);
+      end if;
+    end loop;
 
+    delete from sites_default where created < now() - site_ttl;
+    delete from site_counts where hour < now() - interval '24 hours';
+  end;
+$$ language plpgsql;
+
+-- create a site if the auth key has created fewer than max_sites in the last 24 hours (counted in hourly buckets),
+-- returns the number it had created, or null if it's over the limit.
 create or replace function check_new_site(
     public_key text,
     auth_key text,
@@ -22,39 +92,77 @@ create or replace function check_new_site(
   ) returns int as $$
   declare
     site_count int;
-    site_id int;
+    this_hour timestamptz := date_trunc('hour', now());
   begin
-    select count(*) into site_count
-    from sites
-    where sites.auth_key=check_new_site.auth_key and now() - created<interval '24 hours';
-
-    if site_count < max_sites then
-      insert into sites (public_key, auth_key, user_agent, ip_address)
-      values (check_new_site.public_key, check_new_site.auth_key, check_new_site.user_agent, check_new_site.ip_address)
-      on conflict do nothing returning id into site_id;
-      if site_id is not null then
-        return site_count;
-      end if;
+    -- held until the transaction ends, so concurrent creates with the same key are checked one at a time,
+    -- and can't both pass the limit
+    perform pg_advisory_xact_lock('site_counts'::regclass::oid::int, hashtext(check_new_site.auth_key));
+
+    select coalesce(sum(site_counts.sites), 0) into site_count
+    from site_counts
+    where site_counts.auth_key=check_new_site.auth_key and site_counts.hour > this_hour - interval '24 hours';
+
+    if site_count >= max_sites then
+      return null;
     end if;
-    return null;
+
+    insert into sites (public_key, auth_key, user_agent, ip_address)
+    values (check_new_site.public_key, check_new_site.auth_key, check_new_site.user_agent, check_new_site.ip_address);
+    insert into site_counts (auth_key, hour, sites) values (check_new_site.auth_key, this_hour, 1)
+    on conflict on constraint site_counts_pkey do update set sites=site_counts.sites + 1;
+    return site_count;
   end;
 $$ language plpgsql;
 
-create or replace function check_new_file(public_key text, file_size int, size_limit int) returns integer as $$
-  declare
-    current_site_size int;
-    site_id int;
-  begin
-    -- we could do some complex locking here, perhaps with "SHARE UPDATE EXCLUSIVE", not sure it's worth its
-    select sites.id, sites.site_size into site_id, current_site_size
-    from sites
-    where sites.public_key=check_new_file.public_key;
+-- reserve space for a batch of files in one atomic statement, the update takes a row lock, so concurrent reservations
+-- for the same site wait for each other and the limit is checked against the latest site size.
+-- returns the new site size, or null if the files would take the site over the limit.
+-- negative sizes release space which was reserved but not used, that's always allowed.
+-- files can only be uploaded for an hour after a site is created, limiting "created" means only the latest
+-- partitions are searched.
+create or replace function reserve_site_size(public_key text, file_sizes int[], size_limit int) returns int as $$
+  update sites set site_size=sites.site_size + batch.total_size
+  from (select coalesce(sum(f.size), 0) as total_size from unnest(file_sizes) as f(size)) batch
+  where sites.public_key=reserve_site_size.public_key
+    and sites.created > now() - interval '1 day'
+    and (batch.total_size <= 0 or sites.site_size + batch.total_size <= size_limit)
+  returning sites.site_size;
+$$ language sql;
 
-    if current_site_size + file_size > size_limit then
-      return null;
+-- single file version of reserve_site_size, kept for workers deployed before it existed
+create or replace function check_new_file(public_key text, file_size int, size_limit int) returns int as $$
+  select reserve_site_size(check_new_file.public_key, array[file_size], size_limit);
+$$ language sql;
+
+select create_site_partitions(now() - interval '365 days', now());
+select maintain_sites();
+
+-- run maintain_sites daily where pg_cron is available, otherwise it needs to be run some other way at least monthly
+do $$
+  begin
+    if exists (select 1 from pg_extension where extname = 'pg_cron') then
+      perform cron.schedule('maintain-sites', '0 3 * * *', 'select maintain_sites()');
     else
-      update sites set site_size=site_size + file_size where id=site_id returning site_size into current_site_size;
-      return current_site_size;
+      raise warning 'pg_cron is not installed, "select maintain_sites()" must be scheduled some other way, '
+        'at least monthly';
     end if;
   end;
-$$ language plpgsql;
+$$;
+
+-- to migrate a database created with the old, unpartitioned, sites table, move it out of the way first:
+--
+--   alter table sites rename to sites_old;
+--   alter sequence sites_id_seq rename to sites_old_id_seq;
+--   alter index sites_pkey rename to sites_old_pkey;
+--   alter index sites_public_key_key rename to sites_old_public_key_key;
+--   drop index idx_site_public_key, idx_site_auth_key, idx_site_created;
+--
+-- then run this file, copy sites which haven't expired, and count recent sites:
+--
+--   insert into sites (public_key, auth_key, created, site_size, user_agent, ip_address)
+--   select public_key, auth_key, created, site_size, user_agent, ip_address from sites_old
+--   where created > now() - interval '365 days';
+--   insert into site_counts (auth_key, hour, sites)
+--   select auth_key, date_trunc('hour', created), count(*) from sites
+--   where created > now() - interval '24 hours' group by 1, 2;
+--   drop table sites_old;
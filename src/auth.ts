@@ -1,5 +1,5 @@
 import {Env, FullContext, HttpError} from './utils'
-import {AUTH_HASH_THRESHOLD, UPLOAD_TTL} from './constants'
+import {AUTH_HASH_THRESHOLD, UPLOAD_TTL, UPLOAD_GRACE} from './constants'
 
 export async function check_create_auth(request: Request): Promise<string> {
   const auth_key = get_auth_header(request)
@@ -34,6 +34,16 @@ export async function check_upload_auth(public_key: string, {request, env}: Full
   return upload_auth.creation
 }
 
+/**
+ * Check a file can still be added to a site, once its upload has been read. Nothing can be added after this,
+ * so a manifest built once it has passed is final.
+ */
+export function check_upload_deadline(creation_ms: number): void {
+  if (creation_ms + UPLOAD_TTL + UPLOAD_GRACE < Date.now()) {
+    throw new HttpError(410, 'Too late, the upload finished after uploads ended for this site')
+  }
+}
+
 export async function sign_auth(upload_auth: UploadAuth, env: Env): Promise<string> {
   const data = new TextEncoder().encode(JSON.stringify([upload_auth.public_key, upload_auth.creation]))
 
@@ -3,5 +3,23 @@ export const INFO_FILE_NAME = '/.smokeshow.json'
 export const PUBLIC_KEY_LENGTH = 20
 export const SITE_TTL = 365 * 24 * 3600 * 1000
 export const UPLOAD_TTL = 3600 * 1000
+// uploads started before UPLOAD_TTL ends can finish this long after it, the CLI's timeout for one request, files which
+// finish later are rejected
+export const UPLOAD_GRACE = 300 * 1000
 export const SITES_PER_DAY = 200
 export const MAX_SITE_SIZE = 50 * 1024 ** 2
+// the largest value KV can store
+export const MAX_FILE_SIZE = 25 * 1024 ** 2
+// paths under this prefix are used for the upload API rather than files
+export const RESERVED_PATH_PREFIX = '/.smokeshow/'
+export const CHECK_HASHES_PATH = '/.smokeshow/check-hashes'
+export const MAX_CHECK_HASHES = 500
+export const ARCHIVE_PATH = '/.smokeshow/archive'
+// each file needs a few KV operations, this keeps archives well within the limit of operations per request
+export const MAX_ARCHIVE_FILES = 300
+// changes to KV can take this long to be visible everywhere
+export const KV_PROPAGATION_DELAY = 60 * 1000
+// in seconds, manifests built while a site is being uploaded are only kept this long, KV's minimum
+export const TEMPORARY_MANIFEST_TTL = 60
+// more ranges than this in one request are ignored and the whole file is returned
+export const MAX_RANGES = 20
@@ -1,20 +1,54 @@
 /**
  * Logic related to the actual ephemeral sites, e.g. creating them, then adding files and making get requests
  */
-import {INFO_FILE_NAME, PUBLIC_KEY_LENGTH, SITE_TTL, UPLOAD_TTL} from './constants'
+import {
+  INFO_FILE_NAME,
+  PUBLIC_KEY_LENGTH,
+  SITE_TTL,
+  UPLOAD_TTL,
+  RESERVED_PATH_PREFIX,
+  CHECK_HASHES_PATH,
+  MAX_CHECK_HASHES,
+  ARCHIVE_PATH,
+  MAX_ARCHIVE_FILES,
+  MAX_FILE_SIZE,
+} from './constants'
 import {
   HttpError,
   json_response,
   response_from_kv,
+  accepts_gzip,
+  conditional_response,
+  to_cache,
+  from_cache,
+  check_content_encoding,
   KVFile,
   FileMetadata,
+  StoredFileMetadata,
   RequestExtraInfo,
-  list_all,
   Env,
   FullContext,
 } from './utils'
-import {check_create_auth, check_upload_auth, create_random_string, sign_auth, array_to_base64} from './auth'
-import {create_site_check, new_file_check} from './limits'
+import {
+  check_create_auth,
+  check_upload_auth,
+  check_upload_deadline,
+  create_random_string,
+  sign_auth,
+  array_to_base64,
+} from './auth'
+import {create_site_check, new_file_check, reserve_site_size} from './limits'
+import {TarReader, TarEntry} from './tar'
+import {range_response} from './range'
+import {
+  Manifest,
+  get_manifest,
+  current_manifest,
+  get_index_options,
+  resolve_path,
+  site_paths,
+  site_summary,
+} from './manifest'
 
 export async function create_site({request, env}: FullContext, info: RequestExtraInfo): Promise<Response> {
   const auth_key = await check_create_auth(request)
@@ -64,25 +98,83 @@ export async function create_site({request, env}: FullContext, info: RequestExtr
 export async function site_request(c: FullContext, info: RequestExtraInfo): Promise<Response> {
   const {request, env} = c
   const [, public_key, path] = info.match as RegExpMatchArray
-  if (request.method == 'GET') {
-    return await get_file(public_key, path, env)
+  if (request.method == 'GET' || request.method == 'HEAD') {
+    return await get_file(c, public_key, path)
+  } else if (path == CHECK_HASHES_PATH) {
+    return await check_hashes(c, public_key)
+  } else if (path == ARCHIVE_PATH) {
+    return await post_archive(c, public_key)
   } else {
     // method == 'POST'
     return await post_file(c, public_key, path)
   }
 }
 
-function* get_index_options(path: string) {
-  yield `${path}index.html`
-  yield `${path.slice(0, -1)}.html`
-  yield `${path}index.json`
+async function get_file(c: FullContext, public_key: string, path: string): Promise<Response> {
+  const {request} = c
+  // files stored compressed are served differently depending on whether the client accepts gzip
+  const encoding = accepts_gzip(request.headers.get('accept-encoding')) ? 'gzip' : 'identity'
+  const cache_key = `${new URL(request.url).origin}/${public_key}${path}?encoding=${encoding}`
+  const cached = await caches.default.match(cache_key)
+  let response = cached ? from_cache(cached) : await find_file(c, public_key, path, cache_key)
+  response = await range_response(request, conditional_response(request, response))
+  if (request.method == 'HEAD' && response.body) {
+    await response.body.cancel()
+    return new Response(null, {status: response.status, headers: response.headers})
+  }
+  return response
 }
 
-async function get_file(public_key: string, path: string, env: Env): Promise<Response> {
+async function find_file(c: FullContext, public_key: string, path: string, cache_key: string): Promise<Response> {
+  const accept_encoding = c.request.headers.get('accept-encoding')
+  const manifest = await get_manifest(public_key, c)
   if (path === INFO_FILE_NAME) {
-    return json_response(await site_summary(public_key, env))
+    return json_response(summary_or_404(public_key, await current_manifest(public_key, manifest, c.env)))
+  }
+
+  if (manifest) {
+    const resolved = resolve_path(manifest, path)
+    // files may have been uploaded since a manifest was built before uploads ended, so only a final manifest
+    // can say a file doesn't exist or which fallback to use
+    if (resolved === 'summary') {
+      if (manifest.final) {
+        return no_index_response(public_key, manifest)
+      }
+    } else if (resolved === null) {
+      if (manifest.final) {
+        throw new HttpError(404, `File "${path}" not found in site "${public_key}"`)
+      }
+    } else if (manifest.final || resolved.path == path) {
+      const metadata = manifest.files[resolved.path]
+      if (c.request.method == 'HEAD') {
+        // headers come from the metadata alone
+        return response_from_kv({value: null, metadata}, null, resolved.status, accept_encoding)
+      }
+      const v = await get_kv_content(public_key, resolved.path, metadata, c.env)
+      if (v.value) {
+        const response = response_from_kv(v, null, resolved.status, accept_encoding)
+        if (manifest.final && resolved.status == 200) {
+          // the site can't change now, so the response can be cached until the site expires
+          const ttl = Math.round((Date.parse(manifest.info.site_expiration) - Date.now()) / 1000)
+          c.ctx.waitUntil(caches.default.put(cache_key, to_cache(response.clone(), ttl)))
+        }
+        return response
+      }
+    }
   }
+  return await get_file_direct(public_key, path, manifest, c.env, accept_encoding)
+}
 
+/**
+ * Find a file with a read for each option, used when the manifest is missing or may be out of date.
+ */
+async function get_file_direct(
+  public_key: string,
+  path: string,
+  manifest: Manifest | null,
+  env: Env,
+  accept_encoding: string | null,
+): Promise<Response> {
   let v = await get_kv_file(public_key, path, env)
 
   if (!v.value && path.endsWith('/')) {
@@ -98,14 +190,12 @@ async function get_file(public_key: string, path: string, env: Env): Promise<Res
 
     if (!v.value && path == '/') {
       // if there's just one file, return that for index
-      const only_file = await get_only_file(public_key, env)
-      if (only_file) {
-        v = await get_kv_file(public_key, only_file, env)
+      const current = await current_manifest(public_key, manifest, env)
+      const paths = current ? site_paths(current) : []
+      if (paths.length == 1) {
+        v = await get_kv_file(public_key, paths[0], env)
       } else {
-        return json_response({
-          message: `The site "${public_key}" has no index file, hence this summary response`,
-          summary: await site_summary(public_key, env),
-        })
+        return no_index_response(public_key, current)
       }
     }
   }
@@ -123,7 +213,21 @@ async function get_file(public_key: string, path: string, env: Env): Promise<Res
     }
   }
 
-  return response_from_kv(v, null, status)
+  return response_from_kv(v, null, status, accept_encoding)
+}
+
+function no_index_response(public_key: string, manifest: Manifest | null): Response {
+  return json_response({
+    message: `The site "${public_key}" has no index file, hence this summary response`,
+    summary: summary_or_404(public_key, manifest),
+  })
+}
+
+function summary_or_404(public_key: string, manifest: Manifest | null): Record<string, any> {
+  if (!manifest) {
+    throw new HttpError(404, `Site "${public_key}" not found`)
+  }
+  return site_summary(manifest)
 }
 
 async function get_kv_file(public_key: string, path: string, env: Env): Promise<KVFile> {
@@ -141,57 +245,306 @@ async function get_kv_file(public_key: string, path: string, env: Env): Promise<
   return {value: v.value, metadata}
 }
 
+/**
+ * Get a file's content when its metadata is already known from the manifest.
+ */
+async function get_kv_content(
+  public_key: string,
+  path: string,
+  metadata: FileMetadata,
+  env: Env,
+): Promise<KVFile> {
+  if (metadata.hash) {
+    return {value: await env.STORAGE.get(`file:${metadata.hash}`, 'stream'), metadata}
+  }
+  // old style storage with file content in the site key
+  return {value: await env.STORAGE.get(`site:${public_key}:${path}`, 'stream'), metadata}
+}
+
 async function post_file(c: FullContext, public_key: string, path: string): Promise<Response> {
   const creation_ms = await check_upload_auth(public_key, c)
-  if (path == INFO_FILE_NAME) {
-    throw new HttpError(403, `Overwriting "${INFO_FILE_NAME}" is forbidden`)
-  }
+  check_upload_path(path)
   const {request, env} = c
 
   const content_type = request.headers.get('content-type')
+  // content is stored exactly as uploaded, and decompressed when served if the client doesn't accept gzip
+  const content_encoding = check_content_encoding(request.headers.get('smokeshow-content-encoding'))
   const extra_headers = [...request.headers.entries()]
     .filter(([k]) => k.startsWith('response-header-'))
-    .map(([k, v]) => [k.slice(16), v])
-  const blob = await request.blob()
-  const size = blob.size
+    .map(([k, v]): [string, string] => [k.slice(16), v])
+  const expiration = Math.round((creation_ms + SITE_TTL) / 1000)
+
+  const link_hash = request.headers.get('smokeshow-hash')
+  if (link_hash) {
+    // the content is already stored, so just add a file to this site pointing at it
+    const stored = await get_stored_file(link_hash, env)
+    if (!stored) {
+      throw new HttpError(404, `No file found with hash "${link_hash}", upload the file's content instead`)
+    }
+    const {size} = stored.metadata
+    // size comes from what's stored, not the client, so site size limits apply exactly as for uploads
+    const total_site_size = await new_file_check(public_key, size, env)
+    const metadata = {size, content_type, content_encoding, extra_headers}
+    check_upload_deadline(creation_ms)
+    await save_link(public_key, path, link_hash, stored, metadata, expiration, env)
+    return json_response({path, content_type, size, total_site_size})
+  }
+
+  const content_length = request.headers.get('content-length')
+  // checked before reading the body, so oversized files are rejected without reading them
+  if (content_length && parseInt(content_length) > MAX_FILE_SIZE) {
+    throw new HttpError(413, `Files can be at most ${MAX_FILE_SIZE} bytes`)
+  }
+  const metadata = {content_type, content_encoding, extra_headers}
+  const content_hash = request.headers.get('smokeshow-content-hash')
+  if (!content_length || !content_hash || !request.body) {
+    // the content's hash is needed before it can be stored, without it from the client, read the file into memory
+    const data = await request.arrayBuffer()
+    const size = data.byteLength
+    if (size > MAX_FILE_SIZE) {
+      throw new HttpError(413, `Files can be at most ${MAX_FILE_SIZE} bytes`)
+    }
+    const total_site_size = await new_file_check(public_key, size, env)
+    check_upload_deadline(creation_ms)
+    await save_file(public_key, path, data, metadata, expiration, env)
+    return json_response({path, content_type, size, total_site_size})
+  }
 
+  const size = parseInt(content_length)
+  // space is reserved before the body is read, so a file which would go over the site size limit is never read
   const total_site_size = await new_file_check(public_key, size, env)
+  try {
+    await stream_file(public_key, path, request.body, size, content_hash, metadata, creation_ms, env)
+  } catch (err) {
+    // release the reservation, the file wasn't saved
+    await reserve_site_size(public_key, [-size], env)
+    throw err
+  }
+  return json_response({path, content_type, size, total_site_size})
+}
 
-  const data_array = await blob.arrayBuffer()
-  const hash_array = await crypto.subtle.digest('sha-256', data_array)
-  const hash = array_to_base64(new Uint8Array(hash_array))
+/**
+ * Save a file without holding it in memory, the body is streamed into KV, and through a digest at the same time, to
+ * check it matches the hash sent by the client. The hash is checked as the body ends, before the KV put completes,
+ * and content which doesn't match errors the stream, so the put fails and nothing is stored under `file:{hash}`.
+ *
+ * If content with that hash is already stored, the body is only hashed, and the file is linked to the stored content.
+ */
+async function stream_file(
+  public_key: string,
+  path: string,
+  body: ReadableStream<Uint8Array>,
+  size: number,
+  hash: string,
+  site_metadata: FileMetadata,
+  creation_ms: number,
+  env: Env,
+): Promise<void> {
+  const expiration = Math.round((creation_ms + SITE_TTL) / 1000)
+  const digest = new crypto.DigestStream('SHA-256')
+  const digest_writer = digest.getWriter()
+  let hash_matches = true
+  // passes each chunk on once the digest has taken it, so the body is read no faster than KV stores it
+  const check_hash = new TransformStream<Uint8Array, Uint8Array>({
+    async transform(chunk, controller) {
+      await digest_writer.write(chunk)
+      controller.enqueue(chunk)
+    },
+    async flush() {
+      await digest_writer.close()
+      hash_matches = array_to_base64(new Uint8Array(await digest.digest)) == hash
+      if (!hash_matches) {
+        throw new Error('hash mismatch')
+      }
+    },
+  })
+  const hash_error = () => new HttpError(400, 'File content does not match "Smokeshow-Content-Hash"')
+
+  const stored = await get_stored_file(hash, env)
+  if (stored) {
+    try {
+      await body.pipeThrough(check_hash).pipeTo(new WritableStream())
+    } catch (err) {
+      await stored.value.cancel()
+      throw hash_matches ? err : hash_error()
+    }
+    check_upload_deadline(creation_ms)
+    await save_link(public_key, path, hash, stored, {...site_metadata, size}, expiration, env)
+    return
+  }
+
+  const file_metadata: StoredFileMetadata = {public_key, path, size, expiration}
+  try {
+    // FixedLengthStream errors if the body isn't the length given
+    const content = body.pipeThrough(check_hash).pipeThrough(new FixedLengthStream(size))
+    await env.STORAGE.put(`file:${hash}`, content, {expiration, metadata: file_metadata})
+  } catch (err) {
+    throw hash_matches ? err : hash_error()
+  }
+  // the content is stored, but isn't part of the site until the site key is written
+  check_upload_deadline(creation_ms)
+  const metadata: FileMetadata = {...site_metadata, size, hash}
+  await env.STORAGE.put(`site:${public_key}:${path}`, '1', {expiration, metadata})
+}
+
+async function post_archive(c: FullContext, public_key: string): Promise<Response> {
+  const creation_ms = await check_upload_auth(public_key, c)
+  const {request, env} = c
 
+  const archive_size = parseInt(request.headers.get('smokeshow-archive-size') || '')
+  if (!(archive_size >= 0)) {
+    throw new HttpError(400, 'The "Smokeshow-Archive-Size" header must be set to the total size of files in the archive')
+  } else if (!request.body) {
+    throw new HttpError(400, 'No archive in request body')
+  }
+  let body: ReadableStream<Uint8Array> = request.body
+  const archive_type = request.headers.get('content-type')
+  if (archive_type == 'application/gzip') {
+    body = body.pipeThrough(new DecompressionStream('gzip'))
+  } else if (archive_type != 'application/x-tar') {
+    throw new HttpError(415, 'Archives must have content-type "application/x-tar" or "application/gzip"')
+  }
+
+  // reserve space for the whole archive in one database call, rather than one per file
+  let total_site_size = await reserve_site_size(public_key, [archive_size], env)
   const expiration = Math.round((creation_ms + SITE_TTL) / 1000)
-  const metadata = {size, content_type, hash, extra_headers}
+
+  const files: Record<string, any>[] = []
+  const missing: string[] = []
+  // size of files read from the archive, and of those actually saved
+  let size = 0
+  let saved_size = 0
+  const tar = new TarReader(body)
+  try {
+    let entry: TarEntry | null
+    while ((entry = await tar.next())) {
+      if (files.length + missing.length >= MAX_ARCHIVE_FILES) {
+        throw new HttpError(413, `Archives can contain at most ${MAX_ARCHIVE_FILES} files`)
+      }
+      const path = `/${entry.path}`
+      check_upload_path(path)
+      const content_type = entry.pax['SMOKESHOW.content_type'] || null
+      const content_encoding = check_content_encoding(entry.pax['SMOKESHOW.content_encoding'])
+      const link_hash = entry.pax['SMOKESHOW.hash']
+      const stored = link_hash ? await get_stored_file(link_hash, env) : null
+      if (link_hash && !stored) {
+        // content has gone, the client will need to upload it
+        missing.push(path)
+        continue
+      }
+      const file_size = stored ? stored.metadata.size : entry.size
+      size += file_size
+      // checked before reading the file so nothing beyond the reserved size is ever buffered
+      if (size > archive_size) {
+        throw new HttpError(400, 'Files in the archive are larger than "Smokeshow-Archive-Size"')
+      }
+
+      if (stored) {
+        check_upload_deadline(creation_ms)
+        const metadata = {size: file_size, content_type, content_encoding}
+        await save_link(public_key, path, link_hash, stored, metadata, expiration, env)
+      } else {
+        const data = await tar.read(entry)
+        check_upload_deadline(creation_ms)
+        await save_file(public_key, path, data, {content_type, content_encoding}, expiration, env)
+      }
+      saved_size += file_size
+      files.push({path, content_type, size: file_size, linked: !!stored})
+    }
+  } finally {
+    if (saved_size < archive_size) {
+      // release the part of the reservation which wasn't used
+      total_site_size = await reserve_site_size(public_key, [saved_size - archive_size], env)
+    }
+  }
+  return json_response({files, missing, size: saved_size, total_site_size})
+}
+
+function check_upload_path(path: string): void {
+  if (path == INFO_FILE_NAME) {
+    throw new HttpError(403, `Overwriting "${INFO_FILE_NAME}" is forbidden`)
+  } else if (path.startsWith(RESERVED_PATH_PREFIX)) {
+    throw new HttpError(403, `Paths starting "${RESERVED_PATH_PREFIX}" are reserved`)
+  }
+}
+
+async function save_file(
+  public_key: string,
+  path: string,
+  data: ArrayBuffer | ArrayBufferView,
+  site_metadata: FileMetadata,
+  expiration: number,
+  env: Env,
+): Promise<void> {
+  const size = data.byteLength
+  const hash_array = await crypto.subtle.digest('sha-256', data)
+  const hash = array_to_base64(new Uint8Array(hash_array))
+
+  const metadata: FileMetadata = {...site_metadata, size, hash}
+  const file_metadata: StoredFileMetadata = {public_key, path, size, expiration}
 
   await Promise.all([
     env.STORAGE.put(`site:${public_key}:${path}`, '1', {expiration, metadata}),
-    env.STORAGE.put(`file:${hash}`, data_array, {expiration, metadata: {public_key, path}}),
+    env.STORAGE.put(`file:${hash}`, data, {expiration, metadata: file_metadata}),
   ])
-
-  return json_response({path, content_type, size, total_site_size})
 }
 
-async function site_summary(public_key: string, env: Env): Promise<Record<string, any>> {
-  const raw = await env.STORAGE.get(`site:${public_key}:${INFO_FILE_NAME}`, 'json')
-  if (!raw) {
-    throw new HttpError(404, `Site "${public_key}" not found`)
+async function save_link(
+  public_key: string,
+  path: string,
+  hash: string,
+  stored: StoredFile,
+  site_metadata: FileMetadata,
+  expiration: number,
+  env: Env,
+): Promise<void> {
+  const metadata: FileMetadata = {...site_metadata, hash}
+  const puts = [env.STORAGE.put(`site:${public_key}:${path}`, '1', {expiration, metadata})]
+  if (stored.metadata.expiration < expiration) {
+    // the content would expire before this site, store it again with the later expiration
+    const file_metadata: StoredFileMetadata = {...stored.metadata, expiration}
+    puts.push(env.STORAGE.put(`file:${hash}`, stored.value, {expiration, metadata: file_metadata}))
+  } else {
+    await stored.value.cancel()
   }
-  const obj = raw as Record<string, any>
-  const files = await list_all(`site:${public_key}:`, env)
-  obj.files = filter_files(files)
-  obj.total_site_size = files.map(k => k.metadata.size).reduce((a, v) => a + v, 0)
-  return obj
+  await Promise.all(puts)
 }
 
-export async function get_only_file(public_key: string, env: Env): Promise<string | undefined> {
-  const value = await env.STORAGE.list({prefix: `site:${public_key}:`})
-  const files = filter_files(value.keys)
-  if (files.length == 1) {
-    return files[0]
+async function check_hashes(c: FullContext, public_key: string): Promise<Response> {
+  await check_upload_auth(public_key, c)
+  let hashes: unknown
+  try {
+    hashes = ((await c.request.json()) as Record<string, unknown>).hashes
+  } catch (err) {
+    throw new HttpError(400, 'Invalid JSON body')
+  }
+  if (!Array.isArray(hashes) || !hashes.every(h => typeof h == 'string')) {
+    throw new HttpError(400, '"hashes" must be an array of strings')
+  } else if (hashes.length > MAX_CHECK_HASHES) {
+    throw new HttpError(413, `At most ${MAX_CHECK_HASHES} hashes can be checked in one request`)
   }
+
+  const stored = await Promise.all(hashes.map(hash => get_stored_file(hash, c.env)))
+  await Promise.all(stored.map(s => s && s.value.cancel()))
+  const missing = hashes.filter((_, i) => !stored[i])
+  return json_response({missing})
 }
 
-function filter_files(files: {name: string}[]): string[] {
-  return files.map(k => k.name.substring(PUBLIC_KEY_LENGTH + 6)).filter(f => f != INFO_FILE_NAME)
+interface StoredFile {
+  value: ReadableStream
+  metadata: StoredFileMetadata
+}
+
+async function get_stored_file(hash: string, env: Env): Promise<StoredFile | null> {
+  const v = await env.STORAGE.getWithMetadata(`file:${hash}`, 'stream')
+  if (!v.value) {
+    return null
+  }
+  const metadata = v.metadata as StoredFileMetadata | null
+  if (metadata && typeof metadata.size == 'number' && typeof metadata.expiration == 'number') {
+    return {value: v.value, metadata}
+  }
+  // files stored before size and expiration were recorded can't be linked
+  await v.value.cancel()
+  return null
 }
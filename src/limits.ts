@@ -19,8 +19,16 @@ export async function create_site_check(
 }
 
 export async function new_file_check(public_key: string, file_size: number, env: Env): Promise<number> {
-  const data = {public_key, file_size, size_limit: MAX_SITE_SIZE}
-  const total_size = await postgrest_post('check_new_file', data, env)
+  return await reserve_site_size(public_key, [file_size], env)
+}
+
+/**
+ * Reserve space for many files with one database call, the check and update happen in one statement so concurrent
+ * uploads to the same site can't both pass the limit. Negative sizes release space reserved earlier.
+ */
+export async function reserve_site_size(public_key: string, file_sizes: number[], env: Env): Promise<number> {
+  const data = {public_key, file_sizes, size_limit: MAX_SITE_SIZE}
+  const total_size = await postgrest_post('reserve_site_size', data, env)
 
   if (total_size == null) {
     throw new HttpError(429, `You've exceeded the site size limit of ${MAX_SITE_SIZE}.`)
@@ -0,0 +1,131 @@
+/**
+ * Manifest of all the files in a site, so paths can be resolved, including index and 404 fallbacks, with one
+ * KV read instead of a read for each option
+ */
+import {
+  INFO_FILE_NAME,
+  PUBLIC_KEY_LENGTH,
+  UPLOAD_TTL,
+  UPLOAD_GRACE,
+  KV_PROPAGATION_DELAY,
+  TEMPORARY_MANIFEST_TTL,
+} from './constants'
+import {FileMetadata, FullContext, Env, list_all} from './utils'
+
+export interface Manifest {
+  // content of the site's info file, INFO_FILE_NAME
+  info: Record<string, any>
+  // metadata of every file in the site by path, as stored with the "site:{public_key}:{path}" key
+  files: Record<string, FileMetadata>
+  // true once the site can no longer be uploaded to, so the manifest can't change
+  final: boolean
+}
+
+/**
+ * Get a site's manifest, building it from a list of the site's keys if it's not stored yet,
+ * null if the site doesn't exist.
+ *
+ * Files can't be added to the manifest as they're uploaded, since KV only allows one write per second to a key,
+ * instead a manifest built while the site can still be uploaded to is only kept briefly and isn't final.
+ */
+export async function get_manifest(public_key: string, c: FullContext): Promise<Manifest | null> {
+  const {env, ctx} = c
+  const key = `manifest:${public_key}`
+  const stored = (await env.STORAGE.get(key, 'json')) as Manifest | null
+  if (stored) {
+    return stored
+  }
+
+  const manifest = await build_manifest(public_key, env)
+  if (manifest) {
+    const options = manifest.final
+      ? {expiration: Math.round(Date.parse(manifest.info.site_expiration) / 1000)}
+      : {expirationTtl: TEMPORARY_MANIFEST_TTL}
+    // another request may have stored it at the same time, in which case this write can fail, that's fine
+    const put = env.STORAGE.put(key, JSON.stringify(manifest), options).catch(err =>
+      console.warn(`error storing manifest for ${public_key}:`, err),
+    )
+    ctx.waitUntil(put)
+  }
+  return manifest
+}
+
+/**
+ * A manifest which includes every file in the site, for answers which depend on all of them, like the summary:
+ * `manifest` if it's final, otherwise one built from KV now, since a stored manifest can be out of date.
+ */
+export async function current_manifest(
+  public_key: string,
+  manifest: Manifest | null,
+  env: Env,
+): Promise<Manifest | null> {
+  return manifest && manifest.final ? manifest : await build_manifest(public_key, env)
+}
+
+async function build_manifest(public_key: string, env: Env): Promise<Manifest | null> {
+  const info = (await env.STORAGE.get(`site:${public_key}:${INFO_FILE_NAME}`, 'json')) as Record<string, any> | null
+  if (!info) {
+    return null
+  }
+  // check if uploads have ended before listing files, so no upload can be missed from a final manifest, files can't be
+  // added after UPLOAD_GRACE, see check_upload_deadline
+  const final = Date.now() > Date.parse(info.site_creation) + UPLOAD_TTL + UPLOAD_GRACE + KV_PROPAGATION_DELAY
+  const files: Record<string, FileMetadata> = {}
+  for (const item of await list_all(`site:${public_key}:`, env)) {
+    files[item.name.substring(PUBLIC_KEY_LENGTH + 6)] = item.metadata
+  }
+  return {info, files, final}
+}
+
+export function* get_index_options(path: string) {
+  yield `${path}index.html`
+  yield `${path.slice(0, -1)}.html`
+  yield `${path}index.json`
+}
+
+export interface ResolvedPath {
+  path: string
+  status: number
+}
+
+/**
+ * Find the file to serve for a path, the first of:
+ * * the path itself
+ * * for directories, "index.html", "{directory}.html" or "index.json"
+ * * for the root, the only file in the site, if there's one file
+ * * "/404.html" or "/404.txt" with status 404
+ *
+ * Returns "summary" if the root has no index and the site's summary should be shown, null if nothing matches.
+ */
+export function resolve_path(manifest: Manifest, path: string): ResolvedPath | 'summary' | null {
+  const {files} = manifest
+  if (path in files) {
+    return {path, status: 200}
+  }
+  if (path.endsWith('/')) {
+    for (const option of get_index_options(path)) {
+      if (option in files) {
+        return {path: option, status: 200}
+      }
+    }
+    if (path == '/') {
+      const paths = site_paths(manifest)
+      return paths.length == 1 ? {path: paths[0], status: 200} : 'summary'
+    }
+  }
+  for (const option of ['/404.html', '/404.txt']) {
+    if (option in files) {
+      return {path: option, status: 404}
+    }
+  }
+  return null
+}
+
+export function site_paths(manifest: Manifest): string[] {
+  return Object.keys(manifest.files).filter(f => f != INFO_FILE_NAME)
+}
+
+export function site_summary(manifest: Manifest): Record<string, any> {
+  const total_site_size = Object.values(manifest.files).reduce((total, f) => total + (f.size || 0), 0)
+  return {...manifest.info, files: site_paths(manifest), total_site_size}
+}
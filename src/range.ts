@@ -0,0 +1,183 @@
+/**
+ * Support for "Range" requests for site files, see https://www.rfc-editor.org/rfc/rfc9110#name-range-requests
+ */
+import {MAX_RANGES} from './constants'
+import {response_with} from './utils'
+
+type ByteRange = [number, number]
+
+/**
+ * Parse a "Range" header into inclusive byte ranges of a file of `size` bytes, returns null if the header
+ * should be ignored and an empty array if no range is satisfiable.
+ *
+ * Ranges are sorted, with overlapping or adjacent ranges merged, and the header is ignored if the ranges add up to
+ * more than the whole file, see https://www.rfc-editor.org/rfc/rfc9110#section-14.2, so a request can't ask for
+ * more than the file's size.
+ */
+export function parse_ranges(header: string, size: number): ByteRange[] | null {
+  const m = header.match(/^\s*bytes\s*=(.+)$/i)
+  if (!m) {
+    return null
+  }
+  const ranges: ByteRange[] = []
+  for (const spec of m[1].split(',')) {
+    const r = spec.trim().match(/^(\d*)-(\d*)$/)
+    if (!r || (!r[1] && !r[2])) {
+      return null
+    }
+    if (!r[1]) {
+      // suffix range, the last N bytes
+      const suffix = parseInt(r[2])
+      if (suffix > 0 && size > 0) {
+        ranges.push([Math.max(size - suffix, 0), size - 1])
+      }
+      continue
+    }
+    const start = parseInt(r[1])
+    const last = r[2] ? parseInt(r[2]) : size - 1
+    if (last < start && r[2]) {
+      return null
+    }
+    if (start < size) {
+      ranges.push([start, Math.min(last, size - 1)])
+    }
+  }
+  if (ranges.length > MAX_RANGES || ranges.reduce((total, [start, last]) => total + last - start + 1, 0) > size) {
+    return null
+  }
+  ranges.sort((a, b) => a[0] - b[0])
+  const merged: ByteRange[] = []
+  for (const [start, last] of ranges) {
+    const previous = merged[merged.length - 1]
+    if (previous && start <= previous[1] + 1) {
+      previous[1] = Math.max(previous[1], last)
+    } else {
+      merged.push([start, last])
+    }
+  }
+  return merged
+}
+
+/**
+ * Return part of a file if the request has a "Range" header which applies to the response, the response must have
+ * "accept-ranges" and "content-length" headers.
+ */
+export async function range_response(request: Request, response: Response): Promise<Response> {
+  const header = request.headers.get('range')
+  const size = parseInt(response.headers.get('content-length') || '')
+  if (
+    !header ||
+    request.method != 'GET' ||
+    response.status != 200 ||
+    response.headers.get('accept-ranges') != 'bytes' ||
+    isNaN(size)
+  ) {
+    return response
+  }
+  const if_range = request.headers.get('if-range')
+  if (if_range && if_range != response.headers.get('etag')) {
+    // the client's copy is out of date, it needs the whole file
+    return response
+  }
+  const ranges = parse_ranges(header, size)
+  // multiple ranges are sent as a multipart body, which can't be sent with a content encoding of the parts
+  if (!ranges || (ranges.length > 1 && response.headers.has('content-encoding'))) {
+    return response
+  }
+
+  const headers = new Headers(response.headers)
+  if (ranges.length == 0) {
+    await response.body?.cancel()
+    const body = `416: None of the ranges requested are satisfiable for a file of ${size} bytes`
+    return new Response(body, {status: 416, headers: {'content-range': `bytes */${size}`}})
+  } else if (ranges.length == 1) {
+    const [start, end] = ranges[0]
+    headers.set('content-range', `bytes ${start}-${end}/${size}`)
+    headers.set('content-length', `${end - start + 1}`)
+    const body = response.body && slice_stream(response.body, start, end + 1)
+    return response_with(body, 206, headers)
+  }
+
+  const boundary = crypto.randomUUID()
+  const content_type = headers.get('content-type')
+  const encoder = new TextEncoder()
+  const part_headers = ranges.map(([start, end]) => {
+    const part_header = `content-type: ${content_type}\r\ncontent-range: bytes ${start}-${end}/${size}`
+    return encoder.encode(`--${boundary}\r\n${part_header}\r\n\r\n`)
+  })
+  const closing = encoder.encode(`--${boundary}--\r\n`)
+  // each part is its headers, its content, then "\r\n"
+  const length = ranges.reduce(
+    (total, [start, end], i) => total + part_headers[i].byteLength + end - start + 1 + 2,
+    closing.byteLength,
+  )
+  headers.set('content-type', `multipart/byteranges; boundary=${boundary}`)
+  headers.set('content-length', `${length}`)
+  const body = response.body && multipart_stream(response.body, ranges, part_headers, closing)
+  return response_with(body, 206, headers)
+}
+
+/**
+ * A "multipart/byteranges" body of `ranges` of a stream, read in one pass, so `ranges` must be sorted and not
+ * overlap, as they are from `parse_ranges`.
+ */
+function multipart_stream(
+  stream: ReadableStream<Uint8Array>,
+  ranges: ByteRange[],
+  part_headers: Uint8Array[],
+  closing: Uint8Array,
+): ReadableStream<Uint8Array> {
+  const line_end = new TextEncoder().encode('\r\n')
+  let offset = 0
+  let part = 0
+  let part_started = false
+  const transform = new TransformStream<Uint8Array, Uint8Array>({
+    transform(chunk, controller) {
+      const chunk_start = offset
+      offset += chunk.byteLength
+      while (part < ranges.length) {
+        const [start, end] = ranges[part]
+        if (offset <= start) {
+          // the next part starts in a later chunk
+          return
+        }
+        if (!part_started) {
+          controller.enqueue(part_headers[part])
+          part_started = true
+        }
+        const slice_start = Math.max(start - chunk_start, 0)
+        controller.enqueue(chunk.subarray(slice_start, Math.min(end + 1 - chunk_start, chunk.length)))
+        if (offset <= end) {
+          // the part continues in the next chunk
+          return
+        }
+        controller.enqueue(line_end)
+        part++
+        part_started = false
+      }
+      controller.enqueue(closing)
+      controller.terminate()
+    },
+  })
+  return stream.pipeThrough(transform)
+}
+
+/**
+ * Bytes `start` (inclusive) to `end` (exclusive) of a stream, the rest of the stream isn't read.
+ */
+function slice_stream(stream: ReadableStream<Uint8Array>, start: number, end: number): ReadableStream<Uint8Array> {
+  let offset = 0
+  const transform = new TransformStream<Uint8Array, Uint8Array>({
+    transform(chunk, controller) {
+      const chunk_start = offset
+      offset += chunk.byteLength
+      if (offset > start && chunk_start < end) {
+        controller.enqueue(chunk.subarray(Math.max(start - chunk_start, 0), Math.min(end - chunk_start, chunk.length)))
+      }
+      if (offset >= end) {
+        controller.terminate()
+      }
+    },
+  })
+  return stream.pipeThrough(transform)
+}
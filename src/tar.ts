@@ -0,0 +1,144 @@
+/**
+ * Minimal streaming reader for tar archives, entries are read one at a time so only the current file is in memory
+ */
+import {HttpError} from './utils'
+
+const BLOCK_SIZE = 512
+const decoder = new TextDecoder()
+
+export interface TarEntry {
+  path: string
+  size: number
+  // records from PAX extended headers, e.g. "path" or custom "SMOKESHOW.*" records
+  pax: Record<string, string>
+}
+
+export class TarReader {
+  private reader: ReadableStreamDefaultReader<Uint8Array>
+  private buffer = new Uint8Array(0)
+  // bytes of the current entry (including padding) which haven't been read yet
+  private remaining = 0
+
+  constructor(stream: ReadableStream<Uint8Array>) {
+    this.reader = stream.getReader()
+  }
+
+  /**
+   * Get the next regular file in the archive, or null at the end of the archive,
+   * directories, links and other special entries are skipped.
+   */
+  async next(): Promise<TarEntry | null> {
+    let pax: Record<string, string> = {}
+    let long_name: string | null = null
+    while (true) {
+      await this.skip(this.remaining)
+      this.remaining = 0
+      const header = await this.read_exactly(BLOCK_SIZE)
+      if (header.every(b => b == 0)) {
+        // end of archive marker
+        return null
+      }
+      let size = parse_octal(header.subarray(124, 136))
+      const type_flag = String.fromCharCode(header[156])
+
+      if (type_flag == 'x') {
+        pax = parse_pax(await this.read_exactly(padded(size)), size)
+      } else if (type_flag == 'L') {
+        // GNU long name
+        long_name = read_string(await this.read_exactly(padded(size)), 0, size)
+      } else if (type_flag == '0' || type_flag == '\0') {
+        size = pax.size ? parseInt(pax.size) : size
+        this.remaining = padded(size)
+        const path = pax.path || long_name || header_path(header)
+        return {path: path.replace(/^(\.?\/)+/, ''), size, pax}
+      } else {
+        // directories and other entries are skipped, as are any extended headers which applied to them
+        this.remaining = padded(size)
+        pax = {}
+        long_name = null
+      }
+    }
+  }
+
+  /**
+   * Read the content of the entry last returned by next().
+   */
+  async read(entry: TarEntry): Promise<Uint8Array> {
+    const data = await this.read_exactly(this.remaining)
+    this.remaining = 0
+    return data.subarray(0, entry.size)
+  }
+
+  private async read_exactly(size: number): Promise<Uint8Array> {
+    const out = new Uint8Array(size)
+    let offset = 0
+    while (offset < size) {
+      await this.fill()
+      const n = Math.min(size - offset, this.buffer.length)
+      out.set(this.buffer.subarray(0, n), offset)
+      this.buffer = this.buffer.subarray(n)
+      offset += n
+    }
+    return out
+  }
+
+  private async skip(size: number): Promise<void> {
+    while (size > 0) {
+      await this.fill()
+      const n = Math.min(size, this.buffer.length)
+      this.buffer = this.buffer.subarray(n)
+      size -= n
+    }
+  }
+
+  private async fill(): Promise<void> {
+    while (!this.buffer.length) {
+      const {done, value} = await this.reader.read()
+      if (done) {
+        throw new HttpError(400, 'Invalid archive, unexpected end of data')
+      }
+      this.buffer = value
+    }
+  }
+}
+
+const padded = (size: number): number => Math.ceil(size / BLOCK_SIZE) * BLOCK_SIZE
+
+function header_path(header: Uint8Array): string {
+  const name = read_string(header, 0, 100)
+  // ustar archives can split long paths between "prefix" and "name"
+  const prefix = read_string(header, 257, 263) == 'ustar' ? read_string(header, 345, 500) : ''
+  return prefix ? `${prefix}/${name}` : name
+}
+
+function read_string(data: Uint8Array, start: number, end: number): string {
+  const field = data.subarray(start, end)
+  const nul = field.indexOf(0)
+  return decoder.decode(nul == -1 ? field : field.subarray(0, nul))
+}
+
+function parse_octal(field: Uint8Array): number {
+  const value = parseInt(read_string(field, 0, field.length).trim() || '0', 8)
+  if (isNaN(value)) {
+    throw new HttpError(400, 'Invalid archive, invalid size in header')
+  }
+  return value
+}
+
+function parse_pax(data: Uint8Array, size: number): Record<string, string> {
+  // records have the form "<length> <key>=<value>\n" where length is in bytes and includes the whole record
+  const records: Record<string, string> = {}
+  let pos = 0
+  while (pos < size) {
+    const space = data.indexOf(32, pos)
+    const length = parseInt(decoder.decode(data.subarray(pos, space)), 10)
+    if (space == -1 || !length) {
+      throw new HttpError(400, 'Invalid archive, invalid PAX header')
+    }
+    const record = decoder.decode(data.subarray(space + 1, pos + length - 1))
+    const eq = record.indexOf('=')
+    records[record.slice(0, eq)] = record.slice(eq + 1)
+    pos += length
+  }
+  return records
+}
@@ -17,7 +17,7 @@ export interface FullContext {
 
 export const debug = (env: Env) => env.DEBUG === 'TRUE'
 
-export type Method = 'GET' | 'POST' | 'PUT' | 'DELETE' | 'OPTIONS'
+export type Method = 'GET' | 'HEAD' | 'POST' | 'PUT' | 'DELETE' | 'OPTIONS'
 
 export function simple_response(
   body: string | ReadableStream | ArrayBuffer,
@@ -50,20 +50,140 @@ export async function cached_proxy(url: string, content_type: string, env: Env):
 }
 
 export interface FileMetadata {
-  content_type?: string
+  content_type?: string | null
+  // set if content is stored compressed, currently only "gzip" is supported
+  content_encoding?: string | null
   hash?: string
   size?: number
   extra_headers?: [string, string][]
 }
 
+// metadata of the "file:{hash}" keys where file content is stored
+export interface StoredFileMetadata {
+  public_key: string
+  path: string
+  size: number
+  expiration: number
+}
+
 export interface KVFile {
   value: ReadableStream | null
   metadata: FileMetadata | null
 }
 
-export function response_from_kv(cache_value: KVFile, expires: number | null = null, status = 200): Response {
+export function response_from_kv(
+  cache_value: KVFile,
+  expires: number | null = null,
+  status = 200,
+  accept_encoding: string | null = null,
+): Response {
   const metadata: FileMetadata = cache_value.metadata || {}
-  return new Response(cache_value.value, {status, headers: build_headers(metadata, expires)})
+  const headers = build_headers(metadata, expires)
+  const etag = file_etag(metadata, accept_encoding)
+  if (etag && status == 200) {
+    headers['etag'] = etag
+  }
+  let body = cache_value.value
+  const decompress = metadata.content_encoding == 'gzip' && !accepts_gzip(accept_encoding)
+  if (metadata.size != null && !decompress) {
+    // content is served exactly as stored, so its length is known and ranges of it can be requested
+    headers['content-length'] = metadata.size.toString()
+    headers['accept-ranges'] = 'bytes'
+  }
+  if (metadata.content_encoding == 'gzip') {
+    headers['vary'] = 'accept-encoding'
+    if (!decompress) {
+      headers['content-encoding'] = 'gzip'
+      // the body is already compressed, stop the runtime from compressing it again
+      return new Response(body, {status, headers, encodeBody: 'manual'})
+    } else if (body) {
+      body = body.pipeThrough(new DecompressionStream('gzip'))
+    }
+  }
+  return new Response(body, {status, headers})
+}
+
+export function accepts_gzip(accept_encoding: string | null): boolean {
+  return (accept_encoding || '').split(',').some(part => {
+    const [coding, ...params] = part.trim().toLowerCase().split(';')
+    return (coding == 'gzip' || coding == '*') && !params.some(p => /^\s*q=0(\.0*)?\s*$/.test(p))
+  })
+}
+
+/**
+ * Strong ETag for a file stored by hash, files are decompressed for clients which don't accept gzip, so that
+ * representation gets a different tag.
+ */
+export function file_etag(metadata: FileMetadata, accept_encoding: string | null): string | null {
+  if (!metadata.hash) {
+    return null
+  }
+  const decompressed = metadata.content_encoding == 'gzip' && !accepts_gzip(accept_encoding)
+  return decompressed ? `"${metadata.hash}-identity"` : `"${metadata.hash}"`
+}
+
+/**
+ * Return "304 Not Modified" if the request's "If-None-Match" header matches the response's ETag.
+ */
+export function conditional_response(request: Request, response: Response): Response {
+  const etag = response.headers.get('etag')
+  const if_none_match = request.headers.get('if-none-match')
+  if (!etag || !if_none_match || response.status != 200) {
+    return response
+  }
+  // If-None-Match uses weak comparison
+  const match = if_none_match.split(',').some(tag => ['*', etag].includes(tag.trim().replace(/^W\//, '')))
+  if (!match) {
+    return response
+  }
+  response.body?.cancel()
+  const headers: Record<string, string> = {etag}
+  for (const name of ['vary', 'cache-control', 'expires']) {
+    const value = response.headers.get(name)
+    if (value) {
+      headers[name] = value
+    }
+  }
+  return new Response(null, {status: 304, headers})
+}
+
+/**
+ * Copy of a response to store with the Cache API for `ttl` seconds, any "cache-control" set for clients is kept
+ * in another header and restored by `from_cache`.
+ */
+export function to_cache(response: Response, ttl: number): Response {
+  const headers = new Headers(response.headers)
+  const cache_control = headers.get('cache-control')
+  if (cache_control) {
+    headers.set('smokeshow-cache-control', cache_control)
+  }
+  headers.set('cache-control', `max-age=${ttl}`)
+  return response_with(response.body, response.status, headers)
+}
+
+export function from_cache(response: Response): Response {
+  const headers = new Headers(response.headers)
+  headers.delete('cache-control')
+  headers.delete('cf-cache-status')
+  const cache_control = headers.get('smokeshow-cache-control')
+  if (cache_control) {
+    headers.set('cache-control', cache_control)
+    headers.delete('smokeshow-cache-control')
+  }
+  return response_with(response.body, response.status, headers)
+}
+
+export function response_with(body: BodyInit | null, status: number, headers: Headers): Response {
+  // a compressed body must be passed on as it is
+  const encodeBody = headers.has('content-encoding') ? 'manual' : 'automatic'
+  return new Response(body, {status, headers, encodeBody})
+}
+
+export function check_content_encoding(content_encoding: string | null | undefined): string | null {
+  if (content_encoding && content_encoding != 'gzip') {
+    throw new HttpError(415, `Unsupported content encoding "${content_encoding}", only "gzip" is supported`)
+  }
+  return content_encoding || null
 }
 
 function build_headers(metadata: FileMetadata, expires_in: number | null): Record<string, string> {
@@ -131,7 +251,7 @@ export function clean_path(url: URL): string {
 interface KvListItem {
   name: string
   expiration: number
-  metadata: {content_type: string; size: number}
+  metadata: FileMetadata
 }
 
 export async function list_all(prefix: string, env: Env): Promise<KvListItem[]> {
@@ -52,7 +52,7 @@ export const views: View[] = [
   },
   {
     match: site_path_regex,
-    allow: ['GET', 'POST'],
+    allow: ['GET', 'HEAD', 'POST'],
     view: site_request,
   },
 ]